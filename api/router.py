@@ -1,18 +1,29 @@
-import asyncio
 import base64
+import hashlib
 import json
 import mimetypes
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from typing import List, Dict, Any, Optional, AsyncGenerator, Literal
 
 import google.generativeai as genai
 import openai
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query, Header, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel, Field
 
 from core.orchestrator import Orchestrator
 import core.database as db
 from core.searxng import get_searxng_client
+from core.executor import get_provider_executor
+from core.resilience import circuit_breaker_stats, latency_stats, provider_health_stats
+from core.usage import get_process_usage
+from core.sse import SSEWriter, sse_stats
+from core.protocol import PROTOCOL_VERSIONS, compact_events
+from core.control import RunControl
+from core.sessions import get_session_store
+from core.coalesce import IdempotencyConflict, get_run_registry, request_fingerprint
+from core.ratelimit import client_key, get_rate_limiter
+from core.imaging import ImageTooLarge, InvalidImage, get_image_preprocessor, get_ocr_cache, read_limited
+from core.config import get_config
 from core.logging import get_logger
 
 logger = get_logger(__name__)
@@ -21,11 +32,25 @@ class ChatMessage(BaseModel):
     role: str
     content: str
 
-class QueryRequest(BaseModel):
+class TurnRequest(BaseModel):
+    """一轮评审的参数；会话接口只提交这些，历史消息由服务端保存"""
     question: str
     selected_models: List[str]
-    history: Optional[List[ChatMessage]] = []
     ocr_text: Optional[str] = None
+    max_rounds: Optional[int] = Field(None, ge=1, le=10)
+    prefetch_search: Optional[bool] = None
+    token_budget: Optional[int] = Field(None, ge=0)
+    # 事件协议版本：2 为去重的紧凑格式，verbosity 仅在协议 2 下生效
+    protocol: int = Field(1, ge=min(PROTOCOL_VERSIONS), le=max(PROTOCOL_VERSIONS))
+    verbosity: Literal["final_only", "summary", "full"] = "full"
+    # 是否把本次运行记入服务端历史（前端“自动保存”开关），默认不记录
+    save_history: bool = False
+
+class QueryRequest(TurnRequest):
+    history: Optional[List[ChatMessage]] = []
+
+class SessionCreateRequest(BaseModel):
+    history: List[ChatMessage] = []
 
 class ProviderModel(BaseModel):
     name: str = Field(..., min_length=1)
@@ -33,6 +58,7 @@ class ProviderModel(BaseModel):
     api_key: str
     models: str = Field(..., min_length=1)
     api_base: Optional[str] = None
+    equivalence_group: Optional[str] = None
 
 class ProviderUpdateModel(BaseModel):
     name: str = Field(..., min_length=1)
@@ -40,6 +66,7 @@ class ProviderUpdateModel(BaseModel):
     api_key: Optional[str] = None
     models: str = Field(..., min_length=1)
     api_base: Optional[str] = None
+    equivalence_group: Optional[str] = None
 
 router = APIRouter()
 
@@ -47,6 +74,24 @@ router = APIRouter()
 def health_check():
     return {"status": "ok"}
 
+@router.get("/metrics")
+async def get_metrics():
+    """运行时指标：供运维排查排队与延迟"""
+    registry = get_run_registry()
+    limiter = get_rate_limiter()
+    return {
+        "provider_executor": get_provider_executor().stats(),
+        "provider_health": provider_health_stats(),
+        "circuit_breakers": circuit_breaker_stats(),
+        "latency": latency_stats(),
+        "token_usage": get_process_usage().summary(),
+        "sse": sse_stats(),
+        "sessions": get_session_store().stats(),
+        "idempotency": registry.stats() if registry else None,
+        "rate_limit": limiter.stats() if limiter else None,
+        "ocr": {"preprocess": get_image_preprocessor().stats(), "cache": get_ocr_cache().stats()}
+    }
+
 def get_available_tools():
     """获取可用的工具列表"""
     from core.config import get_config
@@ -75,31 +120,207 @@ def get_available_tools():
     
     return tools
 
-async def stream_process_generator(request: QueryRequest) -> AsyncGenerator[str, None]:
+async def stream_process_generator(
+    request: TurnRequest,
+    control: Optional[RunControl] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    session_id: Optional[str] = None,
+    owner: Optional[str] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
     try:
         orch = Orchestrator()
-        history_dicts = [msg.model_dump() for msg in request.history] if request.history else []
+        if history is None:
+            history = [msg.model_dump() for msg in getattr(request, "history", None) or []]
         # 获取可用工具
         tools = get_available_tools()
         async for event in orch.process_query_stream(
             request.question, 
             request.selected_models, 
-            history_dicts, 
+            history, 
             request.ocr_text,
-            tools=tools if tools else None
+            tools=tools if tools else None,
+            max_rounds=request.max_rounds,
+            prefetch_search=request.prefetch_search,
+            token_budget=request.token_budget,
+            control=control,
+            save_history=request.save_history,
+            history_owner=owner
         ):
-            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0.01)
+            if session_id and event.get("type") == "final_result":
+                await _record_session_turn(session_id, request.question, event["data"].get("best_answer", ""))
+            yield event
     except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'data': f'错误: {e}'}, ensure_ascii=False)}\n\n"
+        yield {'type': 'error', 'data': f'错误: {e}'}
 
-@router.post("/process")
-async def process_user_query_stream(request: QueryRequest):
+# 关闭反向代理（nginx）的响应缓冲，帧到达即转发
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def _record_session_turn(session_id: str, question: str, answer: str) -> None:
+    """把本轮问答追加到会话；失败只记日志，不影响本次结果"""
+    try:
+        await get_session_store().append(session_id, [
+            {"role": "user", "content": question.strip()},
+            {"role": "assistant", "content": answer}
+        ])
+    except Exception as e:
+        logger.error(f"保存会话 {session_id} 的对话失败: {e}")
+
+def validate_query(request: TurnRequest) -> None:
     if not request.question.strip():
         raise HTTPException(400, "问题不能为空")
     if not request.selected_models:
         raise HTTPException(400, "必须选择至少一个模型")
-    return StreamingResponse(stream_process_generator(request), media_type="text/event-stream")
+
+def process_events(
+    request: TurnRequest,
+    control: Optional[RunControl] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    session_id: Optional[str] = None,
+    owner: Optional[str] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """一次评审运行的事件流，按请求协商的协议版本编码（SSE 与 WebSocket 共用）"""
+    return encode_for_client(request, stream_process_generator(request, control, history, session_id, owner))
+
+def encode_for_client(request: TurnRequest, events: AsyncGenerator[Dict[str, Any], None]) -> AsyncGenerator[Dict[str, Any], None]:
+    if request.protocol >= 2:
+        return compact_events(events, request.verbosity)
+    return events
+
+def request_client(http_request: Request) -> str:
+    """调用方标识，与限流使用同一规则（API token，否则客户端 IP）"""
+    return client_key(http_request.scope, get_config().rate_limit.trust_proxy)
+
+def history_owner(client: str, client_id: Optional[str] = None, session_id: Optional[str] = None) -> str:
+    """运行历史的所属者：会话内的运行属于会话；否则是前端随机生成的 X-Client-Id，没有时退回调用方标识"""
+    if session_id:
+        return f"session:{session_id}"
+    if client_id:
+        return "cid:" + hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:32]
+    return client
+
+def process_response(
+    request: TurnRequest,
+    client: str,
+    idempotency_key: Optional[str],
+    history: Optional[List[Dict[str, str]]] = None,
+    session_id: Optional[str] = None,
+    owner: Optional[str] = None
+) -> StreamingResponse:
+    """SSE 响应；相同的请求（同一 Idempotency-Key 或相同请求体）共享一次运行，见 core.coalesce"""
+    headers = {**SSE_HEADERS, "X-Event-Protocol": str(request.protocol)}
+    registry = get_run_registry()
+    if registry is None:
+        events = process_events(request, history=history, session_id=session_id, owner=owner)
+    else:
+        if history is None:
+            history = [msg.model_dump() for msg in getattr(request, "history", None) or []]
+        # 协议与 verbosity 只影响编码，不同编码的请求可以共享同一次运行
+        fingerprint = request_fingerprint({
+            **request.model_dump(exclude={"protocol", "verbosity", "history"}),
+            "history": history,
+            "session_id": session_id,
+            "owner": owner
+        })
+        # 没有 Idempotency-Key 时只合并同一客户端进行中的相同请求：不同用户问同一个问题仍各自运行，
+        # 运行结束后再发送相同的请求（重新生成）也会启动新的运行，而不是重放旧结果
+        key = f"key:{idempotency_key}" if idempotency_key else f"body:{client}:{fingerprint}"
+        try:
+            status, shared = registry.open(
+                key, fingerprint, lambda: stream_process_generator(request, None, history, session_id, owner),
+                replay=bool(idempotency_key)
+            )
+        except IdempotencyConflict:
+            raise HTTPException(422, "Idempotency-Key 已用于另一个不同的请求")
+        events = encode_for_client(request, shared)
+        headers["X-Idempotency-Status"] = status
+    return StreamingResponse(
+        SSEWriter.from_config().stream(events),
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+@router.post("/process")
+async def process_user_query_stream(
+    request: QueryRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    x_client_id: Optional[str] = Header(None, max_length=128)
+):
+    validate_query(request)
+    client = request_client(http_request)
+    return process_response(request, client, idempotency_key, owner=history_owner(client, x_client_id))
+
+# 服务端会话：创建后每轮只提交新问题，历史由服务端保存并随请求交给模型
+@router.post("/sessions", status_code=201)
+async def create_session(data: Optional[SessionCreateRequest] = None):
+    messages = [msg.model_dump() for msg in data.history] if data else []
+    return {"session_id": await get_session_store().create(messages)}
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    messages = await db.get_session_messages_async(session_id)
+    if messages is None:
+        raise HTTPException(404, "会话不存在")
+    return {"session_id": session_id, "messages": messages}
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not await get_session_store().delete(session_id):
+        raise HTTPException(404, "会话不存在")
+    return {"message": "会话已删除"}
+
+@router.post("/sessions/{session_id}/process")
+async def process_session_turn(
+    session_id: str,
+    request: TurnRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    validate_query(request)
+    history = await get_session_store().history(session_id)
+    if history is None:
+        raise HTTPException(404, "会话不存在")
+    client = request_client(http_request)
+    owner = history_owner(client, session_id=session_id)
+    return process_response(request, client, idempotency_key, history, session_id, owner)
+
+# 运行历史：只返回调用方自己的运行（X-Client-Id，或 session_id 指定的会话）；
+# 按 id 倒序的键集分页，before 传上一页返回的 next_cursor
+@router.get("/history")
+async def get_history(
+    http_request: Request,
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[int] = Query(None, ge=1),
+    session_id: Optional[str] = None,
+    x_client_id: Optional[str] = Header(None, max_length=128)
+):
+    owner = history_owner(request_client(http_request), x_client_id, session_id)
+    return await db.list_runs_async(owner, limit, before)
+
+@router.get("/history/search")
+async def search_history(
+    http_request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[int] = Query(None, ge=1),
+    session_id: Optional[str] = None,
+    x_client_id: Optional[str] = Header(None, max_length=128)
+):
+    owner = history_owner(request_client(http_request), x_client_id, session_id)
+    return await db.search_runs_async(owner, q, limit, before)
+
+@router.get("/history/{run_id}")
+async def get_history_run(
+    run_id: int,
+    http_request: Request,
+    session_id: Optional[str] = None,
+    x_client_id: Optional[str] = Header(None, max_length=128)
+):
+    owner = history_owner(request_client(http_request), x_client_id, session_id)
+    run = await db.get_run_async(run_id, owner)
+    if not run:
+        raise HTTPException(404, "运行记录不存在")
+    return run
 
 @router.get("/providers", response_model=List[Dict[str, Any]])
 def get_providers():
@@ -204,13 +425,18 @@ async def ocr_image(
         logger.error(f"[/api/ocr] 模型格式错误: {ocr_model}")
         raise HTTPException(400, "ocr_model 格式应为 '服务商名::模型名'")
 
-    provider_config = db.get_provider_by_name(provider_name)
+    provider_config = await db.get_provider_by_name_async(provider_name)
     if not provider_config:
         logger.error(f"[/api/ocr] 未找到服务商: {provider_name}")
         raise HTTPException(404, f"未找到服务商: {provider_name}")
 
-    # 读取图片字节与 MIME 类型
-    image_bytes = await file.read()
+    # 分块读取图片字节，超过上限立即拒绝
+    ocr_config = get_config().ocr
+    try:
+        image_bytes, upload_digest = await read_limited(file, ocr_config.max_upload_bytes)
+    except ImageTooLarge:
+        logger.error(f"[/api/ocr] 图片超过大小上限")
+        raise HTTPException(413, f"图片不能超过 {ocr_config.max_upload_bytes // (1024 * 1024)} MB")
     mime_type = file.content_type or mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream"
     
     logger.info(f"[/api/ocr] 图片字节数: {len(image_bytes)}")
@@ -220,6 +446,32 @@ async def ocr_image(
         logger.error(f"[/api/ocr] 未读取到图片内容")
         raise HTTPException(400, "未读取到图片内容")
 
+    # 同一张图片（按内容哈希）用同一个模型识别过就直接返回
+    cache = get_ocr_cache()
+    text = cache.get(upload_digest, ocr_model)
+    if text is not None:
+        logger.info(f"[/api/ocr] 命中缓存，ocr_text长度={len(text)}")
+        return JSONResponse({"ocr_text": text, "cached": True})
+
+    try:
+        prepared = await get_image_preprocessor().prepare(image_bytes, mime_type, upload_digest)
+    except ImageTooLarge:
+        raise HTTPException(413, "图片分辨率过大")
+    except InvalidImage as e:
+        logger.error(f"[/api/ocr] 无法解码图片: {e}")
+        raise HTTPException(400, "无法识别的图片格式")
+    logger.info(
+        f"[/api/ocr] 预处理后: {prepared.mime_type}, {len(prepared.data)} 字节"
+        f"{f', {prepared.width}x{prepared.height}' if prepared.width else ''}"
+    )
+    # 重新保存过（元数据不同）的同一张图，预处理后的内容相同
+    text = cache.get(prepared.digest, ocr_model)
+    if text is not None:
+        cache.put(upload_digest, ocr_model, text)
+        logger.info(f"[/api/ocr] 预处理后命中缓存，ocr_text长度={len(text)}")
+        return JSONResponse({"ocr_text": text, "cached": True})
+    image_bytes, mime_type = prepared.data, prepared.mime_type
+
     provider_type = provider_config.get('type')
     logger.info(f"[/api/ocr] 服务商类型: {provider_type}")
 
@@ -263,7 +515,7 @@ async def ocr_image(
                 {"mime_type": mime_type, "data": image_bytes}
             ]
             logger.info(f"[/api/ocr] 发送Gemini API请求...")
-            resp = await asyncio.to_thread(model.generate_content, parts)
+            resp = await get_provider_executor().run(provider_name, model.generate_content, parts)
             text = getattr(resp, 'text', '') or ''
             logger.info(f"[/api/ocr] Gemini返回OCR文本，长度: {len(text)}")
             logger.info(f"[/api/ocr] OCR文本内容: {text[:200]}...")
@@ -275,8 +527,11 @@ async def ocr_image(
             logger.warning(f"[/api/ocr] OCR返回空文本")
             text = ""
         
+        if text:
+            cache.put(upload_digest, ocr_model, text)
+            cache.put(prepared.digest, ocr_model, text)
         logger.info(f"[/api/ocr] 返回结果: ocr_text长度={len(text)}")
-        return JSONResponse({"ocr_text": text})
+        return JSONResponse({"ocr_text": text, "cached": False})
     except Exception as e:
         logger.error(f"[/api/ocr] OCR识别失败: {e}", exc_info=True)
         raise HTTPException(500, f"OCR 识别失败: {e}")
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import math
+from contextlib import nullcontext, suppress
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from fastapi import APIRouter, HTTPException, WebSocket
+from pydantic import ValidationError
+
+from api.router import QueryRequest, history_owner, process_events, validate_query
+from core.config import get_config
+from core.control import RunControl
+from core.sessions import get_session_store
+from core.ratelimit import QueueTimeout, client_key, get_rate_limiter
+from core.sse import EventQueue, close_connection_stats, encode_json, open_connection_stats
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+router = APIRouter()
+
+# 一条 WebSocket 连接上复用多个评审运行，每个运行占一个由客户端命名的 channel。
+# 连接 URL 可带 ?client_id=...，作用同 HTTP 的 X-Client-Id（request.save_history 为真时运行记入该标识的历史）。
+#
+# 客户端消息（文本帧或 UTF-8 JSON 二进制帧）：
+#   {"op": "hello", "window": 64, "binary": true}       可选；window 为每个 channel 未确认事件上限（0 不限），binary 让服务端用二进制帧发送
+#   {"op": "start", "channel": "c1", "request": {...}}  request 与 POST /api/process 的请求体相同
+#   {"op": "start", "channel": "c1", "session": "<id>", "request": {...}}  在服务端会话中继续对话，request 不含 history
+#   {"op": "ack", "channel": "c1", "n": 32}             归还 n 个发送额度
+#   {"op": "cancel", "channel": "c1"}                   取消整个运行
+#   {"op": "skip_model", "channel": "c1", "model": "provider::model"}  取消该模型进行中的调用，后续阶段不再使用
+#   {"op": "pause" | "resume", "channel": "c1"}         在下一个阶段边界暂停 / 继续
+#
+# 服务端消息：运行事件附带 "channel" 字段原样转发；运行结束时发送
+#   {"type": "channel_closed", "channel": "c1", "reason": "completed" | "cancelled" | "slow_consumer"}
+
+
+class _Channel:
+    """一个运行的事件队列、发送额度与控制开关"""
+
+    def __init__(self, channel_id: str, window: int, queue_size: int):
+        self.id = channel_id
+        self.control = RunControl()
+        self.stats = open_connection_stats("ws")
+        self.queue = EventQueue(queue_size, self.stats)
+        self.window = window
+        self.credits = window
+        self._credit = asyncio.Event()
+        self.pump: Optional[asyncio.Task] = None
+        self.sender: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+    def grant(self, n: int) -> None:
+        self.credits = min(self.window, self.credits + n)
+        self._credit.set()
+
+    async def take_credit(self) -> None:
+        if self.window <= 0:
+            return
+        while self.credits <= 0:
+            self._credit.clear()
+            await self._credit.wait()
+        self.credits -= 1
+
+
+class RunMultiplexer:
+    """处理一条 WebSocket 连接：解析控制消息，按 channel 启动、控制并转发运行"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.channels: Dict[str, _Channel] = {}
+        self.window = 0
+        self.binary = False
+        self.closed = False
+        self._send_lock = asyncio.Lock()
+        self.max_channels = get_config().stream.ws_max_channels
+        self.queue_size = get_config().stream.queue_size
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        if self.closed:
+            return
+        payload = encode_json(message)
+        # 多个 channel 的发送任务共用一条连接，逐条串行写出
+        async with self._send_lock:
+            try:
+                if self.binary:
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload.decode("utf-8"))
+            except Exception:
+                self.closed = True
+
+    async def error(self, data: str, channel: Optional[str] = None) -> None:
+        message: Dict[str, Any] = {"type": "error", "data": data}
+        if channel is not None:
+            message["channel"] = channel
+        await self.send(message)
+
+    async def serve(self) -> None:
+        await self.send({"type": "ready", "max_channels": self.max_channels})
+        while not self.closed:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            raw = message.get("text")
+            if raw is None and message.get("bytes") is not None:
+                raw = message["bytes"].decode("utf-8", errors="replace")
+            try:
+                msg = json.loads(raw or "")
+                if not isinstance(msg, dict):
+                    raise ValueError("message must be an object")
+            except ValueError as e:
+                await self.error(f"无效的消息: {e}")
+                continue
+            try:
+                await self.handle(msg)
+            except (TypeError, ValueError) as e:
+                await self.error(f"无效的消息: {e}", msg.get("channel"))
+
+    async def handle(self, msg: Dict[str, Any]) -> None:
+        op = msg.get("op")
+        if op == "hello":
+            self.window = max(0, int(msg.get("window") or 0))
+            self.binary = bool(msg.get("binary"))
+            return
+        channel_id = str(msg.get("channel") or "")
+        if not channel_id:
+            await self.error(f"{op} 缺少 channel")
+            return
+        if op == "start":
+            await self.start(channel_id, msg.get("request") or {}, msg.get("session"))
+            return
+
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            # 运行结束后仍可能收到在途的 ack，忽略即可
+            if op != "ack":
+                await self.error(f"channel 不存在: {channel_id}", channel_id)
+        elif op == "ack":
+            channel.grant(max(0, int(msg.get("n") or 0)))
+        elif op == "cancel":
+            await self.cancel(channel)
+        elif op == "skip_model":
+            model_name = str(msg.get("model") or "")
+            cancelled_calls = channel.control.skip(model_name)
+            logger.info(f"channel {channel_id}: 跳过模型 {model_name}，取消 {cancelled_calls} 个进行中的调用")
+        elif op == "pause":
+            channel.control.pause()
+        elif op == "resume":
+            channel.control.resume()
+        else:
+            await self.error(f"未知操作: {op}", channel_id)
+
+    async def start(self, channel_id: str, body: Dict[str, Any], session_id: Optional[str] = None) -> None:
+        if channel_id in self.channels:
+            await self.error(f"channel 已存在: {channel_id}", channel_id)
+            return
+        if len(self.channels) >= self.max_channels:
+            await self.error(f"同一连接最多 {self.max_channels} 个并发运行", channel_id)
+            return
+        try:
+            request = QueryRequest(**body)
+            validate_query(request)
+        except ValidationError as e:
+            await self.error(f"请求无效: {e.errors()}", channel_id)
+            return
+        except HTTPException as e:
+            await self.error(str(e.detail), channel_id)
+            return
+        # 与 /api/process 共用同一个令牌桶与公平队列（见 _pump）
+        client = client_key(self.websocket.scope, get_config().rate_limit.trust_proxy)
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            wait = await limiter.take(client, "process", len(request.selected_models))
+            if wait:
+                await self.error(f"请求过于频繁，请在 {math.ceil(wait)} 秒后重试", channel_id)
+                return
+        history = None
+        if session_id:
+            session_id = str(session_id)
+            history = await get_session_store().history(session_id)
+            if history is None:
+                await self.error(f"会话不存在: {session_id}", channel_id)
+                return
+
+        # 浏览器的 WebSocket 无法自定义请求头，历史记录标识由连接 URL 的 client_id 参数给出
+        owner = history_owner(client, self.websocket.query_params.get("client_id"), session_id)
+        channel = _Channel(channel_id, self.window, self.queue_size)
+        self.channels[channel_id] = channel
+        channel.pump = asyncio.create_task(
+            self._pump(channel, process_events(request, channel.control, history, session_id, owner), client)
+        )
+        channel.sender = asyncio.create_task(self._send_loop(channel))
+
+    async def _pump(self, channel: _Channel, events: AsyncGenerator[Dict[str, Any], None], client: str) -> None:
+        """以运行自身的速度把事件写入 channel 队列；队列溢出时停止运行。
+
+        启用限流时运行先在 process 公平队列里等到名额，与 HTTP 上的运行共享并发上限。
+        """
+        limiter = get_rate_limiter()
+        try:
+            async with limiter.queues["process"].slot(client) if limiter is not None else nullcontext():
+                async for event in events:
+                    if not channel.queue.put(event):
+                        break
+        except QueueTimeout:
+            limiter.timed_out["process"] += 1
+            channel.queue.put({"type": "error", "data": "服务繁忙，请稍后重试"})
+        finally:
+            channel.queue.close()
+            with suppress(Exception):
+                await events.aclose()
+
+    async def _send_loop(self, channel: _Channel) -> None:
+        reason = "completed"
+        try:
+            while True:
+                event = await channel.queue.get(None)
+                if event is None:
+                    break
+                await channel.take_credit()
+                await self.send({**event, "channel": channel.id})
+            if channel.queue.overflowed:
+                reason = "slow_consumer"
+                channel.stats.disconnect_reason = reason
+        except asyncio.CancelledError:
+            reason = "cancelled"
+            raise
+        finally:
+            self.channels.pop(channel.id, None)
+            close_connection_stats(channel.stats)
+            if channel.cancelled:
+                reason = "cancelled"
+            # 发送可能正被取消，结束消息放到独立任务里发出
+            asyncio.ensure_future(self.send({"type": "channel_closed", "channel": channel.id, "reason": reason}))
+
+    async def cancel(self, channel: _Channel) -> None:
+        channel.cancelled = True
+        for task in (channel.pump, channel.sender):
+            if task is not None:
+                task.cancel()
+        for task in (channel.pump, channel.sender):
+            if task is not None:
+                with suppress(asyncio.CancelledError, Exception):
+                    await task
+
+    async def close(self) -> None:
+        self.closed = True
+        for channel in list(self.channels.values()):
+            await self.cancel(channel)
+
+
+@router.websocket("/ws")
+async def websocket_runs(websocket: WebSocket):
+    await websocket.accept()
+    multiplexer = RunMultiplexer(websocket)
+    try:
+        await multiplexer.serve()
+    except Exception as e:
+        logger.warning(f"WebSocket 连接异常结束: {e}")
+    finally:
+        await multiplexer.close()
@@ -0,0 +1,97 @@
+"""Size reduction and read latency of the run archive tier.
+
+Builds a synthetic history (see history_bench.py), times get_run on hot
+runs, archives every run with each codec and reports the database size
+before/after (live pages, and file size after VACUUM) together with the
+latency of rehydrating cold runs.
+
+    python benchmarks/archive_bench.py --runs 5000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.database as db  # noqa: E402
+from history_bench import OWNER, _fake_run  # noqa: E402
+
+
+def _read_latency(run_ids: List[int]) -> str:
+    samples = []
+    for run_id in run_ids:
+        started = time.perf_counter()
+        run = db.get_run(run_id, OWNER)
+        samples.append((time.perf_counter() - started) * 1000)
+        assert run and run["answers"], run_id
+    samples.sort()
+    return f"median={statistics.median(samples):.3f}ms p95={samples[int(len(samples) * 0.95) - 1]:.3f}ms"
+
+
+def _mb(size: int) -> str:
+    return f"{size / 1e6:7.1f} MB"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5000)
+    parser.add_argument("--reads", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="archive-bench-")
+    try:
+        template = os.path.join(workdir, "template.db")
+        db.DB_PATH = template
+        db.initialize_database()
+        rng = random.Random(args.seed)
+        for index in range(args.runs):
+            db.save_run(_fake_run(rng, index))
+        db.close_db_connections()
+
+        sample = random.Random(args.seed).sample(range(1, args.runs + 1), min(args.reads, args.runs))
+        for codec in db.ARCHIVE_CODECS:
+            db.DB_PATH = os.path.join(workdir, f"{codec}.db")
+            shutil.copyfile(template, db.DB_PATH)
+            before = db.database_size()
+            hot = _read_latency(sample)
+
+            # a threshold of -1 days (created_at < tomorrow) treats every run as old
+            stats = {"runs": 0, "raw_bytes": 0, "compressed_bytes": 0}
+            started = time.perf_counter()
+            more = True
+            while more:
+                batch = db.archive_old_runs(-1, codec=codec)
+                for key in stats:
+                    stats[key] += batch[key]
+                more = batch["more"]
+            seconds = round(time.perf_counter() - started, 3)
+            after = db.database_size()
+            cold = _read_latency(sample)
+            with db.get_db_connection() as conn:
+                conn.execute("VACUUM")
+            vacuumed = db.database_size()
+
+            print(f"[{codec}] archived {stats['runs']} runs in {seconds}s, "
+                  f"payload {_mb(stats['raw_bytes'])} -> {_mb(stats['compressed_bytes'])} "
+                  f"(x{stats['raw_bytes'] / max(1, stats['compressed_bytes']):.1f})")
+            print(f"[{codec}] db used {_mb(before['used_bytes'])} -> {_mb(after['used_bytes'])}, "
+                  f"file after VACUUM {_mb(vacuumed['file_bytes'])}")
+            print(f"[{codec}] hot get_run  {hot}")
+            print(f"[{codec}] cold get_run {cold}")
+            db.close_db_connections()
+    finally:
+        db.close_db_connections()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Compare core.database throughput before and after connection reuse.
+
+Runs the real data-access functions from several reader and writer threads
+against a scratch copy of providers.db, once with the old
+connect-per-query / rollback-journal behaviour and once with the per-thread
+WAL connections, and prints queries per second for each.
+
+    python benchmarks/db_bench.py --readers 8 --writers 2 --seconds 5
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.database as db  # noqa: E402
+
+SOURCE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "providers.db")
+
+
+def legacy_connection() -> sqlite3.Connection:
+    """The previous get_db_connection: a fresh connection per call."""
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _read_ops() -> List[Callable[[], object]]:
+    provider = db.get_all_providers()
+    name = provider[0]["name"] if provider else "missing"
+    return [
+        lambda: db.get_provider_by_name(name),
+        db.get_active_prompt,
+        db.get_all_providers,
+    ]
+
+
+def _write_op() -> None:
+    prompt = db.get_active_prompt()
+    db.set_active_prompt(prompt["id"] if prompt else 1)
+
+
+def _worker(ops: List[Callable[[], object]], deadline: float, counts: List[int], errors: List[int], index: int) -> None:
+    done = failed = 0
+    while time.monotonic() < deadline:
+        for op in ops:
+            try:
+                op()
+                done += 1
+            except sqlite3.OperationalError:
+                # "database is locked" once a writer outlasts the busy timeout
+                failed += 1
+    counts[index] = done
+    errors[index] = failed
+
+
+def run(label: str, readers: int, writers: int, seconds: float) -> Dict[str, float]:
+    threads = []
+    total = readers + writers
+    counts = [0] * total
+    errors = [0] * total
+    read_ops = _read_ops()
+    deadline = time.monotonic() + seconds
+    for index in range(total):
+        ops = read_ops if index < readers else [_write_op]
+        threads.append(threading.Thread(target=_worker, args=(ops, deadline, counts, errors, index)))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    result = {
+        "reads/s": sum(counts[:readers]) / elapsed,
+        "writes/s": sum(counts[readers:]) / elapsed,
+        "errors": float(sum(errors)),
+    }
+    print(f"{label:<10} reads/s={result['reads/s']:>10.0f}  writes/s={result['writes/s']:>8.0f}  locked={int(result['errors'])}")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="db-bench-")
+    pooled_get_db_connection = db.get_db_connection
+    try:
+        db.DB_PATH = os.path.join(workdir, "legacy.db")
+        shutil.copyfile(SOURCE_DB, db.DB_PATH)
+        with sqlite3.connect(db.DB_PATH) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        db.get_db_connection = legacy_connection
+        before = run("before", args.readers, args.writers, args.seconds)
+
+        db.get_db_connection = pooled_get_db_connection
+        db.DB_PATH = os.path.join(workdir, "pooled.db")
+        shutil.copyfile(SOURCE_DB, db.DB_PATH)
+        after = run("after", args.readers, args.writers, args.seconds)
+        db.close_db_connections()
+
+        for key in ("reads/s", "writes/s"):
+            if before[key]:
+                print(f"{key:<10} x{after[key] / before[key]:.1f}")
+    finally:
+        db.get_db_connection = pooled_get_db_connection
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Latency of the run history queries on a large synthetic history.
+
+Fills a scratch database with ``--runs`` runs (two answers and two
+critiques each), then times the first and a deep keyset page of
+list_runs and search_runs.
+
+    python benchmarks/history_bench.py --runs 200000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.database as db  # noqa: E402
+
+TOPICS = ["SQLite 索引", "Python 异步", "向量数据库", "提示词缓存", "熔断器", "keyset pagination", "FTS5 trigram", "React 性能"]
+# Every run belongs to one client, so each query walks that owner's whole (owner, id) range
+OWNER = "ip:127.0.0.1"
+WORDS = "分析 优化 查询 缓存 并发 延迟 吞吐 索引 事务 日志 模型 评审 答案 建议 latency throughput index cache".split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _fake_run(rng: random.Random, index: int) -> Dict[str, object]:
+    question = f"{rng.choice(TOPICS)} 问题 {index}: {_text(rng, 12)}"
+    details = [
+        {"model_name": name, "initial_answer": _text(rng, 120), "revised_answer": _text(rng, 120), "total_score": rng.random() * 12}
+        for name in ("a::gpt", "b::gemini")
+    ]
+    critiques = [
+        {"round": 1, "critic_name": "b::gemini", "target_model": "a::gpt", "score": 7, "comment": _text(rng, 40), "raw_text": _text(rng, 60)},
+        {"round": 1, "critic_name": "a::gpt", "target_model": "b::gemini", "score": 8, "comment": _text(rng, 40), "raw_text": _text(rng, 60)},
+    ]
+    return {
+        "owner": OWNER, "question": question, "models": ["a::gpt", "b::gemini"], "best_answer": details[0]["revised_answer"],
+        "process_details": details, "critiques": critiques, "rounds": 1,
+    }
+
+
+def _timed(label: str, func: Callable[[], Dict[str, object]], repeat: int = 50) -> Dict[str, object]:
+    samples: List[float] = []
+    result: Dict[str, object] = {}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+    items = result.get("items", [])
+    print(f"{label:<32} median={statistics.median(samples):7.2f}ms  p95={sorted(samples)[int(len(samples) * 0.95) - 1]:7.2f}ms  items={len(items)}")  # type: ignore[arg-type]
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="history-bench-")
+    try:
+        db.DB_PATH = os.path.join(workdir, "history.db")
+        db.initialize_database()
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        for index in range(args.runs):
+            db.save_run(_fake_run(rng, index))
+        elapsed = time.perf_counter() - started
+        size_mb = os.path.getsize(db.DB_PATH) / 1e6
+        print(f"inserted {args.runs} runs in {elapsed:.1f}s ({args.runs / elapsed:.0f} runs/s), db {size_mb:.0f} MB")
+
+        first = _timed("list first page", lambda: db.list_runs(OWNER, 20))
+        deep_cursor = args.runs // 2
+        _timed("list page at id < runs/2", lambda: db.list_runs(OWNER, 20, deep_cursor))
+        hits = _timed("search 'SQLite 索引'", lambda: db.search_runs(OWNER, "SQLite 索引", 20))
+        _timed("search next page", lambda: db.search_runs(OWNER, "SQLite 索引", 20, hits["next_cursor"]))  # type: ignore[arg-type]
+        _timed("search rare 'keyset pagination'", lambda: db.search_runs(OWNER, "keyset pagination", 20, deep_cursor))
+        _timed("search answers 'throughput'", lambda: db.search_runs(OWNER, "throughput", 20))
+        _timed("get run", lambda: db.get_run(first["items"][0]["id"], OWNER) or {})  # type: ignore[index]
+    finally:
+        db.close_db_connections()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
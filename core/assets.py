@@ -0,0 +1,170 @@
+"""In-memory static asset pipeline.
+
+At startup every file under ``static/`` is read once, fingerprinted by
+content hash and, for text types, compressed with gzip (and brotli when
+the optional ``brotli`` package is installed). HTML pages get their
+``src="/static/..."`` / ``href="/static/..."`` references rewritten to the
+fingerprinted URLs, e.g. ``/static/script.3f2a1b9c04de.js``.
+
+Fingerprinted URLs never change content, so they are served with
+``Cache-Control: immutable`` and a one-year max-age. Plain URLs (``/`` and
+``/static/script.js``) are served with ``no-cache`` so the browser
+revalidates them, which is a cheap 304 thanks to the ETag.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from core.logging import get_logger
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+__all__ = ["Asset", "AssetStore", "IMMUTABLE_CACHE", "REVALIDATE_CACHE"]
+
+logger = get_logger(__name__)
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# 小于这个大小的文件压缩收益抵不过额外的头部与解压开销
+_MIN_COMPRESS_SIZE = 512
+_DIGEST_LENGTH = 12
+_HTML_REFERENCE = re.compile(r'(\b(?:src|href)=")/static/([^"?#]+)(?:\?[^"]*)?(")')
+
+
+@dataclass
+class Asset:
+    name: str
+    fingerprinted: str
+    media_type: str
+    digest: str
+    # 编码 -> 内容；identity 始终存在，gzip / br 只在比原文小时保留
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    accepted: Dict[str, float] = {}
+    for part in header.split(","):
+        token, _, params = part.strip().partition(";")
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+    return accepted
+
+
+def _etag_matches(if_none_match: str, etags: List[str]) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in etags:
+            return True
+    return False
+
+
+class AssetStore:
+    """Fingerprinted, precompressed copies of the files in one directory."""
+
+    def __init__(self, directory: str, url_prefix: str = "/static") -> None:
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip("/")
+        self._assets: Dict[str, Asset] = {}
+        self._by_fingerprint: Dict[str, Asset] = {}
+
+    def load(self) -> None:
+        """(Re)build the store from disk; HTML is processed last so it can reference the others."""
+        assets: Dict[str, Asset] = {}
+        names = sorted(
+            os.path.relpath(os.path.join(root, filename), self.directory).replace(os.sep, "/")
+            for root, _, filenames in os.walk(self.directory)
+            for filename in filenames
+            if not filename.startswith(".")
+        )
+        html = [name for name in names if name.endswith(".html")]
+        for name in [name for name in names if not name.endswith(".html")] + html:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                content = f.read()
+            if name.endswith(".html"):
+                content = self._rewrite_references(content.decode("utf-8"), assets).encode("utf-8")
+            assets[name] = self._build(name, content)
+
+        self._assets = assets
+        self._by_fingerprint = {asset.fingerprinted: asset for asset in assets.values()}
+        raw = sum(len(asset.variants["identity"]) for asset in assets.values())
+        packed = sum(len(asset.variants.get("gzip", asset.variants["identity"])) for asset in assets.values())
+        logger.info(
+            f"静态资源已加载: {len(assets)} 个文件, {raw / 1024:.0f} KB, gzip 后 {packed / 1024:.0f} KB"
+            f"{'' if brotli else '（未安装 brotli，仅提供 gzip）'}"
+        )
+
+    def _build(self, name: str, content: bytes) -> Asset:
+        digest = hashlib.sha256(content).hexdigest()[:_DIGEST_LENGTH]
+        stem, ext = os.path.splitext(name)
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type += "; charset=utf-8"
+        asset = Asset(name, f"{stem}.{digest}{ext}", media_type, digest, {"identity": content})
+        if len(content) >= _MIN_COMPRESS_SIZE and media_type.startswith(_COMPRESSIBLE):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                asset.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    asset.variants["br"] = compressed
+        return asset
+
+    def _rewrite_references(self, html: str, assets: Dict[str, Asset]) -> str:
+        def replace(match: "re.Match[str]") -> str:
+            asset = assets.get(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{self.url_prefix}/{asset.fingerprinted}{match.group(3)}"
+        return _HTML_REFERENCE.sub(replace, html)
+
+    def respond(self, path: str, accept_encoding: str = "", if_none_match: Optional[str] = None) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+        """``(status, headers, body)`` for ``path``, or None if there is no such asset."""
+        immutable = path in self._by_fingerprint
+        asset = self._by_fingerprint.get(path) or self._assets.get(path)
+        if asset is None:
+            return None
+
+        accepted = _accepted_encodings(accept_encoding)
+        encoding = next(
+            (candidate for candidate in ("br", "gzip") if candidate in asset.variants and accepted.get(candidate, 0) > 0),
+            "identity"
+        )
+        headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE,
+            "Vary": "Accept-Encoding",
+        }
+        if if_none_match and _etag_matches(if_none_match, [asset.etag(variant) for variant in asset.variants]):
+            return 304, headers, b""
+
+        headers["Content-Type"] = asset.media_type
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return 200, headers, asset.variants[encoding]
@@ -0,0 +1,220 @@
+"""Idempotency keys and request coalescing for review runs.
+
+Double-clicks, retries and reconnects used to start a full peer review for
+every copy of the same request. Runs are now registered under a key: the
+client's ``Idempotency-Key`` header, or a hash of the request body when
+the header is absent (scoped to the calling client, so unrelated users
+asking the same question are not merged).
+
+* A submission whose key matches a run in progress attaches to that run:
+  it first receives the events emitted so far, then the live ones. Of the
+  ``answer_delta`` events only the most recent ones of answers still being
+  generated are kept for this replay.
+* A submission whose explicit key matches a run that finished with a
+  ``final_result`` in the last ``replay_seconds`` gets that result
+  replayed instead of a new run. Body-derived keys only ever attach to
+  runs in progress: sending the same body again after it finished (e.g.
+  "regenerate") starts a new run.
+* Reusing an explicit key for a different request body is a conflict.
+
+Runs are shared as protocol 1 events; every subscriber applies its own
+protocol / verbosity afterwards. A shared run keeps going while anyone is
+subscribed; once the last subscriber has been gone for a short grace
+period (long enough for a reconnect) it is cancelled.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from core.config import get_config
+from core.logging import get_logger
+
+__all__ = ["IdempotencyConflict", "RunRegistry", "SharedRun", "get_run_registry", "request_fingerprint"]
+
+logger = get_logger(__name__)
+
+Event = Dict[str, Any]
+
+# 最后一个订阅者断开后，等待这么久再取消运行，给客户端重连留出时间
+_ORPHAN_GRACE_SECONDS = 10.0
+# 每次运行保留供后来者重放的 answer_delta 上限；更早的增量只丢弃，完整答案随 initial_answer_complete 送达
+_MAX_REPLAYED_DELTAS = 512
+
+
+class IdempotencyConflict(Exception):
+    """An explicit Idempotency-Key was reused for a different request."""
+
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    """Stable hash of a request body, independent of key order and whitespace."""
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SharedRun:
+    """One run's event log, readable from the start by any number of subscribers."""
+
+    def __init__(self, key: str, fingerprint: str, replayable: bool = True) -> None:
+        self.key = key
+        self.fingerprint = fingerprint
+        self.replayable = replayable
+        # 被丢弃的增量原位置留 None，订阅者的读取位置不受影响
+        self.events: List[Optional[Event]] = []
+        self._deltas: Deque[Tuple[int, Any]] = deque()
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, event: Event) -> None:
+        async with self._changed:
+            event_type = event.get("type")
+            if event_type == "answer_delta":
+                self._deltas.append((len(self.events), event.get("model_name")))
+                if len(self._deltas) > _MAX_REPLAYED_DELTAS:
+                    self.events[self._deltas.popleft()[0]] = None
+            elif event_type == "initial_answer_complete" and self._deltas:
+                # 该模型的答案已完整送达，它的增量不必再留给后来者
+                model_name = event.get("model_name")
+                for index, delta_model in self._deltas:
+                    if delta_model == model_name:
+                        self.events[index] = None
+                self._deltas = deque(item for item in self._deltas if item[1] != model_name)
+            self.events.append(event)
+            self._changed.notify_all()
+
+    async def finish(self) -> None:
+        async with self._changed:
+            self.done = True
+            self._changed.notify_all()
+
+    @property
+    def result(self) -> Optional[Event]:
+        last = self.events[-1] if self.events else None
+        if last is not None and last.get("type") == "final_result":
+            return last
+        return None
+
+    async def _read(self) -> AsyncGenerator[Event, None]:
+        index = 0
+        while True:
+            while index < len(self.events):
+                event = self.events[index]
+                index += 1
+                if event is not None:
+                    yield event
+            if self.done:
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: index < len(self.events) or self.done)
+
+
+class RunRegistry:
+    """Runs in progress and recently completed results, by idempotency key."""
+
+    def __init__(self, replay_seconds: float, max_entries: int) -> None:
+        self.replay_seconds = replay_seconds
+        self.max_entries = max(1, max_entries)
+        self._running: Dict[str, SharedRun] = {}
+        # key -> (请求指纹, 过期时间, final_result 事件)，按完成顺序排列
+        self._completed: "OrderedDict[str, Tuple[str, float, Event]]" = OrderedDict()
+        self.counts = {"started": 0, "attached": 0, "replayed": 0}
+
+    def open(
+        self, key: str, fingerprint: str, start: Callable[[], AsyncIterator[Event]], replay: bool = True
+    ) -> Tuple[str, AsyncGenerator[Event, None]]:
+        """Events for the request under ``key``, and whether the run was started, attached or replayed.
+
+        ``start`` is only called when a new run is needed. With ``replay``
+        false the run is only shared while in progress and its result is
+        not kept. Raises ``IdempotencyConflict`` when ``key`` belongs to a
+        different request.
+        """
+        self._expire()
+        completed = self._completed.get(key) if replay else None
+        if completed is not None:
+            if completed[0] != fingerprint:
+                raise IdempotencyConflict(key)
+            self.counts["replayed"] += 1
+            return "replayed", self._replay(completed[2])
+
+        run = self._running.get(key)
+        if run is not None:
+            if run.fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            self.counts["attached"] += 1
+            return "attached", self._subscribe(run)
+
+        run = SharedRun(key, fingerprint, replay)
+        self._running[key] = run
+        run.task = asyncio.create_task(self._drive(run, start()))
+        self.counts["started"] += 1
+        return "started", self._subscribe(run)
+
+    async def _drive(self, run: SharedRun, events: AsyncIterator[Event]) -> None:
+        try:
+            async for event in events:
+                await run.publish(event)
+        finally:
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            await run.finish()
+            if self._running.get(run.key) is run:
+                del self._running[run.key]
+            result = run.result
+            if result is not None and run.replayable and self.replay_seconds > 0:
+                self._completed[run.key] = (run.fingerprint, time.monotonic() + self.replay_seconds, result)
+                self._completed.move_to_end(run.key)
+                while len(self._completed) > self.max_entries:
+                    self._completed.popitem(last=False)
+
+    async def _subscribe(self, run: SharedRun) -> AsyncGenerator[Event, None]:
+        run.subscribers += 1
+        try:
+            async for event in run._read():
+                yield event
+        finally:
+            run.subscribers -= 1
+            if run.subscribers == 0 and not run.done:
+                asyncio.get_running_loop().call_later(_ORPHAN_GRACE_SECONDS, self._reap, run)
+
+    def _reap(self, run: SharedRun) -> None:
+        if run.subscribers == 0 and not run.done and run.task is not None:
+            logger.info(f"运行 {run.key[:16]} 已无订阅者，取消")
+            run.task.cancel()
+
+    @staticmethod
+    async def _replay(result: Event) -> AsyncGenerator[Event, None]:
+        yield result
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._completed:
+            key, (_, expires_at, _) = next(iter(self._completed.items()))
+            if expires_at > now:
+                break
+            del self._completed[key]
+
+    def stats(self) -> Dict[str, int]:
+        self._expire()
+        return {"running": len(self._running), "replayable": len(self._completed), **self.counts}
+
+
+_registry: Optional[RunRegistry] = None
+
+
+def get_run_registry() -> Optional[RunRegistry]:
+    """The process-wide registry, or None when REQUEST_COALESCING is off."""
+    global _registry
+    config = get_config().idempotency
+    if not config.enabled:
+        return None
+    if _registry is None:
+        _registry = RunRegistry(config.replay_seconds, config.max_entries)
+    return _registry
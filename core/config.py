@@ -34,12 +34,126 @@ class BrowserSearchConfig:
     timeout_ms: int = 15000
     user_agent: Optional[str] = None
 
+@dataclasses.dataclass
+class PipelineConfig:
+    max_rounds: int = 1
+    score_delta_threshold: float = 0.5
+    edit_distance_threshold: float = 0.05
+
+@dataclasses.dataclass
+class ToolConfig:
+    shared_cache: bool = False
+    cache_ttl: float = 300.0
+    cache_max_entries: int = 256
+    max_concurrency: int = 4
+    network_timeout: float = 15.0
+    browser_timeout: float = 45.0
+    max_steps: int = 3
+    time_budget: float = 120.0
+    prefetch: bool = False
+
+@dataclasses.dataclass
+class ExecutorConfig:
+    max_workers: int = 8
+    per_provider_limit: int = 4
+
+@dataclasses.dataclass
+class RetryConfig:
+    max_attempts: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+
+@dataclasses.dataclass
+class CircuitBreakerConfig:
+    window: int = 20
+    min_calls: int = 5
+    failure_rate: float = 0.5
+    slow_call_seconds: float = 0.0
+    cooldown: float = 30.0
+
+@dataclasses.dataclass
+class HedgeConfig:
+    enabled: bool = True
+    min_samples: int = 5
+    min_delay: float = 0.5
+
+@dataclasses.dataclass
+class UsageConfig:
+    token_budget: int = 0
+    stream_usage: bool = True
+
+@dataclasses.dataclass
+class DatabaseConfig:
+    busy_timeout_ms: int = 5000
+    statement_cache_size: int = 256
+    history_enabled: bool = True
+    archive_after_days: float = 7.0
+    archive_codec: str = 'zlib'
+    archive_interval_hours: float = 6.0
+
+@dataclasses.dataclass
+class StreamConfig:
+    flush_interval_ms: int = 30
+    max_frame_bytes: int = 16384
+    heartbeat_seconds: float = 15.0
+    answer_deltas: bool = True
+    queue_size: int = 256
+    ws_max_channels: int = 8
+
+@dataclasses.dataclass
+class SessionConfig:
+    cache_size: int = 256
+    idle_hours: float = 24.0
+    max_history_messages: int = 40
+
+@dataclasses.dataclass
+class IdempotencyConfig:
+    enabled: bool = True
+    replay_seconds: float = 600.0
+    max_entries: int = 1000
+
+@dataclasses.dataclass
+class RateLimitConfig:
+    # 默认关闭：部署在反向代理后面时需同时开启 trust_proxy，否则所有用户共用代理的 IP 桶
+    enabled: bool = False
+    # 每分钟令牌数（同时也是突发上限）；/api/process 每个选中的模型消耗一个令牌
+    process_per_minute: float = 120.0
+    ocr_per_minute: float = 10.0
+    search_per_minute: float = 30.0
+    store: str = 'memory'
+    trust_proxy: bool = False
+    # 名额在整个 SSE 评审期间占用，需明显高于正常的并行评审数
+    queue_concurrency: int = 32
+    queue_timeout_seconds: float = 60.0
+
+@dataclasses.dataclass
+class OCRConfig:
+    max_upload_bytes: int = 20 * 1024 * 1024
+    max_dimension: int = 2048
+    max_pixels: int = 50_000_000
+    quality: int = 90
+    preprocess_workers: int = 2
+    cache_size: int = 512
+
 @dataclasses.dataclass
 class AppConfig:
     server: ServerConfig
     proxy: ProxyConfig
     searxng: SearXNGConfig
     browser: BrowserSearchConfig
+    pipeline: PipelineConfig
+    tools: ToolConfig
+    executor: ExecutorConfig
+    retry: RetryConfig
+    breaker: CircuitBreakerConfig
+    hedge: HedgeConfig
+    usage: UsageConfig
+    database: DatabaseConfig
+    stream: StreamConfig
+    session: SessionConfig
+    idempotency: IdempotencyConfig
+    rate_limit: RateLimitConfig
+    ocr: OCRConfig
 
 _config: Optional[AppConfig] = None
 
@@ -89,11 +203,122 @@ def get_config() -> AppConfig:
             timeout_ms=int(os.getenv('BROWSER_SEARCH_TIMEOUT_MS', '15000') or 15000),
             user_agent=os.getenv('BROWSER_SEARCH_USER_AGENT')
         )
+
+        pipeline_config = PipelineConfig(
+            max_rounds=max(1, int(os.getenv('PIPELINE_MAX_ROUNDS', '1') or 1)),
+            score_delta_threshold=float(os.getenv('PIPELINE_SCORE_DELTA', '0.5') or 0.5),
+            edit_distance_threshold=float(os.getenv('PIPELINE_EDIT_DISTANCE', '0.05') or 0.05)
+        )
+
+        tool_config = ToolConfig(
+            shared_cache=os.getenv('TOOL_CACHE_SHARED', 'False').lower() == 'true',
+            cache_ttl=float(os.getenv('TOOL_CACHE_TTL', '300') or 300),
+            cache_max_entries=int(os.getenv('TOOL_CACHE_MAX_ENTRIES', '256') or 256),
+            max_concurrency=int(os.getenv('TOOL_MAX_CONCURRENCY', '4') or 4),
+            network_timeout=float(os.getenv('TOOL_NETWORK_TIMEOUT', '15') or 15),
+            browser_timeout=float(os.getenv('TOOL_BROWSER_TIMEOUT', '45') or 45),
+            max_steps=max(0, int(os.getenv('TOOL_MAX_STEPS', '3') or 3)),
+            time_budget=float(os.getenv('TOOL_TIME_BUDGET', '120') or 120),
+            prefetch=os.getenv('TOOL_PREFETCH_SEARCH', 'False').lower() == 'true'
+        )
+
+        executor_config = ExecutorConfig(
+            max_workers=int(os.getenv('PROVIDER_EXECUTOR_WORKERS', '8') or 8),
+            per_provider_limit=int(os.getenv('PROVIDER_EXECUTOR_PER_PROVIDER', '4') or 4)
+        )
+
+        retry_config = RetryConfig(
+            max_attempts=int(os.getenv('MODEL_MAX_RETRIES', '3') or 3),
+            base_delay=float(os.getenv('MODEL_RETRY_BASE_DELAY', '1') or 1),
+            max_delay=float(os.getenv('MODEL_RETRY_MAX_DELAY', '30') or 30)
+        )
+
+        breaker_config = CircuitBreakerConfig(
+            window=int(os.getenv('BREAKER_WINDOW', '20') or 20),
+            min_calls=int(os.getenv('BREAKER_MIN_CALLS', '5') or 5),
+            failure_rate=float(os.getenv('BREAKER_FAILURE_RATE', '0.5') or 0.5),
+            slow_call_seconds=float(os.getenv('BREAKER_SLOW_CALL_SECONDS', '0') or 0),
+            cooldown=float(os.getenv('BREAKER_COOLDOWN', '30') or 30)
+        )
+
+        hedge_config = HedgeConfig(
+            enabled=os.getenv('HEDGE_ENABLED', 'True').lower() == 'true',
+            min_samples=int(os.getenv('HEDGE_MIN_SAMPLES', '5') or 5),
+            min_delay=float(os.getenv('HEDGE_MIN_DELAY', '0.5') or 0.5)
+        )
+
+        usage_config = UsageConfig(
+            token_budget=max(0, int(os.getenv('RUN_TOKEN_BUDGET', '0') or 0)),
+            stream_usage=os.getenv('STREAM_USAGE_ENABLED', 'True').lower() == 'true'
+        )
+
+        database_config = DatabaseConfig(
+            busy_timeout_ms=int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000') or 5000),
+            statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256') or 256),
+            history_enabled=os.getenv('RUN_HISTORY_ENABLED', 'True').lower() == 'true',
+            archive_after_days=float(os.getenv('ARCHIVE_AFTER_DAYS', '7') or 0),
+            archive_codec=os.getenv('ARCHIVE_CODEC', 'zlib'),
+            archive_interval_hours=float(os.getenv('ARCHIVE_INTERVAL_HOURS', '6') or 6)
+        )
+
+        stream_config = StreamConfig(
+            flush_interval_ms=max(0, int(os.getenv('SSE_FLUSH_INTERVAL_MS', '30') or 0)),
+            max_frame_bytes=max(1, int(os.getenv('SSE_MAX_FRAME_BYTES', '16384') or 16384)),
+            heartbeat_seconds=float(os.getenv('SSE_HEARTBEAT_SECONDS', '15') or 0),
+            answer_deltas=os.getenv('STREAM_ANSWER_DELTAS', 'True').lower() == 'true',
+            queue_size=max(1, int(os.getenv('SSE_QUEUE_SIZE', '256') or 256)),
+            ws_max_channels=max(1, int(os.getenv('WS_MAX_CHANNELS', '8') or 8))
+        )
+
+        session_config = SessionConfig(
+            cache_size=max(1, int(os.getenv('SESSION_CACHE_SIZE', '256') or 256)),
+            idle_hours=float(os.getenv('SESSION_IDLE_HOURS', '24') or 0),
+            max_history_messages=max(1, int(os.getenv('SESSION_MAX_HISTORY', '40') or 40))
+        )
+
+        idempotency_config = IdempotencyConfig(
+            enabled=os.getenv('REQUEST_COALESCING', 'True').lower() == 'true',
+            replay_seconds=float(os.getenv('IDEMPOTENCY_REPLAY_SECONDS', '600') or 0),
+            max_entries=max(1, int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '1000') or 1000))
+        )
+
+        rate_limit_config = RateLimitConfig(
+            enabled=os.getenv('RATE_LIMIT_ENABLED', 'False').lower() == 'true',
+            process_per_minute=float(os.getenv('RATE_LIMIT_PROCESS_PER_MIN', '120') or 0),
+            ocr_per_minute=float(os.getenv('RATE_LIMIT_OCR_PER_MIN', '10') or 0),
+            search_per_minute=float(os.getenv('RATE_LIMIT_SEARCH_PER_MIN', '30') or 0),
+            store=os.getenv('RATE_LIMIT_STORE', 'memory').lower(),
+            trust_proxy=os.getenv('RATE_LIMIT_TRUST_PROXY', 'False').lower() == 'true',
+            queue_concurrency=max(0, int(os.getenv('FAIR_QUEUE_CONCURRENCY', '32') or 0)),
+            queue_timeout_seconds=float(os.getenv('FAIR_QUEUE_TIMEOUT_SECONDS', '60') or 60)
+        )
+
+        ocr_config = OCRConfig(
+            max_upload_bytes=int(float(os.getenv('OCR_MAX_UPLOAD_MB', '20') or 20) * 1024 * 1024),
+            max_dimension=int(os.getenv('OCR_MAX_DIMENSION', '2048') or 2048),
+            max_pixels=int(os.getenv('OCR_MAX_PIXELS', '50000000') or 50_000_000),
+            quality=int(os.getenv('OCR_IMAGE_QUALITY', '90') or 90),
+            preprocess_workers=max(1, int(os.getenv('OCR_PREPROCESS_WORKERS', '2') or 2)),
+            cache_size=max(1, int(os.getenv('OCR_CACHE_SIZE', '512') or 512))
+        )
         
         _config = AppConfig(
             server=server_config,
             proxy=proxy_config,
             searxng=searxng_config,
-            browser=browser_config
+            browser=browser_config,
+            pipeline=pipeline_config,
+            tools=tool_config,
+            executor=executor_config,
+            retry=retry_config,
+            breaker=breaker_config,
+            hedge=hedge_config,
+            usage=usage_config,
+            database=database_config,
+            stream=stream_config,
+            session=session_config,
+            idempotency=idempotency_config,
+            rate_limit=rate_limit_config,
+            ocr=ocr_config
         )
     return _config
@@ -0,0 +1,88 @@
+"""Client control of a running review.
+
+A ``RunControl`` is handed to ``Orchestrator.process_query_stream`` by
+transports that have a channel back from the client (the /api/ws
+WebSocket). It lets the client
+
+* skip a model: its in-flight calls are cancelled and it takes no part
+  in later stages;
+* pause / resume: calls already running finish, but the orchestrator waits
+  at the next stage boundary until the run is resumed.
+
+Cancelling the whole run is done by the transport, by cancelling the task
+that consumes the event stream.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Dict, Set, TypeVar
+
+from core.exceptions import ModelSkipped
+
+__all__ = ["RunControl"]
+
+T = TypeVar("T")
+
+
+class RunControl:
+    """Skip and pause switches for one run, flipped by the client."""
+
+    def __init__(self) -> None:
+        self.skipped: Set[str] = set()
+        self._tasks: Dict[str, Set[asyncio.Future]] = {}
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    def is_skipped(self, model_name: str) -> bool:
+        return model_name in self.skipped
+
+    def skip(self, model_name: str) -> int:
+        """Drop ``model_name`` from the run; returns how many calls were cancelled."""
+        self.skipped.add(model_name)
+        tasks = self._tasks.pop(model_name, set())
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def pause(self) -> None:
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        self._resumed.set()
+
+    async def checkpoint(self) -> None:
+        """Stage boundary: wait here while the run is paused."""
+        await self._resumed.wait()
+
+    async def run(self, awaitable: Awaitable[T], *model_names: str) -> T:
+        """Await a call involving ``model_names`` so that ``skip`` can cancel it.
+
+        A critique involves both the critic and its target; skipping either
+        cancels it. Raises ``ModelSkipped`` if one of the models is (or
+        becomes) skipped. When the caller itself is cancelled the call is
+        cancelled with it.
+        """
+        skipped = next((name for name in model_names if name in self.skipped), None)
+        if skipped is not None:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise ModelSkipped(skipped)
+        task = asyncio.ensure_future(awaitable)
+        for name in model_names:
+            self._tasks.setdefault(name, set()).add(task)
+        try:
+            # asyncio.wait 不会把内部任务的取消传给调用方，借此区分“被跳过”与“调用方被取消”
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            for name in model_names:
+                self._tasks.get(name, set()).discard(task)
+        if task.cancelled():
+            raise ModelSkipped(next((name for name in model_names if name in self.skipped), model_names[0]))
+        return task.result()
@@ -1,18 +1,105 @@
+import asyncio
+import functools
+import hashlib
+import json
+import lzma
 import os
 import sqlite3
-from typing import List, Dict, Any, Optional
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional, TypeVar
 
+from .config import get_config
 from .logging import get_logger
 
 logger = get_logger(__name__)
 
+T = TypeVar('T')
+
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'providers.db')
 
-def get_db_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# 每个线程复用一个连接（按数据库路径区分），避免每次查询都重新打开文件、重新编译语句
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+def _open_connection(path: str) -> sqlite3.Connection:
+    cfg = get_config().database
+    # 连接只在创建它的线程中使用；关闭 check_same_thread 仅为了让 close_db_connections 能在退出时统一关闭
+    conn = sqlite3.connect(
+        path,
+        timeout=cfg.busy_timeout_ms / 1000,
+        cached_statements=cfg.statement_cache_size,
+        check_same_thread=False
+    )
     conn.row_factory = sqlite3.Row
+    # WAL 允许读写并发；NORMAL 在 WAL 下只在检查点时 fsync，掉电最多丢失最近的事务，不会损坏数据库
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(cfg.busy_timeout_ms)}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def get_db_connection() -> sqlite3.Connection:
+    """返回当前线程的数据库连接。
+
+    连接在线程内长期复用，``with get_db_connection() as conn`` 只负责提交或回滚事务，不会关闭连接。
+    """
+    pool = getattr(_local, 'connections', None)
+    if pool is None:
+        pool = _local.connections = {}
+    conn = pool.get(DB_PATH)
+    if conn is None:
+        conn = pool[DB_PATH] = _open_connection(DB_PATH)
     return conn
 
+# 协程中的数据库操作统一交给一个专用线程排队执行：文件 I/O 不占用事件循环，
+# 该线程始终复用同一个连接，写操作也不会在多个连接之间争锁
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_lock = threading.Lock()
+
+def _get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        with _db_executor_lock:
+            if _db_executor is None:
+                _db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+    return _db_executor
+
+async def run_in_db_thread(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """在数据库线程中执行同步的数据访问函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_db_executor(), functools.partial(func, *args, **kwargs))
+
+def close_db_connections():
+    """停止数据库线程并关闭所有线程打开的连接（应用退出时调用）"""
+    global _db_executor
+    with _db_executor_lock:
+        executor, _db_executor = _db_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"关闭数据库连接失败: {e}")
+    # 其他线程的 thread-local 里仍引用着已关闭的连接，换一个新的 local 让它们下次重新打开
+    global _local
+    _local = threading.local()
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, ddl: str):
+    """为已存在的旧表补齐新增列"""
+    columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+
 def initialize_database():
     with get_db_connection() as conn:
         conn.execute('''
@@ -22,9 +109,11 @@ def initialize_database():
                 type TEXT NOT NULL,
                 api_key TEXT NOT NULL,
                 api_base TEXT,
-                models TEXT NOT NULL
+                models TEXT NOT NULL,
+                equivalence_group TEXT -- 同组服务商部署的同名模型视为等价，可用于对冲请求
             )
         ''')
+        _ensure_column(conn, 'providers', 'equivalence_group', 'TEXT')
         conn.execute('''
             CREATE TABLE IF NOT EXISTS prompts (
                 id INTEGER PRIMARY KEY,
@@ -188,8 +277,122 @@ Comment: Strengths: The answer's explanation of core concepts is mostly accurate
             'Revise the answer below based on the specific review feedback, output ONLY the revised answer with clear improvements. Do not add explanations.\n\n Original Answer:\n{original}\n\nReview Feedback:\n{feedback}\n\nRevision Requirements: Directly fix the specific defects pointed out in the review, supplement all missing content, optimize expression and logic, and significantly increase usefulness. The improvement must be clearly evident.',
             1
         ))
+        _initialize_history_tables(conn)
+        _initialize_session_tables(conn)
+        _initialize_rate_limit_tables(conn)
         conn.commit()
 
+def _initialize_history_tables(conn: sqlite3.Connection):
+    """运行历史：runs / answers / critiques，以及问题与答案的全文索引"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question TEXT NOT NULL,
+            ocr_text TEXT,
+            models TEXT NOT NULL, -- JSON list of provider::model
+            best_model TEXT,
+            best_answer TEXT,
+            rounds INTEGER DEFAULT 1,
+            usage TEXT, -- JSON token usage summary
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            model_name TEXT NOT NULL,
+            initial_answer TEXT,
+            revised_answer TEXT,
+            total_score REAL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_answers_run ON answers(run_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS critiques (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            round INTEGER NOT NULL DEFAULT 1,
+            critic_name TEXT,
+            target_model TEXT,
+            score REAL,
+            comment TEXT,
+            raw_text TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_critiques_run ON critiques(run_id)')
+    # 冷数据：归档后的运行把答案与评审压缩成一个 blob，runs 中只保留列表所需的字段
+    _ensure_column(conn, 'runs', 'archived', 'INTEGER DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_runs_hot ON runs(id) WHERE archived = 0')
+    # 所属者：发起运行的客户端或会话，列表、搜索与读取都只返回自己的运行
+    _ensure_column(conn, 'runs', 'owner', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_runs_owner ON runs(owner, id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS runs_archive (
+            run_id INTEGER PRIMARY KEY REFERENCES runs(id),
+            codec TEXT NOT NULL, -- zlib / lzma
+            payload BLOB NOT NULL, -- 压缩后的 JSON: best_answer, answers, critiques
+            raw_size INTEGER NOT NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 无内容（contentless）索引：只存倒排表，rowid 即 runs.id；owner 列存所属者的定长令牌，
+    # 搜索在索引内就限定到调用方自己的运行。trigram 分词支持中文子串匹配（SQLite 3.34+），旧版本退回 unicode61
+    existing = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'runs_fts'").fetchone()
+    rebuild = existing is not None and 'owner' not in existing['sql']
+    if rebuild:
+        conn.execute('DROP TABLE runs_fts')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(question, answers, owner, content='', tokenize='trigram')")
+    except sqlite3.OperationalError:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(question, answers, owner, content='')")
+    if rebuild:
+        _rebuild_runs_fts(conn)
+
+def _rebuild_runs_fts(conn: sqlite3.Connection):
+    """旧版索引没有 owner 列：重建有所属者的运行的索引（没有所属者的运行本来就不会被列出）"""
+    for row in conn.execute('SELECT id, question, owner, archived FROM runs WHERE owner IS NOT NULL').fetchall():
+        if row['archived']:
+            archive = conn.execute('SELECT codec, payload FROM runs_archive WHERE run_id = ?', (row['id'],)).fetchone()
+            details = _decode_archive(archive['codec'], archive['payload'])['answers'] if archive else []
+        else:
+            details = [dict(a) for a in conn.execute('SELECT * FROM answers WHERE run_id = ? ORDER BY id', (row['id'],))]
+        conn.execute(
+            'INSERT INTO runs_fts (rowid, question, answers, owner) VALUES (?, ?, ?, ?)',
+            (row['id'], row['question'], _answers_text(details), _owner_token(row['owner']))
+        )
+    conn.commit()
+
+def _initialize_session_tables(conn: sqlite3.Connection):
+    """服务端会话：客户端每轮只提交新问题，历史消息保存在这里"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS session_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL REFERENCES sessions(id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_session_messages_session ON session_messages(session_id, id)')
+
+def _initialize_rate_limit_tables(conn: sqlite3.Connection):
+    """限流令牌桶（RATE_LIMIT_STORE=sqlite 时使用，同一台机器上的多个进程共享）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
 def get_all_providers() -> List[Dict[str, Any]]:
     with get_db_connection() as conn:
         providers_raw = conn.execute('SELECT * FROM providers ORDER BY name').fetchall()
@@ -207,11 +410,35 @@ def get_provider_by_name(name: str) -> Optional[Dict[str, Any]]:
         provider = conn.execute('SELECT * FROM providers WHERE name = ?', (name,)).fetchone()
         return dict(provider) if provider else None
 
+async def get_provider_by_name_async(name: str) -> Optional[Dict[str, Any]]:
+    return await run_in_db_thread(get_provider_by_name, name)
+
+def get_equivalent_providers(provider_name: str, model_name: str) -> List[Dict[str, Any]]:
+    """同一等价组内、同样提供 model_name 的其他服务商"""
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            '''SELECT p.* FROM providers p
+               JOIN providers origin ON origin.name = ?
+               WHERE origin.equivalence_group IS NOT NULL AND origin.equivalence_group != ''
+                 AND p.equivalence_group = origin.equivalence_group
+                 AND p.name != origin.name
+               ORDER BY p.name''',
+            (provider_name,)
+        ).fetchall()
+    return [
+        dict(row) for row in rows
+        if model_name in [m.strip() for m in (row['models'] or '').split(',')]
+    ]
+
+async def get_equivalent_providers_async(provider_name: str, model_name: str) -> List[Dict[str, Any]]:
+    return await run_in_db_thread(get_equivalent_providers, provider_name, model_name)
+
 def add_provider(provider_data: Dict[str, Any]):
     with get_db_connection() as conn:
-        conn.execute('INSERT INTO providers (name, type, api_key, api_base, models) VALUES (?, ?, ?, ?, ?)',
+        conn.execute('INSERT INTO providers (name, type, api_key, api_base, models, equivalence_group) VALUES (?, ?, ?, ?, ?, ?)',
                      (provider_data['name'], provider_data['type'], provider_data['api_key'], 
-                      provider_data.get('api_base', ''), provider_data['models']))
+                      provider_data.get('api_base', ''), provider_data['models'],
+                      provider_data.get('equivalence_group') or None))
         conn.commit()
 
 def update_provider(original_name: str, provider_data: Dict[str, Any]) -> bool:
@@ -225,18 +452,19 @@ def update_provider(original_name: str, provider_data: Dict[str, Any]) -> bool:
         api_base = provider_data.get('api_base', current['api_base'])
         if api_base is None:
             api_base = ''
+        equivalence_group = provider_data.get('equivalence_group', current['equivalence_group']) or None
         
         if provider_data.get('api_key'):
             result = conn.execute(
-                'UPDATE providers SET type = ?, api_key = ?, api_base = ?, models = ? WHERE name = ?',
+                'UPDATE providers SET type = ?, api_key = ?, api_base = ?, models = ?, equivalence_group = ? WHERE name = ?',
                 (provider_data['type'], provider_data['api_key'], 
-                 api_base, provider_data['models'], original_name)
+                 api_base, provider_data['models'], equivalence_group, original_name)
             ).rowcount > 0
         else:
             result = conn.execute(
-                'UPDATE providers SET type = ?, api_base = ?, models = ? WHERE name = ?',
+                'UPDATE providers SET type = ?, api_base = ?, models = ?, equivalence_group = ? WHERE name = ?',
                 (provider_data['type'], api_base, 
-                 provider_data['models'], original_name)
+                 provider_data['models'], equivalence_group, original_name)
             ).rowcount > 0
         conn.commit()
         return result
@@ -258,6 +486,9 @@ def get_active_prompt() -> Optional[Dict[str, Any]]:
         prompt = conn.execute('SELECT * FROM prompts WHERE is_active = 1 LIMIT 1').fetchone()
         return dict(prompt) if prompt else None
 
+async def get_active_prompt_async() -> Optional[Dict[str, Any]]:
+    return await run_in_db_thread(get_active_prompt)
+
 def add_prompt(prompt_data: Dict[str, Any]):
     with get_db_connection() as conn:
         conn.execute(
@@ -297,3 +528,353 @@ def delete_prompt(prompt_id: int) -> bool:
         return result
 
 
+
+# 运行历史
+HISTORY_PREVIEW_LENGTH = 200
+
+_RUN_SUMMARY_COLUMNS = (
+    f'id, question, models, best_model, substr(best_answer, 1, {HISTORY_PREVIEW_LENGTH}) AS preview, rounds, created_at'
+)
+
+def save_run(run: Dict[str, Any]) -> int:
+    """保存一次完整的评审运行，返回 run id"""
+    details = run.get('process_details', [])
+    with get_db_connection() as conn:
+        run_id = conn.execute(
+            'INSERT INTO runs (owner, question, ocr_text, models, best_model, best_answer, rounds, usage) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                run.get('owner'), run['question'], run.get('ocr_text') or None, json.dumps(run.get('models', []), ensure_ascii=False),
+                details[0]['model_name'] if details else None, run.get('best_answer', ''),
+                run.get('rounds', 1), json.dumps(run['usage'], ensure_ascii=False) if run.get('usage') else None
+            )
+        ).lastrowid
+        conn.executemany(
+            'INSERT INTO answers (run_id, model_name, initial_answer, revised_answer, total_score) VALUES (?, ?, ?, ?, ?)',
+            [
+                (run_id, d['model_name'], d.get('initial_answer', ''), d.get('revised_answer', ''), d.get('total_score', 0))
+                for d in details
+            ]
+        )
+        conn.executemany(
+            'INSERT INTO critiques (run_id, round, critic_name, target_model, score, comment, raw_text) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (run_id, c.get('round', 1), c.get('critic_name'), c.get('target_model'),
+                 c.get('score', 0), c.get('comment', ''), c.get('raw_text', ''))
+                for c in run.get('critiques', [])
+            ]
+        )
+        conn.execute(
+            'INSERT INTO runs_fts (rowid, question, answers, owner) VALUES (?, ?, ?, ?)',
+            (run_id, run['question'], _answers_text(details), _owner_token(run.get('owner')))
+        )
+        conn.commit()
+    return run_id
+
+def _answers_text(details: List[Dict[str, Any]]) -> str:
+    """全文索引的 answers 列：各模型的初始与修订答案，去重后拼接"""
+    return "\n\n".join(dict.fromkeys(
+        text for d in details for text in (d.get('initial_answer') or '', d.get('revised_answer') or '') if text
+    ))
+
+def _owner_token(owner: Optional[str]) -> str:
+    """索引 owner 列的内容：定长十六进制摘要，短语匹配即等值匹配，不会命中其他所属者的子串"""
+    return hashlib.sha256((owner or '').encode('utf-8')).hexdigest()[:32] if owner else ''
+
+def _page(rows: List[sqlite3.Row], limit: int) -> Dict[str, Any]:
+    """多取一行判断是否还有下一页；游标为本页最后一条的 id"""
+    items = []
+    for row in rows[:limit]:
+        item = dict(row)
+        item['models'] = json.loads(item['models'] or '[]')
+        items.append(item)
+    next_cursor = items[-1]['id'] if len(rows) > limit else None
+    return {'items': items, 'next_cursor': next_cursor}
+
+def list_runs(owner: str, limit: int = 20, before: Optional[int] = None) -> Dict[str, Any]:
+    """owner 的运行，按时间倒序分页（键集分页：before 为上一页最后一条的 id）"""
+    with get_db_connection() as conn:
+        if before is None:
+            rows = conn.execute(
+                f'SELECT {_RUN_SUMMARY_COLUMNS} FROM runs WHERE owner = ? ORDER BY id DESC LIMIT ?', (owner, limit + 1)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT {_RUN_SUMMARY_COLUMNS} FROM runs WHERE owner = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (owner, before, limit + 1)
+            ).fetchall()
+    return _page(rows, limit)
+
+def _fts_query(owner: str, terms: List[str]) -> str:
+    """owner 列等于该所属者的令牌，且问题或答案包含每个词（各自作为短语，转义双引号）"""
+    phrases = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+    return f'owner : "{_owner_token(owner)}" AND {{question answers}} : ({phrases})'
+
+def _like_pattern(term: str) -> str:
+    """子串匹配的 LIKE 模式，转义 % 与 _（配合 ESCAPE '\\'）"""
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# 与全文索引相同的列：问题与各模型的答案。归档后的运行只剩答案预览可供子串匹配
+_LIKE_TERM_SQL = '''(
+    question LIKE :term ESCAPE '\\' OR best_answer LIKE :term ESCAPE '\\'
+    OR EXISTS (
+        SELECT 1 FROM answers WHERE answers.run_id = runs.id
+        AND (initial_answer LIKE :term ESCAPE '\\' OR revised_answer LIKE :term ESCAPE '\\')
+    )
+)'''
+
+def search_runs(owner: str, query: str, limit: int = 20, before: Optional[int] = None) -> Dict[str, Any]:
+    """在 owner 的运行中全文搜索问题与答案，结果同样按时间倒序键集分页"""
+    terms = query.split()
+    if not terms:
+        return {'items': [], 'next_cursor': None}
+    with get_db_connection() as conn:
+        if all(len(term) >= 3 for term in terms):
+            # 所属者与游标都在 FTS 子查询内生效：按 rowid 倒序取够一页即停，不会先收集所有匹配
+            cursor_sql, cursor_params = ('', []) if before is None else ('AND rowid < ?', [before])
+            rows = conn.execute(
+                f'''SELECT {_RUN_SUMMARY_COLUMNS} FROM runs WHERE id IN (
+                        SELECT rowid FROM runs_fts WHERE runs_fts MATCH ? {cursor_sql}
+                        ORDER BY rowid DESC LIMIT ?
+                    ) ORDER BY id DESC''',
+                (_fts_query(owner, terms), *cursor_params, limit + 1)
+            ).fetchall()
+        else:
+            # trigram 无法匹配少于 3 个字符的词，退回到同样这些列的子串匹配；
+            # 沿 (owner, id) 索引倒序扫描，逐条检查是否匹配，够一页即停
+            params: Dict[str, Any] = {'owner': owner, 'limit': limit + 1}
+            cursor_sql = ''
+            if before is not None:
+                cursor_sql = 'AND id < :before'
+                params['before'] = before
+            clauses = []
+            for index, term in enumerate(terms):
+                params[f'term{index}'] = _like_pattern(term)
+                clauses.append(_LIKE_TERM_SQL.replace(':term', f':term{index}'))
+            rows = conn.execute(
+                f'''SELECT {_RUN_SUMMARY_COLUMNS} FROM runs
+                    WHERE owner = :owner {cursor_sql} AND {' AND '.join(clauses)}
+                    ORDER BY id DESC LIMIT :limit''',
+                params
+            ).fetchall()
+    return _page(rows, limit)
+
+def get_run(run_id: int, owner: str) -> Optional[Dict[str, Any]]:
+    """一次运行的完整记录：各模型答案与所有轮次的评审；不属于 owner 时视为不存在"""
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT * FROM runs WHERE id = ? AND owner = ?', (run_id, owner)).fetchone()
+        if not row:
+            return None
+        run = dict(row)
+        run['models'] = json.loads(run['models'] or '[]')
+        run['usage'] = json.loads(run['usage']) if run['usage'] else None
+        run['answers'] = [
+            dict(a) for a in conn.execute(
+                'SELECT * FROM answers WHERE run_id = ? ORDER BY total_score DESC, id', (run_id,)
+            ).fetchall()
+        ]
+        run['critiques'] = [
+            dict(c) for c in conn.execute(
+                'SELECT * FROM critiques WHERE run_id = ? ORDER BY round, id', (run_id,)
+            ).fetchall()
+        ]
+        if run.get('archived'):
+            archive = conn.execute('SELECT codec, payload FROM runs_archive WHERE run_id = ?', (run_id,)).fetchone()
+            if archive:
+                run.update(_decode_archive(archive['codec'], archive['payload']))
+    return run
+
+# 归档：较旧的运行压缩后移入 runs_archive，读取时透明解压
+ARCHIVE_CODECS: Dict[str, Any] = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+def _decode_archive(codec: str, payload: bytes) -> Dict[str, Any]:
+    return json.loads(ARCHIVE_CODECS[codec][1](payload).decode('utf-8'))
+
+def archive_old_runs(older_than_days: float, codec: str = 'zlib', batch_size: int = 200) -> Dict[str, Any]:
+    """把早于 older_than_days 天的运行压缩归档一批（至多 batch_size 条，一个事务）。
+
+    返回本批的归档数量、压缩前后字节数，以及是否还有待归档的运行（more），
+    由调用方逐批调用，避免一次占住数据库线程太久。全文索引不受影响，归档后的运行仍可被搜索。
+    """
+    if codec not in ARCHIVE_CODECS:
+        raise ValueError(f"不支持的压缩格式: {codec}")
+    compress = ARCHIVE_CODECS[codec][0]
+    stats = {'runs': 0, 'raw_bytes': 0, 'compressed_bytes': 0, 'codec': codec, 'more': False}
+    with get_db_connection() as conn:
+        # 多取一行判断是否还有下一批
+        rows = conn.execute(
+            '''SELECT id, best_answer FROM runs
+               WHERE archived = 0 AND created_at < datetime('now', ?)
+               ORDER BY id LIMIT ?''',
+            (f'{-float(older_than_days)} days', batch_size + 1)
+        ).fetchall()
+        stats['more'] = len(rows) > batch_size
+        for row in rows[:batch_size]:
+            run_id = row['id']
+            payload = json.dumps({
+                'best_answer': row['best_answer'],
+                'answers': [dict(a) for a in conn.execute('SELECT * FROM answers WHERE run_id = ? ORDER BY id', (run_id,))],
+                'critiques': [dict(c) for c in conn.execute('SELECT * FROM critiques WHERE run_id = ? ORDER BY round, id', (run_id,))],
+            }, ensure_ascii=False).encode('utf-8')
+            blob = compress(payload)
+            conn.execute(
+                'INSERT OR REPLACE INTO runs_archive (run_id, codec, payload, raw_size) VALUES (?, ?, ?, ?)',
+                (run_id, codec, blob, len(payload))
+            )
+            conn.execute('DELETE FROM answers WHERE run_id = ?', (run_id,))
+            conn.execute('DELETE FROM critiques WHERE run_id = ?', (run_id,))
+            # 列表只需要预览，完整的最佳答案在归档里
+            conn.execute(
+                'UPDATE runs SET best_answer = substr(best_answer, 1, ?), archived = 1 WHERE id = ?',
+                (HISTORY_PREVIEW_LENGTH, run_id)
+            )
+            stats['runs'] += 1
+            stats['raw_bytes'] += len(payload)
+            stats['compressed_bytes'] += len(blob)
+        conn.commit()
+    return stats
+
+def database_size() -> Dict[str, int]:
+    """数据库文件大小与实际占用（不含空闲页）的字节数"""
+    with get_db_connection() as conn:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return {'file_bytes': page_size * page_count, 'used_bytes': page_size * (page_count - free_pages)}
+
+async def run_archive_job():
+    """后台任务：按 ARCHIVE_INTERVAL_HOURS 周期归档 ARCHIVE_AFTER_DAYS 天前的运行"""
+    cfg = get_config().database
+    while True:
+        totals = {'runs': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+        started = time.monotonic()
+        try:
+            # 每批单独提交给数据库线程，批与批之间让出事件循环，其他读写可以插队
+            while True:
+                stats = await run_in_db_thread(archive_old_runs, cfg.archive_after_days, cfg.archive_codec)
+                for key in totals:
+                    totals[key] += stats[key]
+                if not stats['more']:
+                    break
+                await asyncio.sleep(0)
+        except Exception as e:
+            logger.error(f"归档运行记录失败: {e}")
+        if totals['runs']:
+            logger.info(
+                f"已归档 {totals['runs']} 条运行记录 ({cfg.archive_codec}): "
+                f"{totals['raw_bytes']} -> {totals['compressed_bytes']} 字节，用时 {time.monotonic() - started:.3f} 秒"
+            )
+        await asyncio.sleep(cfg.archive_interval_hours * 3600)
+
+async def save_run_async(run: Dict[str, Any]) -> int:
+    return await run_in_db_thread(save_run, run)
+
+async def list_runs_async(owner: str, limit: int = 20, before: Optional[int] = None) -> Dict[str, Any]:
+    return await run_in_db_thread(list_runs, owner, limit, before)
+
+async def search_runs_async(owner: str, query: str, limit: int = 20, before: Optional[int] = None) -> Dict[str, Any]:
+    return await run_in_db_thread(search_runs, owner, query, limit, before)
+
+async def get_run_async(run_id: int, owner: str) -> Optional[Dict[str, Any]]:
+    return await run_in_db_thread(get_run, run_id, owner)
+
+# 会话
+def create_session(session_id: str, messages: Optional[List[Dict[str, str]]] = None):
+    with get_db_connection() as conn:
+        conn.execute('INSERT INTO sessions (id) VALUES (?)', (session_id,))
+        if messages:
+            conn.executemany(
+                'INSERT INTO session_messages (session_id, role, content) VALUES (?, ?, ?)',
+                [(session_id, m['role'], m['content']) for m in messages]
+            )
+        conn.commit()
+
+def get_session_messages(session_id: str) -> Optional[List[Dict[str, str]]]:
+    """会话的全部消息（按时间顺序）；会话不存在时返回 None"""
+    with get_db_connection() as conn:
+        if not conn.execute('SELECT 1 FROM sessions WHERE id = ?', (session_id,)).fetchone():
+            return None
+        rows = conn.execute(
+            'SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY id', (session_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def append_session_messages(session_id: str, messages: List[Dict[str, str]]) -> bool:
+    with get_db_connection() as conn:
+        cursor = conn.execute('UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
+        if cursor.rowcount == 0:
+            return False
+        conn.executemany(
+            'INSERT INTO session_messages (session_id, role, content) VALUES (?, ?, ?)',
+            [(session_id, m['role'], m['content']) for m in messages]
+        )
+        conn.commit()
+    return True
+
+def delete_sessions(session_ids: List[str]) -> int:
+    if not session_ids:
+        return 0
+    placeholders = ','.join('?' * len(session_ids))
+    with get_db_connection() as conn:
+        conn.execute(f'DELETE FROM session_messages WHERE session_id IN ({placeholders})', session_ids)
+        deleted = conn.execute(f'DELETE FROM sessions WHERE id IN ({placeholders})', session_ids).rowcount
+        conn.commit()
+    return deleted
+
+def stale_session_ids(idle_hours: float, limit: int = 500) -> List[str]:
+    """超过 idle_hours 小时未使用的会话"""
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT id FROM sessions WHERE updated_at < datetime('now', ?) ORDER BY updated_at LIMIT ?",
+            (f'{-float(idle_hours)} hours', limit)
+        ).fetchall()
+    return [row['id'] for row in rows]
+
+def take_rate_limit_tokens(key: str, cost: float, capacity: float, rate: float) -> float:
+    """从令牌桶 key 中扣除 cost 个令牌；返回 0 表示放行，否则为还需等待的秒数。
+
+    读取与写回在同一个 IMMEDIATE 事务中完成，多个进程并发扣减也不会超发。
+    """
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?', (key,)).fetchone()
+        tokens = capacity if row is None else min(capacity, row['tokens'] + max(0.0, now - row['updated_at']) * rate)
+        wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+        if not wait:
+            tokens -= cost
+        conn.execute(
+            'INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+            (key, tokens, now)
+        )
+    return wait
+
+def prune_rate_limit_buckets(idle_seconds: float) -> int:
+    """删除 idle_seconds 内没有使用的令牌桶（此时桶已回满，与不存在等价）"""
+    with get_db_connection() as conn:
+        return conn.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?', (time.time() - idle_seconds,)).rowcount
+
+async def create_session_async(session_id: str, messages: Optional[List[Dict[str, str]]] = None):
+    return await run_in_db_thread(create_session, session_id, messages)
+
+async def get_session_messages_async(session_id: str) -> Optional[List[Dict[str, str]]]:
+    return await run_in_db_thread(get_session_messages, session_id)
+
+async def append_session_messages_async(session_id: str, messages: List[Dict[str, str]]) -> bool:
+    return await run_in_db_thread(append_session_messages, session_id, messages)
+
+async def delete_sessions_async(session_ids: List[str]) -> int:
+    return await run_in_db_thread(delete_sessions, session_ids)
+
+async def stale_session_ids_async(idle_hours: float, limit: int = 500) -> List[str]:
+    return await run_in_db_thread(stale_session_ids, idle_hours, limit)
+
+async def take_rate_limit_tokens_async(key: str, cost: float, capacity: float, rate: float) -> float:
+    return await run_in_db_thread(take_rate_limit_tokens, key, cost, capacity, rate)
+
+async def prune_rate_limit_buckets_async(idle_seconds: float) -> int:
+    return await run_in_db_thread(prune_rate_limit_buckets, idle_seconds)
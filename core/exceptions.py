@@ -30,6 +30,25 @@ class ModelConfigError(ModelError):
     """Invalid model configuration"""
     pass
 
+class CircuitOpenError(ModelError):
+    """Model skipped because its circuit breaker is open"""
+    def __init__(self, model_name: str, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(f"Model {model_name} circuit open, retry in {retry_in:.0f}s")
+
+class TokenBudgetExceeded(ModelError):
+    """Run stopped launching model calls after spending its token budget"""
+    def __init__(self, budget: int, used: int):
+        self.budget = budget
+        self.used = used
+        super().__init__(f"Token budget exhausted ({used}/{budget} tokens)")
+
+class ModelSkipped(ModelError):
+    """Client asked to drop a model from a running review"""
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        super().__init__(f"Model {model_name} skipped by client")
+
 # Database errors
 class DatabaseError(AppError):
     """Database-related errors"""
@@ -0,0 +1,101 @@
+"""Dedicated thread pool for blocking provider SDK calls.
+
+Blocking SDK work (e.g. the synchronous Gemini client used by /api/ocr) must
+not share the default executor that FastAPI uses for sync routes, otherwise a
+burst of slow upstream calls starves the admin endpoints. Calls are capped
+per provider and the pool reports its queue depth.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from core.config import get_config
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+class ProviderExecutor:
+    """Bounded thread pool with a per-provider concurrency cap."""
+
+    def __init__(self, max_workers: int, per_provider_limit: int) -> None:
+        self.max_workers = max(1, max_workers)
+        self.per_provider_limit = max(1, per_provider_limit)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="provider-sdk")
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self._waiting: Dict[str, int] = {}
+        self._running: Dict[str, int] = {}
+        self.completed = 0
+        self.total_wait = 0.0
+
+    def _limit_for(self, provider: str) -> asyncio.Semaphore:
+        limit = self._limits.get(provider)
+        if limit is None:
+            limit = asyncio.Semaphore(self.per_provider_limit)
+            self._limits[provider] = limit
+        return limit
+
+    async def run(self, provider: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run ``func`` in the pool once ``provider`` is under its cap."""
+        limit = self._limit_for(provider)
+        queued_at = time.monotonic()
+        self._waiting[provider] = self._waiting.get(provider, 0) + 1
+        try:
+            await limit.acquire()
+        finally:
+            self._waiting[provider] -= 1
+        self.total_wait += time.monotonic() - queued_at
+        self._running[provider] = self._running.get(provider, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+        finally:
+            self._running[provider] -= 1
+            self.completed += 1
+            limit.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "per_provider_limit": self.per_provider_limit,
+            "queue_depth": self._pool._work_queue.qsize(),
+            "waiting": {name: count for name, count in self._waiting.items() if count},
+            "running": {name: count for name, count in self._running.items() if count},
+            "completed": self.completed,
+            "avg_wait": round(self.total_wait / self.completed, 4) if self.completed else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_provider_executor: Optional[ProviderExecutor] = None
+
+
+def get_provider_executor() -> ProviderExecutor:
+    """Return the process-wide provider executor."""
+    global _provider_executor
+    if _provider_executor is None:
+        cfg = get_config().executor
+        _provider_executor = ProviderExecutor(cfg.max_workers, cfg.per_provider_limit)
+        logger.info(
+            f"Provider executor started: {cfg.max_workers} workers, "
+            f"{cfg.per_provider_limit} per provider"
+        )
+    return _provider_executor
+
+
+def shutdown_provider_executor() -> None:
+    global _provider_executor
+    if _provider_executor is not None:
+        _provider_executor.shutdown()
+        _provider_executor = None
+
+
+__all__ = ["ProviderExecutor", "get_provider_executor", "shutdown_provider_executor"]
@@ -0,0 +1,220 @@
+"""Image preprocessing and OCR result cache for /api/ocr.
+
+Uploads used to be base64-encoded as-is and sent to the vision model on
+every request, multi-megabyte phone photos included. Now:
+
+* the upload is read in chunks and rejected as soon as it exceeds
+  ``max_upload_bytes``, hashing it on the way;
+* Pillow decodes it in a small dedicated thread pool (off the event loop),
+  applies the EXIF orientation, flattens transparency onto white, downscales
+  so the long edge is at most ``max_dimension`` and re-encodes it as WebP
+  (JPEG if Pillow lacks WebP). The original is kept when it is already small
+  enough and the re-encoded copy would not be smaller. Images over
+  ``max_pixels`` are refused before decoding;
+* OCR text is cached in an in-memory LRU keyed by OCR model and the SHA-256
+  of the upload, and of the preprocessed image, so the same screenshot
+  (even re-saved with different metadata) is recognised only once.
+
+Pillow is listed in requirements.txt; without it uploads are passed through
+unchanged (the size limit and cache still apply).
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from core.config import get_config
+from core.logging import get_logger
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+__all__ = [
+    "ImagePreprocessor", "ImageTooLarge", "InvalidImage", "OCRCache", "PreparedImage",
+    "get_image_preprocessor", "get_ocr_cache", "read_limited", "shutdown_image_preprocessor",
+]
+
+logger = get_logger(__name__)
+
+_READ_CHUNK = 64 * 1024
+# 视觉模型都接受的格式；这些格式的小图可以原样发送
+_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class ImageTooLarge(Exception):
+    """The upload exceeds the byte or pixel limit."""
+
+
+class InvalidImage(Exception):
+    """The upload is not an image Pillow can decode."""
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    digest: str
+    width: int = 0
+    height: int = 0
+
+
+async def read_limited(file: Any, limit: int) -> Tuple[bytes, str]:
+    """Read an upload in chunks, refusing it once it exceeds ``limit`` bytes; returns (bytes, sha256)."""
+    size = getattr(file, "size", None)
+    if size is not None and size > limit:
+        raise ImageTooLarge(f"{size} bytes")
+    digest = hashlib.sha256()
+    chunks = []
+    total = 0
+    while True:
+        chunk = await file.read(_READ_CHUNK)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise ImageTooLarge(f"more than {limit} bytes")
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), digest.hexdigest()
+
+
+def _flatten(image: "Image.Image") -> "Image.Image":
+    if image.mode in ("RGB", "L"):
+        return image
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        # 透明背景直接转 RGB 会变黑，截图里的黑字就看不见了
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def preprocess_image(data: bytes, max_dimension: int, max_pixels: int, quality: int) -> PreparedImage:
+    """Downscale and re-encode one image (blocking; run it in the preprocessor's pool)."""
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            source_format = source.format
+            width, height = source.size
+            if width * height > max_pixels:
+                raise ImageTooLarge(f"{width}x{height} pixels")
+            # JPEG 可以直接按缩小的比例解码，省去大部分解码与缩放开销
+            source.draft("RGB", (max_dimension, max_dimension))
+            image = _flatten(ImageOps.exif_transpose(source))
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            image_format = "WEBP" if features.check("webp") else "JPEG"
+            output = io.BytesIO()
+            image.save(output, format=image_format, quality=quality)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+    except (OSError, SyntaxError, ValueError) as e:
+        raise InvalidImage(str(e)) from e
+
+    encoded = output.getvalue()
+    if source_format in _PASSTHROUGH_FORMATS and image.size == (width, height) and len(data) <= len(encoded):
+        return PreparedImage(data, _PASSTHROUGH_FORMATS[source_format], hashlib.sha256(data).hexdigest(), width, height)
+    return PreparedImage(
+        encoded, f"image/{image_format.lower()}", hashlib.sha256(encoded).hexdigest(), image.width, image.height
+    )
+
+
+class ImagePreprocessor:
+    """Runs ``preprocess_image`` in a dedicated thread pool."""
+
+    def __init__(self, workers: int, max_dimension: int, max_pixels: int, quality: int) -> None:
+        self.max_dimension = max(64, max_dimension)
+        self.max_pixels = max_pixels
+        self.quality = min(100, max(1, quality))
+        # Pillow 在解码、缩放与编码时释放 GIL，线程池即可并行
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image")
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def prepare(self, data: bytes, mime_type: str, digest: str) -> PreparedImage:
+        if Image is None:
+            return PreparedImage(data, mime_type, digest)
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(
+            self._pool,
+            functools.partial(preprocess_image, data, self.max_dimension, self.max_pixels, self.quality)
+        )
+        self.processed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(prepared.data)
+        return prepared
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pillow": Image is not None,
+            "processed": self.processed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class OCRCache:
+    """LRU of OCR text by (image digest, OCR model)."""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = max(1, capacity)
+        self._entries: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: str, ocr_model: str) -> Optional[str]:
+        text = self._entries.get((digest, ocr_model))
+        if text is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((digest, ocr_model))
+        return text
+
+    def put(self, digest: str, ocr_model: str, text: str) -> None:
+        self._entries[(digest, ocr_model)] = text
+        self._entries.move_to_end((digest, ocr_model))
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"cached": len(self._entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+_preprocessor: Optional[ImagePreprocessor] = None
+_cache: Optional[OCRCache] = None
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    global _preprocessor
+    if _preprocessor is None:
+        cfg = get_config().ocr
+        _preprocessor = ImagePreprocessor(cfg.preprocess_workers, cfg.max_dimension, cfg.max_pixels, cfg.quality)
+        if Image is None:
+            logger.warning("未安装 Pillow，OCR 图片将不经预处理直接发送")
+    return _preprocessor
+
+
+def get_ocr_cache() -> OCRCache:
+    global _cache
+    if _cache is None:
+        _cache = OCRCache(get_config().ocr.cache_size)
+    return _cache
+
+
+def shutdown_image_preprocessor() -> None:
+    global _preprocessor
+    if _preprocessor is not None:
+        _preprocessor.shutdown()
+        _preprocessor = None
@@ -3,31 +3,67 @@
 AI模型抽象层
 """
 import abc
-import asyncio
 import json
-from typing import Any, AsyncGenerator, Dict, List, Optional, cast
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Set, cast
 
 import google.generativeai as genai
 import openai
 from openai import NOT_GIVEN
 from openai.types.chat import ChatCompletionMessageParam
 
-
-def _parse_max_pages(value: Any) -> Optional[int]:
-    """Normalize the optional max_pages argument passed to tools."""
-    if isinstance(value, int):
-        return value
-    if isinstance(value, str) and value.isdigit():
-        return int(value)
-    return None
+from core.config import get_config
+from core.logging import get_logger
+from core.resilience import call_with_retry, get_circuit_breaker, get_latency_tracker, guarded_call, hedged_call
+from core.tools import ToolExecutor, ToolLoopBudget
+from core.usage import UsageTracker, gemini_usage, openai_usage
+
+logger = get_logger(__name__)
+
+# 非原生流式模型透传结果时每次产出的字符数
+STREAM_CHUNK_SIZE = 256
+
+# 拒绝 stream_options 参数（返回 400）的 OpenAI 兼容服务商，之后的流式请求不再携带它
+_stream_options_unsupported: Set[str] = set()
+
+
+def _assistant_tool_message(content: Optional[str], tool_calls: List[Dict[str, Any]]) -> ChatCompletionMessageParam:
+    """把 [{"id", "name", "arguments"}] 还原成 assistant 的 tool_calls 消息"""
+    return cast(ChatCompletionMessageParam, {
+        "role": "assistant",
+        "content": content,
+        "tool_calls": [
+            {
+                "id": tc["id"],
+                "type": "function",
+                "function": {"name": tc["name"], "arguments": tc["arguments"]},
+            }
+            for tc in tool_calls
+        ],
+    })
+
+def _create_openai_client(provider_config: Dict[str, Any]) -> openai.AsyncOpenAI:
+    # 重试由 call_with_retry 统一负责，关闭 SDK 自带的重试以免叠加
+    return openai.AsyncOpenAI(
+        api_key=provider_config['api_key'],
+        base_url=provider_config.get('api_base'),
+        max_retries=0
+    )
+
+def _latency_key(endpoint: str, stream: bool) -> str:
+    """流式请求只计到首个分片，与完整请求的延迟分开统计"""
+    return f"{endpoint}|{'stream' if stream else 'full'}"
 
 class BaseModel(abc.ABC):
     """基础模型抽象类"""
 
-    def __init__(self, provider_config: Dict[str, Any], model_name: str):
+    def __init__(self, provider_config: Dict[str, Any], model_name: str, tool_executor: Optional[ToolExecutor] = None, on_event: Optional[Callable[[Dict[str, Any]], None]] = None, usage: Optional[UsageTracker] = None):
         self.name = f"{provider_config['name']}::{model_name}"
+        self.provider_name = provider_config['name']
         self.provider_type = provider_config['type']
         self.model_name = model_name
+        self.tool_executor = tool_executor
+        self.on_event = on_event
+        self.usage = usage
 
     @abc.abstractmethod
     async def generate(self, messages: List[Any], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> str:
@@ -35,370 +71,349 @@ class BaseModel(abc.ABC):
         pass
 
     async def generate_stream(self, messages: List[Any], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> AsyncGenerator[str, None]:
-        """流式生成回复"""
-        result = await self.generate(messages)
-        for char in result:
-            yield char
-            await asyncio.sleep(0.01)
+        """流式生成回复：不支持原生流式的实现按块直接透传完整结果"""
+        result = await self.generate(messages, tools=tools, tool_choice=tool_choice)
+        for start in range(0, len(result), STREAM_CHUNK_SIZE):
+            yield result[start:start + STREAM_CHUNK_SIZE]
+
+    async def _run_tools(self, tool_calls: List[Dict[str, Any]], step: int = 1) -> List[Dict[str, Any]]:
+        """并发执行一轮工具调用，返回顺序与 tool_calls 一致的 tool 消息"""
+        executor = self.tool_executor or ToolExecutor()
+        return await executor.execute(tool_calls, model_name=self.name, step=step)
+
+    def _record_usage(self, counts: Optional[Dict[str, int]]) -> None:
+        """把一次调用的 token 用量计入本轮运行（阶段取自 current_stage）"""
+        if self.usage is not None and counts is not None:
+            self.usage.record(self.name, counts["prompt"], counts["completion"], counts["cached"])
+
+    async def _call_provider(self, make_call: Callable[[], Any], stream: bool = False) -> Any:
+        """调用本模型所在的服务商部署；本轮 token 预算用尽后不再发起新调用"""
+        if self.usage is not None:
+            self.usage.check_budget()
+        return await self._call_endpoint(self.provider_name, self.name, make_call, stream)
+
+    async def _call_endpoint(self, provider_name: str, endpoint: str, make_call: Callable[[], Any], stream: bool = False) -> Any:
+        """经过熔断器与共享退避状态调用某个部署，429/5xx 自动重试，并记录延迟"""
+        breaker = get_circuit_breaker(endpoint)
+        latency = get_latency_tracker(_latency_key(endpoint, stream))
+        return await call_with_retry(
+            provider_name,
+            lambda: guarded_call(breaker, make_call, latency),
+            model_name=self.name,
+            on_event=self.on_event
+        )
 
 class OpenAIModel(BaseModel):
     """OpenAI模型实现"""
 
-    def __init__(self, provider_config: Dict[str, Any], model_name: str):
-        super().__init__(provider_config, model_name)
-        self.client = openai.AsyncOpenAI(
-            api_key=provider_config['api_key'],
-            base_url=provider_config.get('api_base')
+    def __init__(self, provider_config: Dict[str, Any], model_name: str, tool_executor: Optional[ToolExecutor] = None, on_event: Optional[Callable[[Dict[str, Any]], None]] = None, alternates: Optional[List[Dict[str, Any]]] = None, usage: Optional[UsageTracker] = None):
+        super().__init__(provider_config, model_name, tool_executor, on_event, usage)
+        self.client = _create_openai_client(provider_config)
+        # 等价部署：同一等价组内提供同名模型的其他 OpenAI 兼容服务商，用于对冲请求
+        self.alternates = [
+            (alt['name'], f"{alt['name']}::{model_name}", _create_openai_client(alt))
+            for alt in alternates or []
+            if alt.get('type') == 'OpenAI'
+        ]
+
+    async def _create(self, **kwargs: Any) -> Any:
+        """发送补全请求；主部署超过其 p95 延迟仍未响应时，向最快的等价部署发起对冲请求"""
+        stream = bool(kwargs.get("stream"))
+        client = cast(Any, self.client)
+        primary = lambda: self._call_provider(lambda: client.chat.completions.create(**kwargs), stream)  # noqa: E731
+
+        hedge_cfg = get_config().hedge
+        p95 = get_latency_tracker(_latency_key(self.name, stream)).p95()
+        backup = self._pick_alternate(stream)
+        if not hedge_cfg.enabled or p95 is None or backup is None:
+            return await primary()
+
+        provider_name, endpoint, backup_client = backup
+        hedge_after = max(hedge_cfg.min_delay, p95)
+
+        def on_hedge() -> None:
+            logger.info(f"{self.name} 超过 p95 ({hedge_after:.1f}s) 未响应，向 {endpoint} 发起对冲请求")
+            if self.on_event is not None:
+                self.on_event({
+                    "type": "status",
+                    "data": f"{self.name} 响应偏慢，已同时请求等价部署 {endpoint}...",
+                    "model_name": self.name,
+                    "hedge": {"backup": endpoint, "after": round(hedge_after, 2)},
+                })
+
+        return await hedged_call(
+            primary,
+            lambda: self._call_endpoint(provider_name, endpoint, lambda: backup_client.chat.completions.create(**kwargs), stream),
+            hedge_after,
+            on_hedge,
         )
 
+    async def _create_stream(self, kwargs: Dict[str, Any]) -> Any:
+        """发起流式请求；带 stream_options 被拒（400）时去掉它重试一次，成功则记住该服务商不支持"""
+        if "stream_options" not in kwargs:
+            return await self._create(**kwargs, stream=True)
+        try:
+            return await self._create(**kwargs, stream=True)
+        except openai.BadRequestError as e:
+            retry_kwargs = {key: value for key, value in kwargs.items() if key != "stream_options"}
+            try:
+                stream = await self._create(**retry_kwargs, stream=True)
+            except Exception:
+                # 去掉后仍然失败：400 与 stream_options 无关，按原错误处理
+                raise e
+            _stream_options_unsupported.add(self.provider_name)
+            logger.warning(f"{self.provider_name} 不接受 stream_options，之后的流式请求不再统计 usage: {e}")
+            return stream
+
+    def _pick_alternate(self, stream: bool) -> Optional[Any]:
+        """熔断器未打开的等价部署中，平均延迟最低的一个（无样本的排在最后）"""
+        candidates = [alt for alt in self.alternates if not get_circuit_breaker(alt[1]).is_open()]
+        if not candidates:
+            return None
+
+        def mean_latency(alt: Any) -> float:
+            tracker = get_latency_tracker(_latency_key(alt[1], stream))
+            return tracker.mean if tracker.samples else float("inf")
+
+        return min(candidates, key=mean_latency)
+
+    def _completion_kwargs(self, messages: List[ChatCompletionMessageParam], tools: Optional[List[Any]], tool_choice: Optional[str], tools_allowed: bool) -> Dict[str, Any]:
+        """工具预算用尽后仍携带 tools 定义（历史消息里有 tool 调用），但禁止再次调用"""
+        if tools is None:
+            return {"model": self.model_name, "messages": messages, "temperature": 0.7}
+        return {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": 0.7,
+            "tools": tools,
+            "tool_choice": (tool_choice or NOT_GIVEN) if tools_allowed else "none",
+        }
+
     async def generate(self, messages: List[ChatCompletionMessageParam], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> str:
         try:
-            tool_payload = tools if tools is not None else NOT_GIVEN
-            openai_client = cast(Any, self.client)
-            response = await openai_client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=0.7,
-                tools=tool_payload,
-                tool_choice=tool_choice,
-            )
-            message = response.choices[0].message
-            
-            # 处理工具调用
-            if message.tool_calls:
-                # 将工具调用添加到消息历史中
-                tool_calls_list: List[Any] = list(message.tool_calls or [])
-                tool_call_dicts: List[Dict[str, Any]] = []
-                for tc in tool_calls_list:
-                    tc_id = getattr(tc, "id", "")
+            # 复制一份消息列表，同一批消息会被多个模型并发使用
+            messages = list(messages)
+            budget = ToolLoopBudget(bool(tools))
+
+            while True:
+                tools_allowed = budget.allows_step()
+                kwargs = self._completion_kwargs(messages, tools, tool_choice, tools_allowed)
+                response = await self._create(**kwargs)
+                self._record_usage(openai_usage(getattr(response, "usage", None)))
+                message = response.choices[0].message
+                if not (tools_allowed and message.tool_calls):
+                    return message.content or ""
+
+                tool_calls: List[Dict[str, Any]] = []
+                for tc in message.tool_calls:
                     func = getattr(tc, "function", None)
-                    tool_call_dicts.append({
-                        "id": tc_id,
-                        "type": "function",
-                        "function": {
-                            "name": getattr(func, "name", ""),
-                            "arguments": getattr(func, "arguments", ""),
-                        }
+                    tool_calls.append({
+                        "id": getattr(tc, "id", "") or "",
+                        "name": getattr(func, "name", "") or "",
+                        "arguments": getattr(func, "arguments", "") or "",
                     })
 
-                messages.append(cast(ChatCompletionMessageParam, {
-                    "role": "assistant",
-                    "content": message.content,
-                    "tool_calls": tool_call_dicts,
-                }))
-                
-                # 执行工具调用
-                import json
-                from core.searxng import get_searxng_client
-                from core.browser_search import (
-                    BrowserSearchUnavailable,
-                    get_browser_search_client,
-                )
-
-                tool_results: List[Dict[str, Any]] = []
-                for tc in tool_calls_list:
-                    func = getattr(tc, "function", None)
-                    func_name = getattr(func, "name", "") or ""
-                    try:
-                        args = json.loads(getattr(func, "arguments", "") or "{}")
-                    except json.JSONDecodeError:
-                        args = {}
-
-                    args_dict: Dict[str, Any] = cast(Dict[str, Any], args) if isinstance(args, dict) else {}
-
-                    query = str(args_dict.get("query", "") or "").strip()
-                    max_pages = _parse_max_pages(args_dict.get("max_pages"))
-
-                    if func_name == "network_search":
-                        if not query:
-                            tool_results.append({
-                                "tool_call_id": getattr(tc, "id", ""),
-                                "role": "tool",
-                                "name": "network_search",
-                                "content": "搜索关键词为空。"
-                            })
-                            continue
-
-                        try:
-                            searxng_client = cast(Any, get_searxng_client())
-                            search_result: Dict[str, Any] = await searxng_client.search_with_ai_summary(query)
-                            if search_result.get('success'):
-                                results_text = search_result.get('ai_context', '')
-                                if results_text:
-                                    content = (
-                                        "搜索结果：\n\n"
-                                        f"{results_text}\n\n"
-                                        "基于以上搜索结果，请回答用户的问题。"
-                                    )
-                                else:
-                                    content = "搜索未找到相关结果。"
-                            else:
-                                error_msg = search_result.get('error', '搜索失败')
-                                content = f"搜索失败: {error_msg}"
-                        except Exception as e:
-                            content = f"执行搜索时出错: {str(e)}"
-
-                        tool_results.append({
-                            "tool_call_id": getattr(tc, "id", ""),
-                            "role": "tool",
-                            "name": "network_search",
-                            "content": content
-                        })
-
-                    elif func_name == "browser_search":
-                        if not query:
-                            tool_results.append({
-                                "tool_call_id": getattr(tc, "id", ""),
-                                "role": "tool",
-                                "name": "browser_search",
-                                "content": "浏览器搜索关键词为空。"
-                            })
-                            continue
-
-                        try:
-                            browser_client = cast(Any, get_browser_search_client())
-                            browser_result: Dict[str, Any] = await browser_client.search(query, max_pages=max_pages)
-                            if browser_result.get("success"):
-                                context = browser_result.get("context", "")
-                                if context:
-                                    content = (
-                                        "浏览器抓取结果：\n\n"
-                                        f"{context}\n\n"
-                                        "请结合上述网页内容，整合出权威、最新的回答。"
-                                    )
-                                else:
-                                    content = "浏览器抓取完成，但未提取到可用正文。"
-                            else:
-                                content = f"浏览器抓取失败: {browser_result.get('error', '未知错误')}"
-                        except BrowserSearchUnavailable as e:
-                            content = f"浏览器搜索当前不可用: {e}"
-                        except Exception as e:
-                            content = f"执行浏览器搜索时出错: {str(e)}"
-
-                        tool_results.append({
-                            "tool_call_id": getattr(tc, "id", ""),
-                            "role": "tool",
-                            "name": "browser_search",
-                            "content": content
-                        })
-                
-                # 将工具结果添加到消息历史中
-                messages.extend(cast(List[ChatCompletionMessageParam], tool_results))
-                
-                # 再次调用模型，让它基于搜索结果生成回答
-                second_response = await openai_client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    temperature=0.7,
-                    tools=tool_payload,
-                    tool_choice=tool_choice,
-                )
-                return second_response.choices[0].message.content or ""
-            
-            return message.content or ""
+                # 将工具调用及其结果添加到消息历史中，再让模型基于结果继续
+                step = budget.consume_step()
+                messages.append(_assistant_tool_message(message.content, tool_calls))
+                messages.extend(cast(List[ChatCompletionMessageParam], await self._run_tools(tool_calls, step)))
         except Exception as e:
             return f"[Error: {e}]"
 
     async def generate_stream(self, messages: List[ChatCompletionMessageParam], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> AsyncGenerator[str, None]:
         try:
-            tool_payload = tools if tools is not None else NOT_GIVEN
-            openai_client = cast(Any, self.client)
-            stream = await openai_client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=0.7,
-                stream=True,
-                tools=tool_payload,
-                tool_choice=tool_choice,
-            )
-            
-            # 收集完整的消息内容，用于处理工具调用
-            full_content = ""
-            tool_calls_accumulated: Dict[str, Dict[str, Any]] = {}
-            
-            async for chunk in stream:
-                content = chunk.choices[0].delta.content
-                tool_calls = chunk.choices[0].delta.tool_calls
-
-                if content:
-                    full_content += content
-                    yield content
+            messages = list(messages)
+            budget = ToolLoopBudget(bool(tools))
+
+            while True:
+                tools_allowed = budget.allows_step()
+                kwargs = self._completion_kwargs(messages, tools, tool_choice, tools_allowed)
+                if get_config().usage.stream_usage and self.provider_name not in _stream_options_unsupported:
+                    # 最后一个分片携带整次请求的 usage（choices 为空）
+                    kwargs["stream_options"] = {"include_usage": True}
+                stream = await self._create_stream(kwargs)
                 
-                if tool_calls:
-                    # 累积工具调用信息
-                    for tc in tool_calls:
-                        tc_id = getattr(tc, "id", "")
-                        func = getattr(tc, "function", None)
-                        if tc_id and func:
-                            if tc_id not in tool_calls_accumulated:
-                                tool_calls_accumulated[tc_id] = {
-                                    "id": tc_id,
-                                    "name": getattr(func, "name", "") or "",
-                                    "arguments": getattr(func, "arguments", "") or ""
-                                }
-                            else:
-                                arguments = getattr(func, "arguments", "")
-                                if arguments:
-                                    tool_calls_accumulated[tc_id]["arguments"] += arguments
-            
-            # 如果检测到工具调用，执行它们
-            if tool_calls_accumulated:
-                # 将工具调用添加到消息历史中
-                messages.append({
-                    "role": "assistant",
-                    "content": full_content,
-                    "tool_calls": [
-                        {
-                            "id": tc["id"],
-                            "type": "function",
-                            "function": {
-                                "name": tc["name"],
-                                "arguments": tc["arguments"]
-                            }
-                        } for tc in tool_calls_accumulated.values()
-                    ]
-                })
+                # 收集完整的消息内容，用于处理工具调用
+                full_content = ""
+                tool_calls_accumulated: Dict[int, Dict[str, Any]] = {}
                 
-                # 执行工具调用
-                import json
-                from core.searxng import get_searxng_client
-                from core.browser_search import (
-                    BrowserSearchUnavailable,
-                    get_browser_search_client,
-                )
-
-                tool_results: List[Dict[str, Any]] = []
-                for tc_data in tool_calls_accumulated.values():
-                    func_name = tc_data.get("name", "")
-                    try:
-                        args = json.loads(tc_data.get("arguments", "") or "{}")
-                    except json.JSONDecodeError:
-                        args = {}
-
-                    args_dict: Dict[str, Any] = cast(Dict[str, Any], args) if isinstance(args, dict) else {}
-
-                    query = str(args_dict.get("query", "") or "").strip()
-                    max_pages = _parse_max_pages(args_dict.get("max_pages"))
-
-                    if func_name == "network_search":
-                        if not query:
-                            tool_results.append({
-                                "tool_call_id": tc_data["id"],
-                                "role": "tool",
-                                "name": "network_search",
-                                "content": "搜索关键词为空。"
-                            })
-                            continue
-
-                        try:
-                            searxng_client = cast(Any, get_searxng_client())
-                            search_result: Dict[str, Any] = await searxng_client.search_with_ai_summary(query)
-                            if search_result.get('success'):
-                                results_text = search_result.get('ai_context', '')
-                                if results_text:
-                                    content = (
-                                        "搜索结果：\n\n"
-                                        f"{results_text}\n\n"
-                                        "基于以上搜索结果，请回答用户的问题。"
-                                    )
-                                else:
-                                    content = "搜索未找到相关结果。"
-                            else:
-                                content = f"搜索失败: {search_result.get('error', '搜索失败')}"
-                        except Exception as e:
-                            content = f"执行搜索时出错: {str(e)}"
-
-                        tool_results.append({
-                            "tool_call_id": tc_data["id"],
-                            "role": "tool",
-                            "name": "network_search",
-                            "content": content
-                        })
-
-                    elif func_name == "browser_search":
-                        if not query:
-                            tool_results.append({
-                                "tool_call_id": tc_data["id"],
-                                "role": "tool",
-                                "name": "browser_search",
-                                "content": "浏览器搜索关键词为空。"
-                            })
-                            continue
-
-                        try:
-                            browser_client = cast(Any, get_browser_search_client())
-                            browser_result: Dict[str, Any] = await browser_client.search(query, max_pages=max_pages)
-                            if browser_result.get("success"):
-                                context = browser_result.get("context", "")
-                                if context:
-                                    content = (
-                                        "浏览器抓取结果：\n\n"
-                                        f"{context}\n\n"
-                                        "请结合上述网页内容，整合出权威、最新的回答。"
-                                    )
-                                else:
-                                    content = "浏览器抓取完成，但未提取到可用正文。"
-                            else:
-                                content = f"浏览器抓取失败: {browser_result.get('error', '未知错误')}"
-                        except BrowserSearchUnavailable as e:
-                            content = f"浏览器搜索当前不可用: {e}"
-                        except Exception as e:
-                            content = f"执行浏览器搜索时出错: {str(e)}"
-
-                        tool_results.append({
-                            "tool_call_id": tc_data["id"],
-                            "role": "tool",
-                            "name": "browser_search",
-                            "content": content
-                        })
-                
-                # 将工具结果添加到消息历史中
-                messages.extend(cast(List[ChatCompletionMessageParam], tool_results))
-                
-                # 再次调用模型，流式返回基于搜索结果的回答
-                second_stream = await openai_client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    temperature=0.7,
-                    stream=True,
-                    tools=tool_payload,
-                    tool_choice=tool_choice,
-                )
-                async for chunk in second_stream:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None) is not None:
+                        self._record_usage(openai_usage(chunk.usage))
+                    if not chunk.choices:
+                        continue
                     content = chunk.choices[0].delta.content
+                    tool_calls = chunk.choices[0].delta.tool_calls
+
                     if content:
+                        full_content += content
                         yield content
+                    
+                    if tool_calls:
+                        # 累积工具调用信息：后续分片只带 index 不带 id，按 index 归并
+                        for tc in tool_calls:
+                            index = getattr(tc, "index", None)
+                            if index is None:
+                                index = len(tool_calls_accumulated)
+                            func = getattr(tc, "function", None)
+                            entry = tool_calls_accumulated.setdefault(index, {"id": "", "name": "", "arguments": ""})
+                            if getattr(tc, "id", None):
+                                entry["id"] = tc.id
+                            if getattr(func, "name", None):
+                                entry["name"] = func.name
+                            if getattr(func, "arguments", None):
+                                entry["arguments"] += func.arguments
+                
+                if not (tools_allowed and tool_calls_accumulated):
+                    return
+
+                # 执行工具调用，然后进入下一步继续流式输出
+                step = budget.consume_step()
+                tool_call_list = [tool_calls_accumulated[i] for i in sorted(tool_calls_accumulated)]
+                messages.append(_assistant_tool_message(full_content, tool_call_list))
+                messages.extend(cast(List[ChatCompletionMessageParam], await self._run_tools(tool_call_list, step)))
         except Exception as e:
             yield f"[Error: {e}]"
 
 class GeminiModel(BaseModel):
-    """Gemini模型实现"""
+    """Gemini模型实现：使用 SDK 的原生异步接口，不占用线程池"""
 
-    def __init__(self, provider_config: Dict, model_name: str):
-        super().__init__(provider_config, model_name)
+    def __init__(self, provider_config: Dict, model_name: str, tool_executor: Optional[ToolExecutor] = None, on_event: Optional[Callable[[Dict[str, Any]], None]] = None, usage: Optional[UsageTracker] = None):
+        super().__init__(provider_config, model_name, tool_executor, on_event, usage)
         genai.configure(api_key=provider_config['api_key'])
         self.model = genai.GenerativeModel(model_name)
-
-    async def generate(self, messages: List[Dict]) -> str:
+        self.generation_config = genai.types.GenerationConfig(temperature=0.7)
+        self._system_models: Dict[str, Any] = {}
+
+    def _model_for(self, system: str) -> Any:
+        """带 system_instruction 的模型实例按指令文本复用"""
+        if not system:
+            return self.model
+        model = self._system_models.get(system)
+        if model is None:
+            model = genai.GenerativeModel(self.model_name, system_instruction=system)
+            self._system_models[system] = model
+        return model
+
+    async def generate(self, messages: List[Dict], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> str:
         try:
-            gemini_messages = [
-                {'role': 'user' if msg['role'] == 'user' else 'model', 'parts': [msg['content']]}
-                for msg in messages
-            ]
-            response = await asyncio.to_thread(
-                self.model.generate_content,
-                gemini_messages,
-                generation_config=genai.types.GenerationConfig(temperature=0.7)
-            )
-            return response.text
+            pieces = [piece async for piece in self._run(messages, tools, tool_choice, stream=False)]
+            return "".join(pieces)
         except Exception as e:
             return f"[Error: {e}]"
 
-def create_model_instance(provider_config: Dict, model_name: str) -> Optional[BaseModel]:
-    """工厂函数：根据配置创建模型实例"""
+    async def generate_stream(self, messages: List[Dict], tools: Optional[List[Any]] = None, tool_choice: Optional[str] = None) -> AsyncGenerator[str, None]:
+        try:
+            async for piece in self._run(messages, tools, tool_choice, stream=True):
+                yield piece
+        except Exception as e:
+            yield f"[Error: {e}]"
+
+    async def _run(self, messages: List[Dict], tools: Optional[List[Any]], tool_choice: Optional[str], stream: bool) -> AsyncGenerator[str, None]:
+        """与 OpenAIModel 相同的多步工具循环，逐段产出文本"""
+        # system 消息作为 system_instruction 传入，保持在请求最前面以便命中隐式缓存
+        system = "\n\n".join(msg['content'] for msg in messages if msg['role'] == 'system')
+        model = self._model_for(system)
+        contents: List[Any] = [
+            {'role': 'user' if msg['role'] == 'user' else 'model', 'parts': [msg['content']]}
+            for msg in messages
+            if msg['role'] != 'system'
+        ]
+        gemini_tools = _to_gemini_tools(tools)
+        budget = ToolLoopBudget(bool(gemini_tools))
+
+        while True:
+            tools_allowed = budget.allows_step()
+            kwargs: Dict[str, Any] = {"generation_config": self.generation_config, "stream": stream}
+            if gemini_tools:
+                kwargs["tools"] = gemini_tools
+                mode = (tool_choice if tool_choice in ("auto", "any", "none") else "auto") if tools_allowed else "none"
+                kwargs["tool_config"] = {"function_calling_config": {"mode": mode}}
+            response = await self._call_provider(lambda: model.generate_content_async(contents, **kwargs), stream)
+
+            function_calls: List[Any] = []
+            if stream:
+                # 流式分片的 usage_metadata 是累计值，取最后一个
+                usage_metadata = None
+                async for chunk in response:
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    for text in _collect_parts(chunk, function_calls):
+                        yield text
+                self._record_usage(gemini_usage(usage_metadata))
+            else:
+                self._record_usage(gemini_usage(getattr(response, "usage_metadata", None)))
+                for text in _collect_parts(response, function_calls):
+                    yield text
+
+            if not (tools_allowed and function_calls):
+                return
+
+            step = budget.consume_step()
+            tool_calls = [
+                {
+                    "id": f"gemini-{step}-{index}",
+                    "name": fc.name,
+                    "arguments": json.dumps(_proto_to_python(fc.args), ensure_ascii=False),
+                }
+                for index, fc in enumerate(function_calls)
+            ]
+            tool_messages = await self._run_tools(tool_calls, step)
+            contents.append(genai.protos.Content(
+                role='model',
+                parts=[genai.protos.Part(function_call=fc) for fc in function_calls]
+            ))
+            contents.append(genai.protos.Content(
+                role='user',
+                parts=[
+                    genai.protos.Part(function_response=genai.protos.FunctionResponse(
+                        name=msg["name"], response={"content": msg["content"]}
+                    ))
+                    for msg in tool_messages
+                ]
+            ))
+
+def _to_gemini_tools(tools: Optional[List[Any]]) -> Optional[List[Dict[str, Any]]]:
+    """把 OpenAI 格式的 function 工具定义转换为 Gemini 的 function_declarations"""
+    declarations = []
+    for tool in tools or []:
+        func = tool.get("function") if isinstance(tool, dict) else None
+        if not func or not func.get("name"):
+            continue
+        declaration = {"name": func["name"], "description": func.get("description", "")}
+        if func.get("parameters"):
+            declaration["parameters"] = func["parameters"]
+        declarations.append(declaration)
+    if not declarations:
+        return None
+    return [{"function_declarations": declarations}]
+
+def _collect_parts(response: Any, function_calls: List[Any]) -> List[str]:
+    """取出一个响应（或流式分片）中的文本片段，并把 function_call 收集到 function_calls"""
+    texts: List[str] = []
+    candidates = getattr(response, "candidates", None) or []
+    if not candidates:
+        return texts
+    for part in getattr(candidates[0].content, "parts", None) or []:
+        fc = getattr(part, "function_call", None)
+        if fc is not None and fc.name:
+            function_calls.append(fc)
+        elif getattr(part, "text", ""):
+            texts.append(part.text)
+    return texts
+
+def _proto_to_python(value: Any) -> Any:
+    """把 function_call.args（proto MapComposite）转换成普通的 dict/list"""
+    if hasattr(value, "items"):
+        return {key: _proto_to_python(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "RepeatedComposite":
+        return [_proto_to_python(item) for item in value]
+    return value
+
+def create_model_instance(provider_config: Dict, model_name: str, tool_executor: Optional[ToolExecutor] = None, on_event: Optional[Callable[[Dict[str, Any]], None]] = None, alternates: Optional[List[Dict[str, Any]]] = None, usage: Optional[UsageTracker] = None) -> Optional[BaseModel]:
+    """工厂函数：根据配置创建模型实例；alternates 为可用于对冲请求的等价服务商，usage 为本轮的 token 计量"""
     model_type = provider_config.get('type')
     if model_type == 'OpenAI':
-        return OpenAIModel(provider_config, model_name)
+        return OpenAIModel(provider_config, model_name, tool_executor, on_event, alternates, usage)
     elif model_type == 'Gemini':
-        return GeminiModel(provider_config, model_name)
+        return GeminiModel(provider_config, model_name, tool_executor, on_event, usage)
     return None
@@ -1,9 +1,19 @@
 import asyncio
+import difflib
 import re
-from typing import List, Dict, Any, AsyncGenerator, Optional
+import string
+import time
+from contextlib import suppress
+from typing import List, Dict, Any, AsyncGenerator, Optional, Tuple
 
 from .models import create_model_instance
 from .logging import get_logger
+from .config import PipelineConfig, get_config
+from .resilience import get_circuit_breaker
+from .tools import cached_network_search, create_run_tool_executor
+from .usage import UsageTracker, create_run_usage_tracker, current_stage, run_in_stage
+from .control import RunControl
+from .exceptions import ModelSkipped
 import core.database as db
 
 logger = get_logger(__name__)
@@ -27,6 +37,61 @@ DISCLAIMER_PATTERNS = [
     re.compile(r"没有.*?(?:视觉|图像|图片).*?(?:能力|功能)", re.I)
 ]
 
+# 评审提示词：静态的评审标准作为逐字节不变的 system 消息放在最前，
+# 问题、被评审模型与答案等可变内容放在其后的 user 消息中，
+# 使 N(N-1) 次评审调用共享同一前缀，命中服务商的提示词缓存
+CRITIQUE_RUBRIC = """你是一位专业的同行评审专家。【重要：必须严格按照指定格式输出，否则评审无效】
+
+你将收到一个问题以及某个模型对该问题的答案（如有图片，还会附上OCR识别文本），请按以下标准评审该答案。
+
+【评分标准】(每项0-3分，必须严格区分)
+1. 准确性: 3=完全准确无误 2=基本准确但有小瑕疵 1=有明显错误 0=严重错误或完全相反
+2. 完整性: 3=全面深入，覆盖所有关键点 2=覆盖大部分要点但有遗漏 1=覆盖不足 0=严重不完整
+3. 清晰性: 3=表达清晰有条理 2=基本清晰但逻辑稍乱 1=表达不够清楚 0=难以理解
+4. 实用性: 3=可直接应用，提供具体方案 2=有帮助但缺乏实操细节 1=理论多实践少 0=无用
+
+【评语要求】(至少80字，必须具体指向答案内容)
+- 不要使用通用表述，必须针对该答案的具体内容
+- 指出具体的好处 (如："答案准确指出了...")
+- 指出具体的问题 (如："答案遗漏了..." 或 "答案错误地说...")
+- 给出具体的改进建议 (如："可以补充..." 或 "应该修正...")
+- 如有OCR文本，务必参考其内容进行评价
+
+【输出格式 - 必须严格遵守，不要添加任何其他内容】
+准确性: [0-3]
+完整性: [0-3]
+清晰性: [0-3]
+实用性: [0-3]
+总分: [0-12]
+评语: [80字以上的具体评语]
+
+【格式示例】
+准确性: 2
+完整性: 1
+清晰性: 2
+实用性: 3
+总分: 8
+评语: 该答案准确地指出了OCR文本中的关键词"design"，但完整性不足，遗漏了对"layout"的分析。表达基本清晰。实用性较好，提供了可行的改进方向。建议补充对"color harmony"的讨论，并提供具体的设计工具或参考资源。"""
+
+def _split_critique_template(template: str, values: Dict[str, str]) -> Tuple[str, str]:
+    """把自定义评审模板按段落拆分：开头连续的、不含占位符的段落作为静态前缀（可被缓存），
+    从第一个含占位符的段落起，其余段落填充后按原顺序放在后面，不改变模板的段落顺序"""
+    paragraphs = template.split("\n\n")
+    split = len(paragraphs)
+    for index, paragraph in enumerate(paragraphs):
+        if any(field for _, field, _, _ in string.Formatter().parse(paragraph)):
+            split = index
+            break
+    static = "\n\n".join(paragraphs[:split]).format(**values)
+    variable = "\n\n".join(paragraphs[split:]).format(**values)
+    return static, variable
+
+def _answer_edit_distance(before: str, after: str) -> float:
+    """归一化编辑距离：0 表示完全相同，1 表示完全不同"""
+    if before == after:
+        return 0.0
+    return 1.0 - difflib.SequenceMatcher(None, before or "", after or "").ratio()
+
 class Orchestrator:
     async def process_query_stream(
         self,
@@ -35,69 +100,136 @@ class Orchestrator:
         history: List[Dict[str, str]],
         ocr_text: Optional[str] = None,
         tools: Optional[List[Dict]] = None,
-        tool_choice: Optional[str] = None
+        tool_choice: Optional[str] = None,
+        max_rounds: Optional[int] = None,
+        prefetch_search: Optional[bool] = None,
+        token_budget: Optional[int] = None,
+        control: Optional[RunControl] = None,
+        save_history: bool = False,
+        history_owner: Optional[str] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        yield {"type": "status", "data": "正在初始化模型..."}
+        # 同一次运行内所有模型、所有轮次共享工具调用结果；工具进度与重试事件经队列转发到 SSE
+        run_events: asyncio.Queue = asyncio.Queue()
+        tool_executor = create_run_tool_executor(on_event=run_events.put_nowait)
+        # 按模型与阶段统计 token 用量；超出预算后不再发起新的模型调用
+        usage = create_run_usage_tracker(token_budget if token_budget is not None else get_config().usage.token_budget)
+        # 客户端控制（跳过模型、暂停）；没有反向通道的传输方式使用一个不会被触发的实例
+        control = control or RunControl()
+
+        # 预取搜索：与模型初始化并行执行，结果写入本次运行的工具缓存
+        prefetch_task: Optional[asyncio.Future] = None
+        prefetch_started = time.monotonic()
+        if prefetch_search is None:
+            prefetch_search = get_config().tools.prefetch
+        if prefetch_search and tools and user_question.strip():
+            prefetch_task = asyncio.ensure_future(
+                cached_network_search(tool_executor.cache, user_question.strip())
+            )
+
+        try:
+            yield {"type": "status", "data": "正在初始化模型..."}
         
-        active_models = []
-        for sm_id in selected_models:
-            parts = sm_id.split('::', 1)
-            if len(parts) != 2:
-                continue
-            provider_name, model_name = parts
-            provider_config = db.get_provider_by_name(provider_name)
-            if provider_config:
-                instance = create_model_instance(provider_config, model_name)
-                if instance:
-                    active_models.append(instance)
+            active_models = []
+            for sm_id in selected_models:
+                parts = sm_id.split('::', 1)
+                if len(parts) != 2:
+                    continue
+                provider_name, model_name = parts
+                breaker = get_circuit_breaker(sm_id)
+                if breaker.is_open():
+                    retry_in = round(breaker.retry_in())
+                    yield {
+                        "type": "model_excluded",
+                        "model_name": sm_id,
+                        "reason": "circuit_open",
+                        "retry_in": retry_in,
+                        "data": f"{sm_id} 近期连续失败或响应过慢，已暂时跳过（约 {retry_in} 秒后重试）"
+                    }
+                    continue
+                provider_config = await db.get_provider_by_name_async(provider_name)
+                if provider_config:
+                    alternates = await db.get_equivalent_providers_async(provider_name, model_name) if get_config().hedge.enabled else []
+                    instance = create_model_instance(provider_config, model_name, tool_executor, run_events.put_nowait, alternates, usage)
+                    if instance:
+                        active_models.append(instance)
         
-        if not active_models:
-            yield {"type": "error", "data": "没有可用的模型"}
-            return
+            if not active_models:
+                yield {"type": "error", "data": "没有可用的模型"}
+                return
         
-        # 如果有OCR文本，将其与用户问题合并，作为更丰富且显式的上下文
-        ocr_text_clean = ocr_text.strip() if ocr_text else ""
-        user_question_clean = user_question.strip()
-
-        # 如果有工具可用，添加工具使用提示
-        tool_hint = ""
-        if tools:
-            tool_hint = "\n\n【重要提示】如果你需要获取实时信息、最新资讯、事实核查或当前事件，请使用 network_search 工具进行网络搜索。"
+            # 如果有OCR文本，将其与用户问题合并，作为更丰富且显式的上下文
+            ocr_text_clean = ocr_text.strip() if ocr_text else ""
+            user_question_clean = user_question.strip()
+
+            # 如果有工具可用，添加工具使用提示
+            tool_hint = ""
+            if tools:
+                tool_hint = "\n\n【重要提示】如果你需要获取实时信息、最新资讯、事实核查或当前事件，请使用 network_search 工具进行网络搜索。"
         
-        if ocr_text_clean:
-            combined_question = (
-                "【OCR识别文本】\n"
-                f"{ocr_text_clean}\n\n"
-                "【强制要求】\n"
-                "1. 你无法直接查看原图，禁止回复'无法看到图片''我是文本AI'等托辞。\n"
-                "2. 必须完全依据上方OCR文字做出专业分析，指出优点、缺陷与改进建议。\n"
-                "3. 如OCR文字存在缺漏，请说明缺失信息对判断的影响。\n"
-                "4. 结尾至少提出两条具体改进建议。\n"
-                f"【用户问题】{user_question_clean or '请基于OCR内容给出详细、严格的专业评估。'}\n"
-                f"{tool_hint}"
-            )
-        else:
-            combined_question = (user_question_clean or "请结合已有对话提供回答。") + tool_hint
+            if ocr_text_clean:
+                combined_question = (
+                    "【OCR识别文本】\n"
+                    f"{ocr_text_clean}\n\n"
+                    "【强制要求】\n"
+                    "1. 你无法直接查看原图，禁止回复'无法看到图片''我是文本AI'等托辞。\n"
+                    "2. 必须完全依据上方OCR文字做出专业分析，指出优点、缺陷与改进建议。\n"
+                    "3. 如OCR文字存在缺漏，请说明缺失信息对判断的影响。\n"
+                    "4. 结尾至少提出两条具体改进建议。\n"
+                    f"【用户问题】{user_question_clean or '请基于OCR内容给出详细、严格的专业评估。'}\n"
+                    f"{tool_hint}"
+                )
+            else:
+                combined_question = (user_question_clean or "请结合已有对话提供回答。") + tool_hint
 
-        messages = history + [{"role": "user", "content": combined_question}]
+            first_round_question = combined_question
+            if prefetch_task is not None:
+                search_context = await self._await_prefetch(prefetch_task)
+                yield {
+                    "type": "search_prefetch",
+                    "success": bool(search_context),
+                    "duration": round(time.monotonic() - prefetch_started, 3)
+                }
+                if search_context:
+                    first_round_question = (
+                        "【联网搜索结果（已预先检索）】\n"
+                        f"{search_context}\n\n"
+                        "请优先依据上述搜索结果作答；如仍需补充信息，可继续调用 network_search 工具。\n\n"
+                        f"{combined_question}"
+                    )
+
+            messages = history + [{"role": "user", "content": first_round_question}]
         
-        yield {"type": "status", "data": "第一轮：生成初始答案..."}
+            yield {"type": "status", "data": "第一轮：生成初始答案..."}
         
-        initial_answers = {}
-        results = await asyncio.gather(
-            *[model.generate(messages, tools=tools, tool_choice=tool_choice) for model in active_models],
-            return_exceptions=True
-        )
-
-        for model, result in zip(active_models, results):
-            initial_answers[model.name] = f"[失败: {result}]" if isinstance(result, Exception) else result
-            yield {"type": "initial_answer_complete", "model_name": model.name, "answer": initial_answers[model.name]}
+            initial_answers = {}
+            await control.checkpoint()
+            initial_task = asyncio.ensure_future(asyncio.gather(
+                *[
+                    control.run(run_in_stage("initial", self._generate_initial(model, messages, tools, tool_choice, run_events)), model.name)
+                    for model in active_models
+                ],
+                return_exceptions=True
+            ))
+            async for event in self._relay_events(initial_task, run_events):
+                yield event
+            results = initial_task.result()
+
+            for model, result in zip(active_models, results):
+                if isinstance(result, ModelSkipped):
+                    continue
+                initial_answers[model.name] = f"[失败: {result}]" if isinstance(result, Exception) else result
+                yield {"type": "initial_answer_complete", "model_name": model.name, "answer": initial_answers[model.name]}
+
+            active_models, skipped_events = self._drop_skipped(active_models, control, initial_answers)
+            for event in skipped_events:
+                yield event
+            if not active_models:
+                yield {"type": "error", "data": "所有模型均已被跳过"}
+                return
         
-        if len(active_models) == 1:
-            single_model_name = active_models[0].name
-            yield {
-                "type": "final_result",
-                "data": {
+            if len(active_models) == 1:
+                single_model_name = active_models[0].name
+                result = {
                     "best_answer": initial_answers[single_model_name],
                     "process_details": [{
                         "model_name": single_model_name,
@@ -105,75 +237,272 @@ class Orchestrator:
                         "critiques_received": [],
                         "revised_answer": initial_answers[single_model_name],
                         "total_score": 0
-                    }]
+                    }],
+                    "usage": usage.summary()
                 }
-            }
-            return
-        
-        yield {"type": "status", "data": "第二轮：互相评审..."}
-        
-        critiques = {m.name: [] for m in active_models}
-        critique_tasks = [
-            (critic.name, target.name, self._generate_critique(
-                critic, target.name, combined_question, initial_answers.get(target.name, ""), ocr_text_clean
-            ))
-            for critic in active_models 
-            for target in active_models 
-            if critic.name != target.name
-        ]
-        
-        results = await asyncio.gather(*[task for _, _, task in critique_tasks], return_exceptions=True)
-        
-        for (critic_name, target_name, _), result in zip(critique_tasks, results):
-            if not isinstance(result, Exception):
-                critique_text, parsed = result
-                critiques[target_name].append(parsed)
-                yield {
-                    "type": "critique_complete",
-                    "critic_name": critic_name,
-                    "target_model": target_name,
-                    "critique_text": critique_text,
-                    "critique_data": parsed
-                }
-        
-        yield {"type": "status", "data": "第三轮：改进答案..."}
-        
-        revised_answers = {}
-        revision_tasks = [
-            (model.name, self._generate_revision(
-                model, initial_answers.get(model.name, ""), critiques.get(model.name, [])
-            ))
-            for model in active_models 
-            if critiques.get(model.name)
-        ]
+                result["run_id"] = await self._save_run(
+                    user_question_clean, ocr_text_clean, result, [], 0, history_owner
+                ) if save_history else None
+                yield {"type": "final_result", "data": result}
+                return
         
-        if revision_tasks:
-            results = await asyncio.gather(*[task for _, task in revision_tasks], return_exceptions=True)
-            for (model_name, _), result in zip(revision_tasks, results):
-                if isinstance(result, Exception):
-                    revised_answers[model_name] = initial_answers.get(model_name, "")
+            pipeline = get_config().pipeline
+            rounds_limit = max(1, max_rounds or pipeline.max_rounds)
+            current_answers = dict(initial_answers)
+            critiques: Dict[str, List[Dict]] = {m.name: [] for m in active_models}
+            previous_scores: Optional[Dict[str, float]] = None
+            round_history: List[Dict[str, Any]] = []
+            critique_log: List[Dict[str, Any]] = []
+
+            for round_index in range(1, rounds_limit + 1):
+                await control.checkpoint()
+                active_models, skipped_events = self._drop_skipped(active_models, control, initial_answers, current_answers, critiques)
+                for event in skipped_events:
+                    yield event
+                if len(active_models) < 2:
+                    break
+                if usage.exhausted():
+                    yield self._budget_event(usage, round_index, "critique")
+                    break
+                round_started = time.monotonic()
+                if round_index == 1:
+                    yield {"type": "status", "data": "第二轮：互相评审..."}
                 else:
-                    revised_answers[model_name] = result
-                yield {
-                    "type": "revision_complete", 
-                    "model_name": model_name, 
-                    "revised_answer": revised_answers[model_name]
+                    yield {"type": "status", "data": f"第 {round_index} 轮迭代：互相评审..."}
+
+                critiques = {m.name: [] for m in active_models}
+                critique_tasks = [
+                    (critic.name, target.name, control.run(self._generate_critique(
+                        critic, target.name, combined_question, current_answers.get(target.name, ""), ocr_text_clean
+                    ), critic.name, target.name))
+                    for critic in active_models 
+                    for target in active_models 
+                    if critic.name != target.name
+                ]
+            
+                critique_gather = asyncio.ensure_future(
+                    asyncio.gather(*[task for _, _, task in critique_tasks], return_exceptions=True)
+                )
+                async for event in self._relay_events(critique_gather, run_events):
+                    yield event
+                results = critique_gather.result()
+            
+                for (critic_name, target_name, _), result in zip(critique_tasks, results):
+                    if not isinstance(result, Exception):
+                        critique_text, parsed = result
+                        critiques[target_name].append(parsed)
+                        critique_log.append({**parsed, "round": round_index, "target_model": target_name})
+                        yield {
+                            "type": "critique_complete",
+                            "round": round_index,
+                            "critic_name": critic_name,
+                            "target_model": target_name,
+                            "critique_text": critique_text,
+                            "critique_data": parsed
+                        }
+            
+                if round_index == 1:
+                    yield {"type": "status", "data": "第三轮：改进答案..."}
+                else:
+                    yield {"type": "status", "data": f"第 {round_index} 轮迭代：改进答案..."}
+            
+                revised_answers = {}
+                await control.checkpoint()
+                active_models, skipped_events = self._drop_skipped(active_models, control, initial_answers, current_answers, critiques)
+                for event in skipped_events:
+                    yield event
+                budget_stopped = usage.exhausted()
+                if budget_stopped:
+                    yield self._budget_event(usage, round_index, "revision")
+                revision_tasks = [] if budget_stopped else [
+                    (model.name, control.run(run_in_stage("revision", self._generate_revision(
+                        model, current_answers.get(model.name, ""), critiques.get(model.name, [])
+                    )), model.name))
+                    for model in active_models 
+                    if critiques.get(model.name)
+                ]
+            
+                if revision_tasks:
+                    revision_gather = asyncio.ensure_future(
+                        asyncio.gather(*[task for _, task in revision_tasks], return_exceptions=True)
+                    )
+                    async for event in self._relay_events(revision_gather, run_events):
+                        yield event
+                    results = revision_gather.result()
+                    for (model_name, _), result in zip(revision_tasks, results):
+                        if isinstance(result, ModelSkipped):
+                            continue
+                        if isinstance(result, Exception):
+                            revised_answers[model_name] = current_answers.get(model_name, "")
+                        else:
+                            revised_answers[model_name] = result
+                        yield {
+                            "type": "revision_complete", 
+                            "round": round_index,
+                            "model_name": model_name, 
+                            "revised_answer": revised_answers[model_name]
+                        }
+            
+                active_models, skipped_events = self._drop_skipped(active_models, control, initial_answers, current_answers, critiques)
+                for event in skipped_events:
+                    yield event
+                for model in active_models:
+                    if model.name not in revised_answers:
+                        revised_answers[model.name] = current_answers.get(model.name, "")
+
+                # 收敛检测：比较本轮与上一轮的评分矩阵，以及修订前后答案的编辑距离
+                scores = self._score_matrix(critiques)
+                edit_distances = {
+                    name: round(_answer_edit_distance(current_answers.get(name, ""), answer), 4)
+                    for name, answer in revised_answers.items()
                 }
+                score_deltas = None
+                if previous_scores is not None:
+                    score_deltas = {
+                        name: round(score - previous_scores.get(name, 0.0), 2)
+                        for name, score in scores.items()
+                    }
+                converged = self._has_converged(score_deltas, edit_distances, pipeline)
+
+                round_summary = {
+                    "round": round_index,
+                    "scores": scores,
+                    "score_deltas": score_deltas,
+                    "edit_distances": edit_distances,
+                    "converged": converged,
+                    "elapsed": round(time.monotonic() - round_started, 2),
+                    "total_tokens": usage.total["total_tokens"]
+                }
+                round_history.append(round_summary)
+                yield {"type": "round_complete", **round_summary}
+
+                current_answers = revised_answers
+                previous_scores = scores
+                if budget_stopped:
+                    break
+                if converged and round_index < rounds_limit:
+                    logger.info(f"第 {round_index} 轮后评分与答案趋于稳定，提前结束迭代")
+                    break
         
-        for model in active_models:
-            if model.name not in revised_answers:
-                revised_answers[model.name] = initial_answers.get(model.name, "")
-        
-        yield {"type": "status", "data": "最终决策..."}
-        best_answer, details = self._make_final_decision(initial_answers, critiques, revised_answers)
-        yield {
-            "type": "final_result", 
-            "data": {"best_answer": best_answer, "process_details": details}
+            yield {"type": "status", "data": "最终决策..."}
+            if tools:
+                logger.info(f"工具调用缓存统计: {tool_executor.cache.stats()}")
+            usage_summary = usage.summary()
+            logger.info(
+                f"本轮 token 用量: {usage_summary['total']['total_tokens']}，"
+                f"评审阶段提示词缓存命中率: {usage_summary['by_stage'].get('critique', {}).get('cache_hit_rate', 0.0):.1%}"
+            )
+            best_answer, details = self._make_final_decision(initial_answers, critiques, current_answers)
+            result = {
+                "best_answer": best_answer,
+                "process_details": details,
+                "rounds": round_history,
+                "usage": usage_summary
+            }
+            result["run_id"] = await self._save_run(
+                user_question_clean, ocr_text_clean, result, critique_log, len(round_history), history_owner
+            ) if save_history else None
+            yield {"type": "final_result", "data": result}
+        finally:
+            # 提前返回（没有可用模型）、出错或运行被取消时，预取任务也要收尾，不能悬空
+            if prefetch_task is not None:
+                prefetch_task.cancel()
+                with suppress(asyncio.CancelledError, Exception):
+                    await prefetch_task
+
+    async def _save_run(
+        self, question: str, ocr_text: str, result: Dict[str, Any], critique_log: List[Dict[str, Any]], rounds: int,
+        owner: Optional[str]
+    ) -> Optional[int]:
+        """把本次运行写入 owner 的历史记录；写入失败只记日志，不影响返回结果"""
+        if not get_config().database.history_enabled or not owner:
+            return None
+        try:
+            return await db.save_run_async({
+                "owner": owner,
+                "question": question,
+                "ocr_text": ocr_text,
+                "models": [d["model_name"] for d in result["process_details"]],
+                "best_answer": result["best_answer"],
+                "process_details": result["process_details"],
+                "critiques": critique_log,
+                "rounds": rounds,
+                "usage": result.get("usage")
+            })
+        except Exception as e:
+            logger.error(f"保存运行历史失败: {e}")
+            return None
+
+    def _budget_event(self, usage: UsageTracker, round_index: int, skipped_stage: str) -> Dict[str, Any]:
+        """token 预算用尽：跳过剩余阶段，直接用已有答案做最终决策"""
+        logger.info(f"token 预算已用尽 ({usage.total['total_tokens']}/{usage.token_budget})，跳过第 {round_index} 轮 {skipped_stage}")
+        return {
+            "type": "budget_exhausted",
+            "round": round_index,
+            "skipped_stage": skipped_stage,
+            "total_tokens": usage.total["total_tokens"],
+            "token_budget": usage.token_budget,
+            "data": "已达到本次运行的 token 预算，跳过剩余评审与改进，直接给出结果..."
         }
     
+    async def _await_prefetch(self, prefetch_task: asyncio.Future) -> str:
+        """等待预取的搜索结果；超时或失败时返回空字符串，模型仍可自行调用工具"""
+        timeout = get_config().tools.network_timeout
+        try:
+            result = await asyncio.wait_for(asyncio.shield(prefetch_task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"预取搜索超过 {timeout} 秒未返回，跳过注入")
+            return ""
+        except Exception as e:
+            logger.warning(f"预取搜索失败: {e}")
+            return ""
+        if not result.get("success"):
+            return ""
+        return result.get("ai_context", "") or ""
+
+    async def _relay_events(self, task: asyncio.Future, events: asyncio.Queue) -> AsyncGenerator[Dict[str, Any], None]:
+        """在 task 完成之前持续转发队列中的进度事件，完成后把剩余事件一并转发"""
+        try:
+            while not task.done():
+                getter = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield getter.result()
+                elif not getter.cancel():
+                    yield getter.result()
+            while not events.empty():
+                yield events.get_nowait()
+        finally:
+            # 运行被取消（客户端断开或发送 cancel）时，一并取消仍在进行的模型调用
+            if not task.done():
+                task.cancel()
+                task.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def _drop_skipped(self, active_models: List[Any], control: RunControl, *answer_maps: Dict[str, Any]) -> Tuple[List[Any], List[Dict[str, Any]]]:
+        """移除客户端要求跳过的模型及其答案，返回剩余模型与对应的 model_skipped 事件"""
+        remaining, events = [], []
+        for model in active_models:
+            if not control.is_skipped(model.name):
+                remaining.append(model)
+                continue
+            for answers in answer_maps:
+                answers.pop(model.name, None)
+            events.append({"type": "model_skipped", "model_name": model.name, "data": f"{model.name} 已按客户端要求跳过"})
+        return remaining, events
+
+    async def _generate_initial(self, model, messages: List[Dict[str, str]], tools: Optional[List[Dict]], tool_choice: Optional[str], events: asyncio.Queue) -> str:
+        """第一轮答案：按配置逐段流式输出 answer_delta 事件，返回完整答案"""
+        if not get_config().stream.answer_deltas:
+            return await model.generate(messages, tools=tools, tool_choice=tool_choice)
+        pieces = []
+        async for piece in model.generate_stream(messages, tools=tools, tool_choice=tool_choice):
+            pieces.append(piece)
+            events.put_nowait({"type": "answer_delta", "model_name": model.name, "delta": piece})
+        return "".join(pieces)
+
     async def _generate_critique(self, critic_model, target_name: str, question: str, answer: str, ocr_text: str = "", tools: Optional[List[Dict]] = None, tool_choice: Optional[str] = None) -> tuple:
-        active_prompt = db.get_active_prompt()
-        prompt = self._build_critique_prompt(question, target_name, answer, active_prompt, ocr_text)
+        active_prompt = await db.get_active_prompt_async()
+        rubric, task = self._build_critique_prompt(question, target_name, answer, active_prompt, ocr_text)
 
         attempts = 0
         max_attempts = 3
@@ -182,24 +511,23 @@ class Orchestrator:
 
         while attempts < max_attempts:
             attempts += 1
+            # 本协程在 gather 创建的独立任务中运行，设置阶段不会影响其他调用
+            current_stage.set("critique" if attempts == 1 else "retry")
 
-            # 首次尝试使用原始提示词，后续尝试在提示词中追加纠正说明
+            # 首次尝试使用原始提示词，后续尝试在可变部分之后追加纠正说明，评审标准前缀保持不变
             if attempts == 1:
-                current_prompt = prompt
+                current_task = task
             else:
-                current_prompt = self._build_retry_prompt(
-                    question=question,
-                    target=target_name,
-                    answer=answer,
+                current_task = self._build_retry_prompt(
+                    task=task,
                     previous_output=critique_text,
                     missing_fields=parsed.get("missing_fields", []),
                     attempt=attempts
                 )
 
+            messages = [{"role": "system", "content": rubric}] if rubric else []
             critique_text = await critic_model.generate(
-                messages=[
-                    {"role": "user", "content": current_prompt}
-                ],
+                messages=messages + [{"role": "user", "content": current_task}],
                 tools=tools,
                 tool_choice=tool_choice,
             )
@@ -219,11 +547,12 @@ class Orchestrator:
         return (critique_text, parsed)
     
     async def _generate_revision(self, model, original: str, critiques: List[Dict], tools: Optional[List[Dict]] = None, tool_choice: Optional[str] = None) -> str:
-        active_prompt = db.get_active_prompt()
+        active_prompt = await db.get_active_prompt_async()
         prompt = self._build_revision_prompt(original, critiques, active_prompt)
         return await model.generate([{"role": "user", "content": prompt}], tools=tools, tool_choice=tool_choice)
     
-    def _make_final_decision(self, initial: Dict, critiques: Dict, revised: Dict):
+    def _score_matrix(self, critiques: Dict[str, List[Dict]]) -> Dict[str, float]:
+        """每个被评审模型的平均得分（忽略出错的评审）"""
         scores = {}
         for name, clist in critiques.items():
             # 过滤掉无效的、带有错误的评审
@@ -232,6 +561,23 @@ class Orchestrator:
                 scores[name] = sum(c.get('score', 0) for c in valid_critiques) / len(valid_critiques)
             else:
                 scores[name] = 0
+        return scores
+
+    def _has_converged(
+        self,
+        score_deltas: Optional[Dict[str, float]],
+        edit_distances: Dict[str, float],
+        pipeline: PipelineConfig
+    ) -> bool:
+        """答案几乎不再变化，或评分提升已进入平台期，即视为收敛"""
+        if edit_distances and max(edit_distances.values()) <= pipeline.edit_distance_threshold:
+            return True
+        if score_deltas:
+            return max(abs(delta) for delta in score_deltas.values()) <= pipeline.score_delta_threshold
+        return False
+
+    def _make_final_decision(self, initial: Dict, critiques: Dict, revised: Dict):
+        scores = self._score_matrix(critiques)
         
         results = [
             {
@@ -260,12 +606,13 @@ class Orchestrator:
             best_answer = "无结果"
         return best_answer, results
     
-    def _build_critique_prompt(self, question: str, target: str, answer: str, prompt_template: Optional[Dict] = None, ocr_text: str = "") -> str:
+    def _build_critique_prompt(self, question: str, target: str, answer: str, prompt_template: Optional[Dict] = None, ocr_text: str = "") -> Tuple[str, str]:
+        """返回 (评审标准, 评审任务)：前者对所有评审调用逐字节相同，后者包含本次的问题与答案"""
         if prompt_template and prompt_template.get('critique_prompt'):
-            template = prompt_template['critique_prompt']
-            return template.format(question=question, target=target, answer=answer, ocr_text=ocr_text)
+            values = {"question": question, "target": target, "answer": answer, "ocr_text": ocr_text}
+            return _split_critique_template(prompt_template['critique_prompt'], values)
         
-        # 默认提示词 - 包含OCR文本上下文
+        # 默认提示词 - 包含OCR文本上下文；问题在前，多个被评审答案共享的部分尽量靠前
         ocr_section = ""
         if ocr_text:
             ocr_section = f"""【图片内容 (OCR识别)】
@@ -273,49 +620,16 @@ class Orchestrator:
 
 """
         
-        return f"""你是一位专业的同行评审专家。【重要：必须严格按照指定格式输出，否则评审无效】
-
-【评审背景】
-{ocr_section}【评审问题】
+        task = f"""{ocr_section}【评审问题】
 {question}
 
 【被评审的答案 (来自 {target})】
-{answer}
-
-【评分标准】(每项0-3分，必须严格区分)
-1. 准确性: 3=完全准确无误 2=基本准确但有小瑕疵 1=有明显错误 0=严重错误或完全相反
-2. 完整性: 3=全面深入，覆盖所有关键点 2=覆盖大部分要点但有遗漏 1=覆盖不足 0=严重不完整
-3. 清晰性: 3=表达清晰有条理 2=基本清晰但逻辑稍乱 1=表达不够清楚 0=难以理解
-4. 实用性: 3=可直接应用，提供具体方案 2=有帮助但缺乏实操细节 1=理论多实践少 0=无用
-
-【评语要求】(至少80字，必须具体指向答案内容)
-- 不要使用通用表述，必须针对该答案的具体内容
-- 指出具体的好处 (如："答案准确指出了...")
-- 指出具体的问题 (如："答案遗漏了..." 或 "答案错误地说...")
-- 给出具体的改进建议 (如："可以补充..." 或 "应该修正...")
-- 如有OCR文本，务必参考其内容进行评价
-
-【输出格式 - 必须严格遵守，不要添加任何其他内容】
-准确性: [0-3]
-完整性: [0-3]
-清晰性: [0-3]
-实用性: [0-3]
-总分: [0-12]
-评语: [80字以上的具体评语]
-
-【格式示例】
-准确性: 2
-完整性: 1
-清晰性: 2
-实用性: 3
-总分: 8
-评语: 该答案准确地指出了OCR文本中的关键词"design"，但完整性不足，遗漏了对"layout"的分析。表达基本清晰。实用性较好，提供了可行的改进方向。建议补充对"color harmony"的讨论，并提供具体的设计工具或参考资源。"""
+{answer}"""
+        return CRITIQUE_RUBRIC, task
 
     def _build_retry_prompt(
         self,
-        question: str,
-        target: str,
-        answer: str,
+        task: str,
         previous_output: str,
         missing_fields: List[str],
         attempt: int
@@ -332,7 +646,6 @@ class Orchestrator:
         }
 
         missing_display = "、".join(missing_map.get(field, field) for field in missing_fields)
-        base_prompt = self._build_critique_prompt(question, target, answer, db.get_active_prompt())
 
         retry_instruction = (
             f"⚠️ 第 {attempt} 次尝试：你之前的回答缺少以下字段: {missing_display}。"
@@ -341,9 +654,9 @@ class Orchestrator:
         )
 
         return (
-            f"{retry_instruction}\n\n"
+            f"{task}\n\n"
             f"供你参考的上一轮回答如下（仅供纠正，切勿照搬）：\n{previous_output}\n\n"
-            f"以下是需要重新评审的任务说明：\n{base_prompt}"
+            f"{retry_instruction}"
         )
     
     def _build_revision_prompt(self, original: str, critiques: List[Dict], prompt_template: Optional[Dict] = None) -> str:
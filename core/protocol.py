@@ -0,0 +1,237 @@
+"""Compact event protocol (version 2) for the /api/process stream.
+
+Protocol 1 is the orchestrator's native event stream: every
+``critique_complete`` carries the critique twice (``critique_text`` and
+``critique_data.raw_text``) and ``final_result`` repeats every answer and
+critique already streamed. Clients that ask for ``protocol: 2`` get the
+same run with each payload sent once:
+
+* every event except ``answer_delta`` carries an integer ``id``; the first
+  event is ``{"type": "protocol", "version": 2, "verbosity": ...}``;
+* ``initial_answer_complete`` drops ``answer`` and sets
+  ``answer_from_deltas`` when the streamed deltas already spelled it out;
+* ``critique_complete`` drops ``critique_text`` and points at the critiqued
+  answer with ``target_ref``;
+* ``revision_complete`` carries ``base_ref`` (the event holding the model's
+  previous answer) and ``diff``, a list whose items are either literal
+  strings or ``[start, end]`` ranges of the base text, counted in UTF-16
+  code units so that ``base.slice(start, end)`` works in JavaScript. The
+  full ``revised_answer`` is sent instead when a diff would not be smaller;
+* ``final_result`` replaces texts with ``best_ref``, ``initial_ref``,
+  ``revised_ref``, ``critique_refs`` and ``round_refs`` wherever the text
+  is byte-identical to an earlier event.
+
+``verbosity`` trims further: ``summary`` keeps progress, scores and the
+best answer but no answer or critique bodies, ``final_only`` sends only
+``final_result`` (best answer and scores) and errors. ``full`` is the
+default.
+"""
+from __future__ import annotations
+
+import difflib
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+__all__ = ["PROTOCOL_VERSIONS", "VERBOSITY_LEVELS", "EventCompactor", "compact_events", "text_diff"]
+
+PROTOCOL_VERSIONS = (1, 2)
+VERBOSITY_LEVELS = ("final_only", "summary", "full")
+
+# summary 模式下不转发的事件：答案正文的增量与工具进度
+_SUMMARY_SKIPPED = frozenset({"answer_delta", "tool_call_started", "tool_call_finished"})
+_FINAL_ONLY_KEPT = frozenset({"final_result", "error"})
+_SCORE_FIELDS = ("score", "accuracy", "completeness", "clarity", "usefulness", "missing_fields", "error", "penalty_reason")
+# diff 至少要比全文小这么多才值得发送
+_DIFF_MAX_RATIO = 0.9
+
+DiffOp = Union[str, List[int]]
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def text_diff(base: str, revised: str) -> List[DiffOp]:
+    """Line-level diff of ``revised`` against ``base`` as copy ranges and literals."""
+    base_lines = base.splitlines(keepends=True)
+    revised_lines = revised.splitlines(keepends=True)
+    offsets = [0]
+    for line in base_lines:
+        offsets.append(offsets[-1] + _utf16_len(line))
+
+    ops: List[DiffOp] = []
+    matcher = difflib.SequenceMatcher(None, base_lines, revised_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([offsets[i1], offsets[i2]])
+        elif tag in ("replace", "insert"):
+            literal = "".join(revised_lines[j1:j2])
+            if ops and isinstance(ops[-1], str):
+                ops[-1] += literal
+            else:
+                ops.append(literal)
+    return ops
+
+
+def _diff_size(ops: List[DiffOp]) -> int:
+    return sum(len(op) if isinstance(op, str) else 12 for op in ops)
+
+
+class EventCompactor:
+    """Rewrites protocol 1 events of one run into protocol 2 events."""
+
+    def __init__(self, verbosity: str = "full") -> None:
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"unknown verbosity: {verbosity}")
+        self.verbosity = verbosity
+        self._next_id = 1
+        self._texts: Dict[int, str] = {}
+        self._latest_answer: Dict[str, int] = {}
+        self._initial_answer: Dict[str, int] = {}
+        self._deltas: Dict[str, List[str]] = {}
+        self._critique_refs: Dict[Tuple[Any, Any], int] = {}
+        self._round_refs: List[int] = []
+
+    def hello(self) -> Dict[str, Any]:
+        return {"type": "protocol", "id": 0, "version": 2, "verbosity": self.verbosity}
+
+    def _ref_for(self, model_name: str, text: Any) -> Optional[int]:
+        ref = self._latest_answer.get(model_name)
+        if ref is not None and self._texts.get(ref) == text:
+            return ref
+        return None
+
+    def compact(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The protocol 2 form of ``event``, or None if this verbosity drops it."""
+        event_type = event.get("type")
+        if self.verbosity == "final_only" and event_type not in _FINAL_ONLY_KEPT:
+            return None
+        if event_type == "answer_delta":
+            if self.verbosity != "full":
+                return None
+            self._deltas.setdefault(event.get("model_name"), []).append(event.get("delta") or "")
+            return event
+        if self.verbosity == "summary" and event_type in _SUMMARY_SKIPPED:
+            return None
+
+        event_id = self._next_id
+        self._next_id += 1
+        handler = getattr(self, f"_compact_{event_type}", None)
+        compacted = handler(event_id, event) if handler else dict(event)
+        compacted["id"] = event_id
+        return compacted
+
+    def _remember_answer(self, event_id: int, model_name: str, text: str) -> None:
+        self._texts[event_id] = text
+        self._latest_answer[model_name] = event_id
+
+    def _compact_initial_answer_complete(self, event_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+        model_name, answer = event.get("model_name"), event.get("answer") or ""
+        self._remember_answer(event_id, model_name, answer)
+        self._initial_answer[model_name] = event_id
+        compacted = {"type": event["type"], "model_name": model_name, "length": len(answer)}
+        if self.verbosity == "full":
+            if "".join(self._deltas.pop(model_name, [])) == answer:
+                compacted["answer_from_deltas"] = True
+            else:
+                compacted["answer"] = answer
+        return compacted
+
+    def _compact_critique_complete(self, event_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+        data = event.get("critique_data") or {}
+        critic, target = event.get("critic_name"), event.get("target_model")
+        self._critique_refs[(critic, target)] = event_id
+        compacted = {key: value for key, value in event.items() if key not in ("critique_text", "critique_data")}
+        if self.verbosity == "full":
+            compacted["critique_data"] = {key: value for key, value in data.items() if key != "critic_name"}
+            target_ref = self._latest_answer.get(target)
+            if target_ref is not None:
+                compacted["target_ref"] = target_ref
+        else:
+            compacted["critique_data"] = {key: data[key] for key in _SCORE_FIELDS if key in data}
+        return compacted
+
+    def _compact_revision_complete(self, event_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+        model_name, revised = event.get("model_name"), event.get("revised_answer") or ""
+        base_ref = self._latest_answer.get(model_name)
+        self._remember_answer(event_id, model_name, revised)
+        compacted = {key: value for key, value in event.items() if key != "revised_answer"}
+        compacted["length"] = len(revised)
+        if self.verbosity != "full":
+            return compacted
+        if base_ref is not None:
+            ops = text_diff(self._texts[base_ref], revised)
+            if _diff_size(ops) < len(revised) * _DIFF_MAX_RATIO:
+                compacted["base_ref"] = base_ref
+                compacted["diff"] = ops
+                return compacted
+        compacted["revised_answer"] = revised
+        return compacted
+
+    def _compact_round_complete(self, event_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+        self._round_refs.append(event_id)
+        return dict(event)
+
+    def _compact_final_result(self, event_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+        data = dict(event.get("data") or {})
+        details = data.pop("process_details", []) or []
+        best_answer = data.pop("best_answer", "")
+        if self.verbosity != "full":
+            data.pop("rounds", None)
+            data["best_answer"] = best_answer
+            data["process_details"] = [
+                {key: value for key, value in item.items() if key not in ("initial_answer", "revised_answer", "critiques_received")}
+                for item in details
+            ]
+            return {"type": event["type"], "data": data}
+
+        best_ref = self._ref_for(details[0].get("model_name"), best_answer) if details else None
+        if best_ref is not None:
+            data["best_ref"] = best_ref
+        else:
+            data["best_answer"] = best_answer
+
+        compact_details = []
+        for item in details:
+            model_name = item.get("model_name")
+            compact = {key: value for key, value in item.items() if key not in ("initial_answer", "revised_answer", "critiques_received")}
+            initial_ref = self._initial_ref(model_name, item.get("initial_answer"))
+            revised_ref = self._ref_for(model_name, item.get("revised_answer"))
+            if initial_ref is not None:
+                compact["initial_ref"] = initial_ref
+            else:
+                compact["initial_answer"] = item.get("initial_answer", "")
+            if revised_ref is not None:
+                compact["revised_ref"] = revised_ref
+            else:
+                compact["revised_answer"] = item.get("revised_answer", "")
+
+            refs, inline = [], []
+            for critique in item.get("critiques_received", []):
+                ref = self._critique_refs.get((critique.get("critic_name"), model_name))
+                (refs if ref is not None else inline).append(ref if ref is not None else critique)
+            compact["critique_refs"] = refs
+            if inline:
+                compact["critiques_received"] = inline
+            compact_details.append(compact)
+        data["process_details"] = compact_details
+
+        if self._round_refs and len(data.get("rounds") or []) == len(self._round_refs):
+            data.pop("rounds")
+            data["round_refs"] = list(self._round_refs)
+        return {"type": event["type"], "data": data}
+
+    def _initial_ref(self, model_name: str, text: Any) -> Optional[int]:
+        ref = self._initial_answer.get(model_name)
+        if ref is not None and self._texts.get(ref) == text:
+            return ref
+        return None
+
+
+async def compact_events(events: AsyncIterator[Dict[str, Any]], verbosity: str = "full") -> AsyncGenerator[Dict[str, Any], None]:
+    """Wrap a protocol 1 event stream as protocol 2."""
+    compactor = EventCompactor(verbosity)
+    yield compactor.hello()
+    async for event in events:
+        compacted = compactor.compact(event)
+        if compacted is not None:
+            yield compacted
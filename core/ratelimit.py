@@ -0,0 +1,353 @@
+"""Per-client rate limiting and fair queuing for the expensive endpoints.
+
+Requests to ``/api/process`` (and session turns, and runs started over
+``/api/ws``), ``/api/ocr`` and ``/api/search`` are identified by client: the API token from
+``Authorization: Bearer`` / ``X-API-Key`` when present, otherwise the client
+IP. Two mechanisms apply to them:
+
+* A token bucket per client and endpoint class. It refills at
+  ``<class>_per_minute`` tokens a minute and holds at most as many. A
+  ``/api/process`` request costs one token per selected model; everything
+  else costs one. An empty bucket answers 429 with ``Retry-After``. Buckets
+  live in memory, or in ``providers.db`` with ``RATE_LIMIT_STORE=sqlite`` so
+  that all worker processes on the host share them.
+* A fair queue per endpoint class (in-process) capping how many requests
+  run at once. When a slot frees up it goes to the waiting client with the
+  fewest requests running, and among those to the one served longest ago,
+  so a batch client with many queued requests cannot starve an interactive
+  one.
+
+There is no authentication, so the token is only an identity hint; a client
+that rotates tokens gets fresh buckets.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+import core.database as db
+from core.config import RateLimitConfig, get_config
+from core.logging import get_logger
+
+__all__ = [
+    "FairQueue", "QueueTimeout", "RateLimitMiddleware", "RateLimiter",
+    "client_key", "endpoint_class", "get_rate_limiter",
+]
+
+logger = get_logger(__name__)
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+_ENDPOINT_CLASSES: List[Tuple["re.Pattern[str]", str]] = [
+    (re.compile(r"^/api/(?:process|sessions/[^/]+/process)$"), "process"),
+    (re.compile(r"^/api/ocr$"), "ocr"),
+    (re.compile(r"^/api/search(?:/ai-summary)?$"), "search"),
+]
+# 每扣减这么多次清理一次闲置的令牌桶
+_PRUNE_EVERY = 1000
+# 容量等于每分钟令牌数，空桶一分钟即回满；闲置更久的桶与不存在等价
+_REFILL_SECONDS = 60.0
+# 只为计算模型数而读取的请求体上限，超过的按 1 个模型计费，交给路由返回校验错误
+_MAX_BUFFERED_BODY = 1 << 20
+
+
+class QueueTimeout(Exception):
+    """A request waited longer than FAIR_QUEUE_TIMEOUT_SECONDS for a slot."""
+
+
+def endpoint_class(path: str) -> Optional[str]:
+    for pattern, name in _ENDPOINT_CLASSES:
+        if pattern.match(path):
+            return name
+    return None
+
+
+def client_key(scope: Scope, trust_proxy: bool = False) -> str:
+    """Identity of the caller of an HTTP or WebSocket scope."""
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers") or []}
+    token = headers.get("x-api-key", "").strip()
+    authorization = headers.get("authorization", "")
+    if not token and authorization[:7].lower() == "bearer ":
+        token = authorization[7:].strip()
+    if token:
+        return "token:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+    forwarded = headers.get("x-forwarded-for", "")
+    if trust_proxy and forwarded:
+        return "ip:" + forwarded.split(",")[0].strip()
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class _MemoryBuckets:
+    def __init__(self) -> None:
+        # key -> (剩余令牌, 上次更新时间)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+        self._buckets[key] = (tokens - cost, now)
+        return 0.0
+
+    async def prune(self, idle_seconds: float) -> int:
+        cutoff = time.monotonic() - idle_seconds
+        stale = [key for key, (_, updated) in self._buckets.items() if updated < cutoff]
+        for key in stale:
+            del self._buckets[key]
+        return len(stale)
+
+
+class _SQLiteBuckets:
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        return await db.take_rate_limit_tokens_async(key, cost, capacity, rate)
+
+    async def prune(self, idle_seconds: float) -> int:
+        return await db.prune_rate_limit_buckets_async(idle_seconds)
+
+
+class FairQueue:
+    """Concurrency cap whose free slots go to the least busy, least recently served waiting client."""
+
+    def __init__(self, concurrency: int, timeout: float) -> None:
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.running = 0
+        self._running: Dict[str, int] = {}
+        self._waiting: Dict[str, Deque[Tuple[int, asyncio.Future]]] = {}
+        # 客户端最近一次获得名额的序号；没有运行也没有排队的客户端不记录，回来时优先
+        self._served: Dict[str, int] = {}
+        self._arrivals = itertools.count()
+        self._grants = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    @asynccontextmanager
+    async def slot(self, client: str) -> AsyncIterator[None]:
+        await self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release(client)
+
+    async def acquire(self, client: str) -> None:
+        if self.concurrency <= 0:
+            return
+        if self.running < self.concurrency and not self._waiting:
+            self._grant(client)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(client, deque()).append((next(self._arrivals), future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 在超时 / 取消的同时拿到了名额，还回去
+                self.release(client)
+            else:
+                future.cancel()
+                self._forget(client, future)
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueTimeout(client) from None
+            raise
+
+    def release(self, client: str) -> None:
+        if self.concurrency <= 0:
+            return
+        self.running -= 1
+        self._running[client] -= 1
+        if not self._running[client]:
+            del self._running[client]
+            if client not in self._waiting:
+                self._served.pop(client, None)
+        self._dispatch()
+
+    def _grant(self, client: str) -> None:
+        self.running += 1
+        self._running[client] = self._running.get(client, 0) + 1
+        self._served[client] = next(self._grants)
+
+    def _forget(self, client: str, future: asyncio.Future) -> None:
+        waiters = self._waiting.get(client)
+        if waiters is None:
+            return
+        for item in list(waiters):
+            if item[1] is future:
+                waiters.remove(item)
+        if not waiters:
+            del self._waiting[client]
+            if client not in self._running:
+                self._served.pop(client, None)
+
+    def _dispatch(self) -> None:
+        while self.running < self.concurrency and self._waiting:
+            # 运行中请求最少的客户端优先，其次是最久没有获得名额的
+            client = min(
+                self._waiting,
+                key=lambda name: (self._running.get(name, 0), self._served.get(name, -1), self._waiting[name][0][0])
+            )
+            _, future = self._waiting[client].popleft()
+            if not self._waiting[client]:
+                del self._waiting[client]
+            if future.done():
+                continue
+            self._grant(client)
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": self.running, "waiting": self.waiting, "clients": len(self._running)}
+
+
+class RateLimiter:
+    """Token buckets and fair queues for each endpoint class."""
+
+    def __init__(self, config: RateLimitConfig) -> None:
+        self.trust_proxy = config.trust_proxy
+        self.per_minute = {
+            "process": config.process_per_minute,
+            "ocr": config.ocr_per_minute,
+            "search": config.search_per_minute,
+        }
+        self.queues = {name: FairQueue(config.queue_concurrency, config.queue_timeout_seconds) for name in self.per_minute}
+        self._buckets = _SQLiteBuckets() if config.store == "sqlite" else _MemoryBuckets()
+        self._takes = 0
+        self.rejected = {name: 0 for name in self.per_minute}
+        self.timed_out = {name: 0 for name in self.per_minute}
+
+    async def take(self, client: str, endpoint: str, cost: float = 1.0) -> float:
+        """Charge ``cost`` to the client's bucket; 0 if allowed, else seconds until it would be."""
+        per_minute = self.per_minute[endpoint]
+        if per_minute <= 0:
+            return 0.0
+        rate = per_minute / _REFILL_SECONDS
+        self._takes += 1
+        if self._takes % _PRUNE_EVERY == 0:
+            await self._buckets.prune(_REFILL_SECONDS)
+        # 单次请求的开销不超过桶容量，否则永远无法放行
+        wait = await self._buckets.take(f"{endpoint}:{client}", min(cost, per_minute), per_minute, rate)
+        if wait:
+            self.rejected[endpoint] += 1
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "per_minute": self.per_minute[name],
+                "rejected": self.rejected[name],
+                "queue_timeouts": self.timed_out[name],
+                **self.queues[name].stats(),
+            }
+            for name in self.per_minute
+        }
+
+
+def _selected_model_count(body: bytes) -> int:
+    try:
+        models = json.loads(body).get("selected_models")
+    except (ValueError, AttributeError):
+        return 1
+    return max(1, len(models)) if isinstance(models, list) else 1
+
+
+async def _buffer_body(receive: Receive) -> Tuple[bytes, Receive]:
+    """Read the request body and return it with a ``receive`` that replays it."""
+    chunks: List[bytes] = []
+    size = 0
+    messages: List[Message] = []
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        size += len(chunks[-1])
+        if not message.get("more_body") or size > _MAX_BUFFERED_BODY:
+            break
+    pending = deque(messages)
+
+    async def replay() -> Message:
+        if pending:
+            return pending.popleft()
+        return await receive()
+
+    return b"".join(chunks) if size <= _MAX_BUFFERED_BODY else b"", replay
+
+
+def _retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class RateLimitMiddleware:
+    """ASGI middleware applying ``RateLimiter`` to POSTs on the expensive endpoints."""
+
+    def __init__(self, app: Callable[[Scope, Receive, Send], Awaitable[None]]) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        endpoint = endpoint_class(scope.get("path", "")) if scope["type"] == "http" and scope.get("method") == "POST" else None
+        limiter = get_rate_limiter() if endpoint else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        client = client_key(scope, limiter.trust_proxy)
+        cost = 1
+        if endpoint == "process":
+            body, receive = await _buffer_body(receive)
+            cost = _selected_model_count(body)
+        wait = await limiter.take(client, endpoint, cost)
+        if wait:
+            response = JSONResponse(
+                {"detail": f"请求过于频繁，请在 {_retry_after(wait)} 秒后重试"},
+                status_code=429,
+                headers={"Retry-After": _retry_after(wait)}
+            )
+            await response(scope, receive, send)
+            return
+
+        queue = limiter.queues[endpoint]
+        try:
+            async with queue.slot(client):
+                await self.app(scope, receive, send)
+        except QueueTimeout:
+            limiter.timed_out[endpoint] += 1
+            response = JSONResponse(
+                {"detail": "服务繁忙，请稍后重试"},
+                status_code=503,
+                headers={"Retry-After": _retry_after(queue.timeout / 4)}
+            )
+            await response(scope, receive, send)
+
+
+_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """The process-wide limiter, or None when RATE_LIMIT_ENABLED is off."""
+    global _limiter
+    config = get_config().rate_limit
+    if not config.enabled:
+        return None
+    if _limiter is None:
+        _limiter = RateLimiter(config)
+        logger.info(f"限流已启用（{config.store}）：{_limiter.per_minute}，每类并发 {config.queue_concurrency}")
+    return _limiter
@@ -0,0 +1,437 @@
+"""Provider resilience: retry with backoff, shared provider health, breakers.
+
+A 429 or 5xx from a provider is usually transient. ``call_with_retry``
+retries such errors with jittered exponential backoff, honoring
+``Retry-After`` when the provider sends it. The backoff window is stored in
+a ``ProviderHealth`` shared by every concurrent run, so one throttling
+response slows every caller of that provider instead of each caller
+hammering it on its own schedule.
+
+A provider that is actually down is handled by a ``CircuitBreaker`` per
+``provider::model``: once errors or slow calls dominate its recent window it
+opens and callers fail fast until a half-open trial call succeeds.
+
+Tail latency is handled by hedging: ``LatencyTracker`` keeps an EWMA of
+each endpoint's latency, and ``hedged_call`` fires a backup request at an
+equivalent endpoint once the primary exceeds its estimated p95, keeping
+whichever answers first.
+"""
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import math
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import openai
+
+from core.config import get_config
+from core.exceptions import CircuitOpenError
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """HTTP status of an SDK error (OpenAI: status_code, google-api-core: code)."""
+    for attr in ("status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """429, 5xx, timeouts and connection failures are worth retrying."""
+    if isinstance(exc, (openai.APIConnectionError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = _status_code(exc)
+    return status is not None and (status == 429 or 500 <= status < 600)
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Parse ``retry-after-ms`` / ``Retry-After`` (seconds or HTTP date) from an error."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_ms = headers.get("retry-after-ms")
+    if retry_ms:
+        try:
+            return max(0.0, float(retry_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+class ProviderHealth:
+    """Backoff window shared by every caller of one provider."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.blocked_until = 0.0
+        self.consecutive_failures = 0
+        self.retries = 0
+
+    async def wait_turn(self) -> None:
+        """Sleep until the provider's shared backoff window has passed."""
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_failure(self, retry_after: Optional[float]) -> float:
+        """Widen the shared backoff window and return this caller's delay."""
+        cfg = get_config().retry
+        self.consecutive_failures += 1
+        self.retries += 1
+        if retry_after is not None:
+            delay = min(retry_after, cfg.max_delay)
+        else:
+            ceiling = min(cfg.max_delay, cfg.base_delay * (2 ** (self.consecutive_failures - 1)))
+            delay = random.uniform(ceiling / 2, ceiling)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return self.blocked_until - time.monotonic()
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backoff_remaining": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            "consecutive_failures": self.consecutive_failures,
+            "retries": self.retries,
+        }
+
+
+_provider_health: Dict[str, ProviderHealth] = {}
+
+
+def get_provider_health(provider: str) -> ProviderHealth:
+    health = _provider_health.get(provider)
+    if health is None:
+        health = ProviderHealth(provider)
+        _provider_health[provider] = health
+    return health
+
+
+def provider_health_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: health.stats() for name, health in _provider_health.items()}
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a sliding window of outcomes.
+
+    A call counts as bad when it raises. With ``slow_call_seconds`` > 0 a
+    call taking longer than that counts as bad too; this is off by default
+    because non-streaming critique and revision calls routinely run past a
+    minute on healthy providers. The breaker opens once at least
+    ``min_calls`` outcomes are recorded and the bad ratio reaches
+    ``failure_rate``. After
+    ``cooldown`` seconds one trial call is let through (half-open); its
+    outcome closes or re-opens the breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str) -> None:
+        cfg = get_config().breaker
+        self.name = name
+        self.min_calls = cfg.min_calls
+        self.failure_rate = cfg.failure_rate
+        self.slow_call_seconds = cfg.slow_call_seconds
+        self.cooldown = cfg.cooldown
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._outcomes: "deque[bool]" = deque(maxlen=max(1, cfg.window))
+        self._trial_in_flight = False
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker admits a trial call."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def is_open(self) -> bool:
+        """True while callers should not even try this model."""
+        return self.state == self.OPEN and self.retry_in() > 0
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        slow = self.slow_call_seconds > 0 and latency is not None and latency > self.slow_call_seconds
+        good = ok and not slow
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = False
+            if good:
+                logger.info(f"熔断器 {self.name} 试探成功，恢复闭合")
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+        self._outcomes.append(good)
+        bad = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and bad / len(self._outcomes) >= self.failure_rate:
+            self._open()
+
+    def abandon(self) -> None:
+        """A call was cancelled by us, not failed by the provider: record nothing."""
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = False
+
+    def _open(self) -> None:
+        if self.state != self.OPEN:
+            logger.warning(f"熔断器 {self.name} 打开，{self.cooldown:g} 秒内直接跳过该模型")
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "retry_in": round(self.retry_in(), 2),
+            "recent_calls": len(self._outcomes),
+            "recent_failures": self._outcomes.count(False),
+        }
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Breaker for one ``provider::model``."""
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(name)
+        _circuit_breakers[name] = breaker
+    return breaker
+
+
+def circuit_breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: breaker.stats() for name, breaker in _circuit_breakers.items()}
+
+
+class LatencyTracker:
+    """Exponentially weighted mean and variance of one endpoint's latency."""
+
+    # p95 of a normal distribution sits 1.645 standard deviations above the mean
+    P95_Z = 1.645
+
+    def __init__(self, name: str, alpha: float = 0.2) -> None:
+        self.name = name
+        self.alpha = alpha
+        self.mean = 0.0
+        self.variance = 0.0
+        self.samples = 0
+
+    def record(self, latency: float) -> None:
+        self.samples += 1
+        if self.samples == 1:
+            self.mean = latency
+            return
+        diff = latency - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+
+    def p95(self) -> Optional[float]:
+        """Estimated p95, or None until enough samples were seen."""
+        if self.samples < get_config().hedge.min_samples:
+            return None
+        return self.mean + self.P95_Z * math.sqrt(self.variance)
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "mean": round(self.mean, 3),
+            "p95": round(p95, 3) if p95 is not None else None,
+            "samples": self.samples,
+        }
+
+
+_latency_trackers: Dict[str, LatencyTracker] = {}
+
+
+def get_latency_tracker(name: str) -> LatencyTracker:
+    tracker = _latency_trackers.get(name)
+    if tracker is None:
+        tracker = LatencyTracker(name)
+        _latency_trackers[name] = tracker
+    return tracker
+
+
+def latency_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: tracker.stats() for name, tracker in _latency_trackers.items()}
+
+
+async def guarded_call(
+    breaker: CircuitBreaker,
+    make_call: Callable[[], Awaitable[T]],
+    latency: Optional[LatencyTracker] = None,
+) -> T:
+    """Run one attempt through ``breaker``, recording its outcome and latency."""
+    if not breaker.allow_request():
+        raise CircuitOpenError(breaker.name, breaker.retry_in())
+    started = time.monotonic()
+    try:
+        result = await make_call()
+    except asyncio.CancelledError:
+        breaker.abandon()
+        raise
+    except Exception:
+        breaker.record(False)
+        raise
+    elapsed = time.monotonic() - started
+    breaker.record(True, elapsed)
+    if latency is not None:
+        latency.record(elapsed)
+    return result
+
+
+async def _discard(task: "asyncio.Future[Any]") -> None:
+    """Close the result of a hedge that lost the race (e.g. an open stream)."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is None:
+        return
+    try:
+        closed = close()
+        if asyncio.iscoroutine(closed):
+            await closed
+    except Exception:  # pragma: no cover - best effort cleanup
+        logger.debug("Failed to close losing hedge result", exc_info=True)
+
+
+async def hedged_call(
+    primary: Callable[[], Awaitable[T]],
+    backup: Callable[[], Awaitable[T]],
+    hedge_after: float,
+    on_hedge: Optional[Callable[[], None]] = None,
+) -> T:
+    """Start ``primary``; if it is still running after ``hedge_after`` seconds
+    start ``backup`` too and return whichever succeeds first.
+
+    The loser is cancelled. If one side fails the other is still awaited, so
+    a hedge can only improve on the primary alone.
+    """
+    primary_task = asyncio.ensure_future(primary())
+    tasks = [primary_task]
+    errors: List[BaseException] = []
+    try:
+        done, _ = await asyncio.wait({primary_task}, timeout=hedge_after)
+        if done:
+            return primary_task.result()
+
+        if on_hedge is not None:
+            on_hedge()
+        tasks.append(asyncio.ensure_future(backup()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                winner = primary_task if primary_task in winners else winners[0]
+                for task in done:
+                    if task is not winner:
+                        await _discard(task)
+                return winner.result()
+            errors.extend(task.exception() for task in done)
+        raise errors[0]
+    finally:
+        # Also reached when the caller is cancelled mid-wait: nothing may keep
+        # running (or hold an upstream stream open) after we return.
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+            for task in unfinished:
+                await _discard(task)
+
+
+async def call_with_retry(
+    provider: str,
+    make_call: Callable[[], Awaitable[T]],
+    model_name: str = "",
+    on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> T:
+    """Await ``make_call()``, retrying retryable errors with shared backoff.
+
+    ``on_event`` receives a ``status`` event before every retry so the SSE
+    stream shows why a model is taking longer.
+    """
+    health = get_provider_health(provider)
+    max_attempts = max(1, get_config().retry.max_attempts)
+    attempt = 0
+    while True:
+        attempt += 1
+        await health.wait_turn()
+        try:
+            result = await make_call()
+        except Exception as exc:
+            if attempt >= max_attempts or not is_retryable(exc):
+                raise
+            status = _status_code(exc)
+            delay = health.record_failure(retry_after_seconds(exc))
+            reason = f"HTTP {status}" if status else type(exc).__name__
+            logger.warning(
+                f"{model_name or provider} 调用失败 ({reason})，{delay:.1f} 秒后第 {attempt} 次重试"
+            )
+            if on_event is not None:
+                on_event({
+                    "type": "status",
+                    "data": f"{model_name or provider} 遇到 {reason}，{delay:.1f} 秒后重试（第 {attempt} 次）...",
+                    "model_name": model_name,
+                    "retry": {"attempt": attempt, "delay": round(delay, 2), "reason": reason},
+                })
+            continue
+        health.record_success()
+        return result
+
+
+__all__ = [
+    "CircuitBreaker",
+    "LatencyTracker",
+    "ProviderHealth",
+    "call_with_retry",
+    "circuit_breaker_stats",
+    "get_circuit_breaker",
+    "get_latency_tracker",
+    "get_provider_health",
+    "guarded_call",
+    "hedged_call",
+    "latency_stats",
+    "is_retryable",
+    "provider_health_stats",
+    "retry_after_seconds",
+]
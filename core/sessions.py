@@ -0,0 +1,114 @@
+"""Server-side conversation sessions.
+
+Clients create a session once and then send only the new question; the
+conversation lives in SQLite (``sessions`` / ``session_messages``) and the
+recently used sessions are kept in a bounded in-memory LRU so a turn does
+not have to reload its history. Only the last ``max_history_messages``
+messages are handed to the models. Sessions idle for longer than
+``idle_hours`` are deleted by a background job.
+"""
+from __future__ import annotations
+
+import asyncio
+import secrets
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import core.database as db
+from core.config import get_config
+from core.logging import get_logger
+
+__all__ = ["SessionStore", "get_session_store", "run_session_eviction_job"]
+
+logger = get_logger(__name__)
+
+Message = Dict[str, str]
+
+
+class SessionStore:
+    """LRU cache of session histories in front of the SQLite session tables."""
+
+    def __init__(self, capacity: int, max_history_messages: int) -> None:
+        self.capacity = max(1, capacity)
+        self.max_history_messages = max(1, max_history_messages)
+        # 会话 id -> 最近的 max_history_messages 条消息；数据库是唯一的事实来源
+        self._cache: "OrderedDict[str, List[Message]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, session_id: str, messages: List[Message]) -> None:
+        self._cache[session_id] = messages[-self.max_history_messages:]
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    async def create(self, messages: Optional[List[Message]] = None) -> str:
+        session_id = secrets.token_urlsafe(16)
+        await db.create_session_async(session_id, messages or [])
+        self._remember(session_id, list(messages or []))
+        return session_id
+
+    async def history(self, session_id: str) -> Optional[List[Message]]:
+        """The messages to send along with the next turn, or None for an unknown session."""
+        messages = self._cache.get(session_id)
+        if messages is not None:
+            self.hits += 1
+            self._cache.move_to_end(session_id)
+            return list(messages)
+        self.misses += 1
+        messages = await db.get_session_messages_async(session_id)
+        if messages is None:
+            return None
+        self._remember(session_id, messages)
+        return list(self._cache[session_id])
+
+    async def append(self, session_id: str, messages: List[Message]) -> bool:
+        if not await db.append_session_messages_async(session_id, messages):
+            self._cache.pop(session_id, None)
+            return False
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            self._remember(session_id, cached + messages)
+        return True
+
+    async def delete(self, session_id: str) -> bool:
+        self._cache.pop(session_id, None)
+        return await db.delete_sessions_async([session_id]) > 0
+
+    async def evict_stale(self, idle_hours: float) -> int:
+        """Delete sessions idle for longer than ``idle_hours``; returns how many."""
+        deleted = 0
+        while True:
+            session_ids = await db.stale_session_ids_async(idle_hours)
+            if not session_ids:
+                return deleted
+            for session_id in session_ids:
+                self._cache.pop(session_id, None)
+            deleted += await db.delete_sessions_async(session_ids)
+
+    def stats(self) -> Dict[str, int]:
+        return {"cached": len(self._cache), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+_store: Optional[SessionStore] = None
+
+
+def get_session_store() -> SessionStore:
+    global _store
+    if _store is None:
+        config = get_config().session
+        _store = SessionStore(config.cache_size, config.max_history_messages)
+    return _store
+
+
+async def run_session_eviction_job() -> None:
+    """Background task: drop sessions idle for longer than SESSION_IDLE_HOURS, once an hour."""
+    idle_hours = get_config().session.idle_hours
+    while True:
+        try:
+            deleted = await get_session_store().evict_stale(idle_hours)
+            if deleted:
+                logger.info(f"已清理 {deleted} 个闲置超过 {idle_hours:g} 小时的会话")
+        except Exception as e:
+            logger.error(f"清理闲置会话失败: {e}")
+        await asyncio.sleep(min(3600.0, idle_hours * 3600 / 4))
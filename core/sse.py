@@ -0,0 +1,341 @@
+"""Server-Sent Events writer for the /api/process stream.
+
+Events are serialized once with the fastest available JSON encoder (orjson
+when installed, otherwise a pre-built stdlib encoder) and written as
+``data:`` lines. Delta events (token pieces of a streamed answer) are
+coalesced: consecutive pieces for the same model are merged and flushed as
+one frame per ``flush_interval`` or once ``max_frame_bytes`` are buffered,
+so a fast model produces a few dozen writes per second instead of one per
+token. Any other event flushes the pending deltas and goes out immediately.
+Idle streams get a comment line every ``heartbeat_interval`` seconds so
+proxies do not close them.
+
+The run is decoupled from the socket by a bounded per-connection
+``EventQueue``: a pump task drains the run as fast as it produces, so a
+slow client never stalls the model pipeline. When the queue is full it
+first merges queued deltas, then drops intermediate status events, and
+only then gives up on the client. Per-connection queue depth and lag are
+reported by ``sse_stats()``.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Any, AsyncGenerator, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from core.config import get_config
+from core.logging import get_logger
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+__all__ = [
+    "DELTA_EVENT_TYPES",
+    "DROPPABLE_EVENT_TYPES",
+    "HEARTBEAT",
+    "ConnectionStats",
+    "EventQueue",
+    "SSEWriter",
+    "close_connection_stats",
+    "encode_event",
+    "encode_json",
+    "open_connection_stats",
+    "sse_stats",
+]
+
+logger = get_logger(__name__)
+
+# 可合并的增量事件类型：同一模型相邻的 delta 拼接为一个事件
+DELTA_EVENT_TYPES = frozenset({"answer_delta"})
+# 队列积压时可以丢弃的中间进度事件（只保留最新的一条）
+DROPPABLE_EVENT_TYPES = frozenset({"status", "tool_call_started", "tool_call_finished"})
+
+HEARTBEAT = b": keep-alive\n\n"
+
+SLOW_CONSUMER_EVENT = {"type": "error", "reason": "slow_consumer", "data": "客户端接收过慢，连接已断开"}
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_json(event: Dict[str, Any]) -> bytes:
+    """Compact UTF-8 JSON of one event."""
+    if orjson is not None:
+        return orjson.dumps(event, option=orjson.OPT_NON_STR_KEYS)
+    return _json_encoder.encode(event).encode("utf-8")
+
+
+def encode_event(event: Dict[str, Any]) -> bytes:
+    """One SSE message (``data: <json>\\n\\n``) as UTF-8 bytes."""
+    return b"data: " + encode_json(event) + b"\n\n"
+
+
+def _same_stream(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    return a["type"] == b["type"] and a.get("model_name") == b.get("model_name")
+
+
+class ConnectionStats:
+    """Queue depth and event lag of one SSE connection."""
+
+    def __init__(self, connection_id: int, transport: str = "sse") -> None:
+        self.id = connection_id
+        self.transport = transport
+        self.opened_at = time.time()
+        self.events_in = 0
+        self.events_out = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._lag_total = 0.0
+        self.disconnect_reason: Optional[str] = None
+
+    def observe_lag(self, lag: float) -> None:
+        self.events_out += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._lag_total += lag
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "transport": self.transport,
+            "age": round(time.time() - self.opened_at, 1),
+            "events_in": self.events_in,
+            "events_out": self.events_out,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "max_depth": self.max_depth,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "avg_lag_ms": round(self._lag_total / self.events_out * 1000, 1) if self.events_out else 0.0,
+        }
+
+
+_connection_ids = itertools.count(1)
+_active_connections: Dict[int, ConnectionStats] = {}
+_closed_totals = {"connections": 0, "events_out": 0, "coalesced": 0, "dropped": 0, "slow_disconnects": 0, "max_lag_ms": 0.0}
+
+
+def open_connection_stats(transport: str = "sse") -> ConnectionStats:
+    """Register a connection (or WebSocket channel) for ``sse_stats()``."""
+    stats = ConnectionStats(next(_connection_ids), transport)
+    _active_connections[stats.id] = stats
+    return stats
+
+
+def close_connection_stats(stats: ConnectionStats) -> None:
+    _active_connections.pop(stats.id, None)
+    _closed_totals["connections"] += 1
+    _closed_totals["events_out"] += stats.events_out
+    _closed_totals["coalesced"] += stats.coalesced
+    _closed_totals["dropped"] += stats.dropped
+    _closed_totals["max_lag_ms"] = max(_closed_totals["max_lag_ms"], round(stats.max_lag * 1000, 1))
+    if stats.disconnect_reason == "slow_consumer":
+        _closed_totals["slow_disconnects"] += 1
+
+
+def sse_stats() -> Dict[str, Any]:
+    """Open SSE connections and totals of the closed ones, for /api/metrics."""
+    return {
+        "active": [stats.to_dict() for stats in _active_connections.values()],
+        "closed": dict(_closed_totals),
+    }
+
+
+class EventQueue:
+    """Bounded buffer between a run and one SSE connection.
+
+    ``put`` never blocks the producer. When the queue is full it merges all
+    queued deltas per model, then drops every droppable progress event but
+    the newest, and if that still frees no slot it marks the queue
+    overflowed so the writer can disconnect the client.
+    """
+
+    def __init__(self, maxsize: int, stats: ConnectionStats) -> None:
+        self.maxsize = max(1, maxsize)
+        self.stats = stats
+        self._items: Deque[Tuple[float, Dict[str, Any]]] = deque()
+        self._ready = asyncio.Event()
+        self.closed = False
+        self.overflowed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def finished(self) -> bool:
+        return self.overflowed or (self.closed and not self._items)
+
+    def put(self, event: Dict[str, Any]) -> bool:
+        """Enqueue ``event``; False once the client has fallen too far behind."""
+        if self.overflowed:
+            return False
+        self.stats.events_in += 1
+        if event.get("type") in DELTA_EVENT_TYPES:
+            if self._items and _same_stream(self._items[-1][1], event):
+                self._items[-1][1]["delta"] += event.get("delta") or ""
+                self.stats.coalesced += 1
+                return True
+            # 复制一份，后续 delta 会直接拼接到这个字典上
+            event = dict(event, delta=event.get("delta") or "")
+        if len(self._items) >= self.maxsize:
+            self._relieve()
+        if len(self._items) >= self.maxsize:
+            self.overflowed = True
+            self._items.clear()
+            self._ready.set()
+            return False
+        self._items.append((time.monotonic(), event))
+        self.stats.max_depth = max(self.stats.max_depth, len(self._items))
+        self._ready.set()
+        return True
+
+    def _relieve(self) -> None:
+        merged: Deque[Tuple[float, Dict[str, Any]]] = deque()
+        heads: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+        for enqueued_at, event in self._items:
+            if event.get("type") in DELTA_EVENT_TYPES:
+                key = (event["type"], event.get("model_name"))
+                head = heads.get(key)
+                if head is not None:
+                    # 同一模型的 delta 只会出现在它的完成事件之前，并入更早的一条不改变内容顺序
+                    head["delta"] += event["delta"]
+                    self.stats.coalesced += 1
+                    continue
+                heads[key] = event
+            merged.append((enqueued_at, event))
+
+        if len(merged) >= self.maxsize:
+            droppable = [index for index, (_, event) in enumerate(merged) if event.get("type") in DROPPABLE_EVENT_TYPES]
+            drop = set(droppable[:-1])
+            if drop:
+                merged = deque(item for index, item in enumerate(merged) if index not in drop)
+                self.stats.dropped += len(drop)
+        self._items = merged
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Next event, or None on timeout and once the queue is finished."""
+        if not self._items and not self.finished:
+            self._ready.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._ready.wait(), timeout)
+        if self.overflowed or not self._items:
+            return None
+        enqueued_at, event = self._items.popleft()
+        self.stats.observe_lag(time.monotonic() - enqueued_at)
+        return event
+
+
+class SSEWriter:
+    """Turns an async iterator of event dicts into SSE byte frames."""
+
+    def __init__(
+        self,
+        flush_interval: float = 0.03,
+        max_frame_bytes: int = 16384,
+        heartbeat_interval: float = 15.0,
+        queue_size: int = 256,
+    ) -> None:
+        self.flush_interval = max(0.0, flush_interval)
+        self.max_frame_bytes = max(1, max_frame_bytes)
+        self.heartbeat_interval = heartbeat_interval
+        self.queue_size = queue_size
+        self._pending: List[Dict[str, Any]] = []
+        self._pending_bytes = 0
+
+    @classmethod
+    def from_config(cls) -> "SSEWriter":
+        config = get_config().stream
+        return cls(config.flush_interval_ms / 1000, config.max_frame_bytes, config.heartbeat_seconds, config.queue_size)
+
+    def _buffer(self, event: Dict[str, Any]) -> None:
+        piece = event.get("delta") or ""
+        last = self._pending[-1] if self._pending else None
+        if last is not None and _same_stream(last, event):
+            last["delta"] += piece
+        else:
+            self._pending.append(dict(event, delta=piece))
+        self._pending_bytes += len(piece.encode("utf-8"))
+
+    def _flush(self) -> bytes:
+        frame = b"".join(encode_event(event) for event in self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        return frame
+
+    async def _pump(self, events: AsyncIterator[Dict[str, Any]], queue: EventQueue) -> None:
+        """Drain the run into the queue at the producer's pace."""
+        try:
+            async for event in events:
+                if not queue.put(event):
+                    break
+        except Exception:
+            logger.exception("SSE 事件源异常结束")
+        finally:
+            queue.close()
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                with suppress(Exception):
+                    await aclose()
+
+    async def stream(self, events: AsyncIterator[Dict[str, Any]]) -> AsyncGenerator[bytes, None]:
+        stats = open_connection_stats()
+        queue = EventQueue(self.queue_size, stats)
+        pump = asyncio.ensure_future(self._pump(events, queue))
+        deadline = 0.0
+        last_write = time.monotonic()
+        try:
+            while not queue.finished:
+                now = time.monotonic()
+                if self._pending:
+                    timeout: Optional[float] = max(0.0, deadline - now)
+                elif self.heartbeat_interval > 0:
+                    timeout = max(0.0, last_write + self.heartbeat_interval - now)
+                else:
+                    timeout = None
+
+                event = await queue.get(timeout)
+                if event is None:
+                    if queue.finished:
+                        break
+                    yield self._flush() if self._pending else HEARTBEAT
+                    last_write = time.monotonic()
+                    continue
+
+                if event.get("type") in DELTA_EVENT_TYPES:
+                    if not self._pending:
+                        deadline = time.monotonic() + self.flush_interval
+                    self._buffer(event)
+                    if self._pending_bytes < self.max_frame_bytes and time.monotonic() < deadline:
+                        continue
+                    frame = self._flush()
+                else:
+                    frame = self._flush() + encode_event(event)
+                yield frame
+                last_write = time.monotonic()
+
+            if queue.overflowed:
+                stats.disconnect_reason = "slow_consumer"
+                logger.warning(
+                    f"SSE 连接 {stats.id} 接收过慢，队列已满 ({queue.maxsize})，断开连接；"
+                    f"最大延迟 {stats.max_lag * 1000:.0f}ms"
+                )
+                yield self._flush() + encode_event(SLOW_CONSUMER_EVENT)
+            elif self._pending:
+                yield self._flush()
+        finally:
+            pump.cancel()
+            with suppress(asyncio.CancelledError, Exception):
+                await pump
+            close_connection_stats(stats)
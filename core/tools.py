@@ -0,0 +1,339 @@
+"""Tool execution layer shared by every model in a run.
+
+Models in the same run tend to issue nearly identical searches. The
+``ToolResultCache`` normalizes tool arguments, coalesces identical in-flight
+calls (single-flight) and keeps successful results for the rest of the run,
+optionally backed by a process-wide cache with a TTL. ``ToolExecutor`` turns
+the tool calls of one completion into tool messages, running them
+concurrently under a shared concurrency limit and per-tool timeouts, and
+reports ``tool_call_started`` / ``tool_call_finished`` progress events.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from core.config import get_config
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+_TRAILING_PUNCTUATION = "?？!！。.,，;；:："
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query so trivially different phrasings share a key."""
+    text = unicodedata.normalize("NFKC", query or "").lower()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text.strip(_TRAILING_PUNCTUATION).strip()
+
+
+class ToolResultCache:
+    """Single-flight result cache for tool calls.
+
+    Results are kept only when they report ``success``; failures and
+    exceptions are handed to every waiter of that flight but not cached, so
+    the next call retries.
+    """
+
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        max_entries: int = 256,
+        parent: Optional["ToolResultCache"] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.parent = parent
+        self._results: "OrderedDict[Hashable, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[Hashable, "asyncio.Future[Dict[str, Any]]"] = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _lookup(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return result
+
+    def _store(self, key: Hashable, result: Dict[str, Any]) -> None:
+        if not result.get("success"):
+            return
+        self._results[key] = (time.monotonic(), result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    async def run(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        """Return the cached result for ``key`` or run ``factory`` exactly once."""
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        if self.parent is not None:
+            call = lambda: self.parent.run(key, factory)  # noqa: E731
+        else:
+            call = factory
+        task = asyncio.ensure_future(call())
+        self._inflight[key] = task
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            if task.done():
+                self._inflight.pop(key, None)
+            else:
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self._store(key, result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "coalesced": self.coalesced, "misses": self.misses}
+
+
+_shared_cache: Optional[ToolResultCache] = None
+
+
+def get_shared_tool_cache() -> Optional[ToolResultCache]:
+    """Process-wide cache, or None when TOOL_CACHE_SHARED is off."""
+    global _shared_cache
+    cfg = get_config().tools
+    if not cfg.shared_cache:
+        return None
+    if _shared_cache is None:
+        _shared_cache = ToolResultCache(ttl=cfg.cache_ttl, max_entries=cfg.cache_max_entries)
+    return _shared_cache
+
+
+def create_run_tool_cache() -> ToolResultCache:
+    """Cache for one peer-review run, layered over the shared cache if enabled."""
+    return ToolResultCache(parent=get_shared_tool_cache())
+
+
+async def cached_network_search(cache: Optional[ToolResultCache], query: str) -> Dict[str, Any]:
+    """SearXNG search + AI context, deduplicated through ``cache``."""
+    from core.searxng import get_searxng_client
+
+    client: Any = get_searxng_client()
+    if cache is None:
+        return await client.search_with_ai_summary(query)
+    key = ("network_search", normalize_query(query))
+    return await cache.run(key, lambda: client.search_with_ai_summary(query))
+
+
+async def cached_browser_search(
+    cache: Optional[ToolResultCache], query: str, max_pages: Optional[int] = None
+) -> Dict[str, Any]:
+    """Browser-backed search, deduplicated through ``cache``."""
+    from core.browser_search import get_browser_search_client
+
+    client: Any = get_browser_search_client()
+    if cache is None:
+        return await client.search(query, max_pages=max_pages)
+    key = ("browser_search", normalize_query(query), max_pages)
+    return await cache.run(key, lambda: client.search(query, max_pages=max_pages))
+
+
+def _parse_max_pages(value: Any) -> Optional[int]:
+    """Normalize the optional max_pages argument passed to tools."""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+class ToolExecutor:
+    """Runs the tool calls of one completion and builds the tool messages.
+
+    One executor is shared by every model of a run, so its semaphore bounds
+    the total number of tool calls in flight for that run. ``on_event``
+    receives a progress event before and after every call.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[ToolResultCache] = None,
+        max_concurrency: Optional[int] = None,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        cfg = get_config().tools
+        self.cache = cache
+        self.on_event = on_event
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency or cfg.max_concurrency))
+        self.timeouts: Dict[str, float] = {
+            "network_search": cfg.network_timeout,
+            "browser_search": cfg.browser_timeout,
+        }
+
+    async def execute(
+        self,
+        tool_calls: List[Dict[str, Any]],
+        model_name: str = "",
+        step: int = 1,
+    ) -> List[Dict[str, Any]]:
+        """Execute ``[{"id", "name", "arguments"}, ...]`` concurrently.
+
+        The returned tool messages keep the order of ``tool_calls`` so every
+        ``tool_call_id`` lines up with the assistant message that issued it.
+        """
+        return list(await asyncio.gather(
+            *[self._execute_one(call, model_name, step) for call in tool_calls]
+        ))
+
+    def _emit(self, event: Dict[str, Any]) -> None:
+        if self.on_event is None:
+            return
+        try:
+            self.on_event(event)
+        except Exception:  # pragma: no cover - progress reporting must never break a tool call
+            logger.exception("Tool progress callback failed")
+
+    async def _execute_one(self, call: Dict[str, Any], model_name: str, step: int) -> Dict[str, Any]:
+        name = call.get("name", "") or ""
+        try:
+            args = json.loads(call.get("arguments", "") or "{}")
+        except json.JSONDecodeError:
+            args = {}
+        args_dict: Dict[str, Any] = args if isinstance(args, dict) else {}
+
+        progress = {
+            "model_name": model_name,
+            "tool_call_id": call.get("id", ""),
+            "tool": name,
+            "query": str(args_dict.get("query", "") or ""),
+            "step": step,
+        }
+        timeout = self.timeouts.get(name)
+        timed_out = False
+        async with self._semaphore:
+            self._emit({"type": "tool_call_started", **progress})
+            started = time.monotonic()
+            try:
+                content = await asyncio.wait_for(self._dispatch(name, args_dict), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Tool %s timed out after %ss", name, timeout)
+                content = f"工具 {name} 执行超时（{timeout:g} 秒）。"
+                timed_out = True
+            self._emit({
+                "type": "tool_call_finished",
+                **progress,
+                "duration": round(time.monotonic() - started, 3),
+                "result_size": len(content),
+                "timed_out": timed_out,
+            })
+
+        return {
+            "tool_call_id": call.get("id", ""),
+            "role": "tool",
+            "name": name,
+            "content": content,
+        }
+
+    async def _dispatch(self, name: str, args: Dict[str, Any]) -> str:
+        query = str(args.get("query", "") or "").strip()
+        if name == "network_search":
+            return await self._network_search(query)
+        if name == "browser_search":
+            return await self._browser_search(query, _parse_max_pages(args.get("max_pages")))
+        return f"未知工具: {name}"
+
+    async def _network_search(self, query: str) -> str:
+        if not query:
+            return "搜索关键词为空。"
+        try:
+            search_result = await cached_network_search(self.cache, query)
+        except Exception as e:
+            return f"执行搜索时出错: {str(e)}"
+        if not search_result.get('success'):
+            return f"搜索失败: {search_result.get('error', '搜索失败')}"
+        results_text = search_result.get('ai_context', '')
+        if not results_text:
+            return "搜索未找到相关结果。"
+        return (
+            "搜索结果：\n\n"
+            f"{results_text}\n\n"
+            "基于以上搜索结果，请回答用户的问题。"
+        )
+
+    async def _browser_search(self, query: str, max_pages: Optional[int]) -> str:
+        from core.browser_search import BrowserSearchUnavailable
+
+        if not query:
+            return "浏览器搜索关键词为空。"
+        try:
+            browser_result = await cached_browser_search(self.cache, query, max_pages)
+        except BrowserSearchUnavailable as e:
+            return f"浏览器搜索当前不可用: {e}"
+        except Exception as e:
+            return f"执行浏览器搜索时出错: {str(e)}"
+        if not browser_result.get("success"):
+            return f"浏览器抓取失败: {browser_result.get('error', '未知错误')}"
+        context = browser_result.get("context", "")
+        if not context:
+            return "浏览器抓取完成，但未提取到可用正文。"
+        return (
+            "浏览器抓取结果：\n\n"
+            f"{context}\n\n"
+            "请结合上述网页内容，整合出权威、最新的回答。"
+        )
+
+
+class ToolLoopBudget:
+    """Step and wall-clock budget for one model's multi-step tool loop."""
+
+    def __init__(self, tools_enabled: bool = True) -> None:
+        cfg = get_config().tools
+        self.max_steps = cfg.max_steps if tools_enabled else 0
+        self.deadline = time.monotonic() + cfg.time_budget
+        self.steps = 0
+
+    def allows_step(self) -> bool:
+        """True while the model may still issue another round of tool calls."""
+        return self.steps < self.max_steps and time.monotonic() < self.deadline
+
+    def consume_step(self) -> int:
+        self.steps += 1
+        return self.steps
+
+
+def create_run_tool_executor(
+    on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> ToolExecutor:
+    """Executor for one peer-review run, with its own run-scoped cache."""
+    return ToolExecutor(cache=create_run_tool_cache(), on_event=on_event)
+
+
+__all__ = [
+    "ToolExecutor",
+    "ToolLoopBudget",
+    "ToolResultCache",
+    "cached_browser_search",
+    "cached_network_search",
+    "create_run_tool_cache",
+    "create_run_tool_executor",
+    "get_shared_tool_cache",
+    "normalize_query",
+]
@@ -0,0 +1,141 @@
+"""Token usage accounting for one peer-review run.
+
+Every provider response reports prompt, completion and cached prompt
+tokens. Models record them into the run's ``UsageTracker``, tagged with the
+pipeline stage (initial / critique / retry / revision) the orchestrator is
+in, so the final result can show which model and which stage dominate.
+Every bucket reports its cache hit rate (cached / prompt tokens), and run
+trackers also feed a process-wide tracker exposed on /api/metrics.
+"""
+from __future__ import annotations
+
+import contextvars
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+from core.exceptions import TokenBudgetExceeded
+
+T = TypeVar("T")
+
+# 当前调用所属的流水线阶段；由编排器在每个并发任务内设置
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("usage_stage", default="initial")
+
+
+async def run_in_stage(stage: str, awaitable: Awaitable[T]) -> T:
+    """Await ``awaitable`` with ``current_stage`` set to ``stage``.
+
+    Used around coroutines handed to ``asyncio.gather``: each one runs in its
+    own task, so the stage never leaks into sibling calls.
+    """
+    token = current_stage.set(stage)
+    try:
+        return await awaitable
+    finally:
+        current_stage.reset(token)
+
+
+def _empty() -> Dict[str, int]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "total_tokens": 0}
+
+
+def _add(bucket: Dict[str, int], prompt: int, completion: int, cached: int) -> None:
+    bucket["calls"] += 1
+    bucket["prompt_tokens"] += prompt
+    bucket["completion_tokens"] += completion
+    bucket["cached_tokens"] += cached
+    bucket["total_tokens"] += prompt + completion
+
+
+def _report(bucket: Dict[str, int]) -> Dict[str, Any]:
+    prompt = bucket["prompt_tokens"]
+    return {**bucket, "cache_hit_rate": round(bucket["cached_tokens"] / prompt, 4) if prompt else 0.0}
+
+
+class UsageTracker:
+    """Per-run token totals by model and by stage, with an optional budget.
+
+    Records are forwarded to ``parent`` (the process-wide tracker) so that
+    long-term cache hit rates survive the run.
+    """
+
+    def __init__(self, token_budget: Optional[int] = None, parent: Optional["UsageTracker"] = None) -> None:
+        self.token_budget = token_budget if token_budget and token_budget > 0 else None
+        self.parent = parent
+        self.total = _empty()
+        self.by_model: Dict[str, Dict[str, int]] = {}
+        self.by_stage: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model_name: str, prompt: int, completion: int, cached: int = 0, stage: Optional[str] = None) -> None:
+        stage = stage or current_stage.get()
+        prompt, completion, cached = int(prompt or 0), int(completion or 0), int(cached or 0)
+        _add(self.total, prompt, completion, cached)
+        _add(self.by_model.setdefault(model_name, _empty()), prompt, completion, cached)
+        _add(self.by_stage.setdefault(stage, _empty()), prompt, completion, cached)
+        if self.parent is not None:
+            self.parent.record(model_name, prompt, completion, cached, stage)
+
+    def exhausted(self) -> bool:
+        return self.token_budget is not None and self.total["total_tokens"] >= self.token_budget
+
+    def check_budget(self) -> None:
+        """Raise before launching a new call once the run's budget is spent."""
+        if self.exhausted():
+            raise TokenBudgetExceeded(self.token_budget or 0, self.total["total_tokens"])
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "total": _report(self.total),
+            "by_model": {name: _report(bucket) for name, bucket in self.by_model.items()},
+            "by_stage": {name: _report(bucket) for name, bucket in self.by_stage.items()},
+            "token_budget": self.token_budget,
+            "budget_exhausted": self.exhausted(),
+        }
+
+
+_process_usage: Optional[UsageTracker] = None
+
+
+def get_process_usage() -> UsageTracker:
+    """Usage accumulated by every run since the process started."""
+    global _process_usage
+    if _process_usage is None:
+        _process_usage = UsageTracker()
+    return _process_usage
+
+
+def create_run_usage_tracker(token_budget: Optional[int] = None) -> UsageTracker:
+    """Tracker for one peer-review run, reporting into the process-wide tracker."""
+    return UsageTracker(token_budget, parent=get_process_usage())
+
+
+def openai_usage(usage: Any) -> Optional[Dict[str, int]]:
+    """Token counts from an OpenAI ``usage`` object (response or final stream chunk)."""
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion": getattr(usage, "completion_tokens", 0) or 0,
+        "cached": getattr(details, "cached_tokens", 0) or 0,
+    }
+
+
+def gemini_usage(metadata: Any) -> Optional[Dict[str, int]]:
+    """Token counts from a Gemini ``usage_metadata``."""
+    if metadata is None or not getattr(metadata, "prompt_token_count", 0):
+        return None
+    return {
+        "prompt": getattr(metadata, "prompt_token_count", 0) or 0,
+        "completion": getattr(metadata, "candidates_token_count", 0) or 0,
+        "cached": getattr(metadata, "cached_content_token_count", 0) or 0,
+    }
+
+
+__all__ = [
+    "UsageTracker",
+    "create_run_usage_tracker",
+    "current_stage",
+    "gemini_usage",
+    "get_process_usage",
+    "openai_usage",
+    "run_in_stage",
+]
@@ -2,22 +2,32 @@
 AI Peer Review Platform - Main Application
 Linus Style: "Simple, explicit, and maintainable"
 """
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
 
 from api.router import router as api_router
-from core.database import initialize_database
+from api.ws import router as ws_router
+from core.database import close_db_connections, initialize_database, run_archive_job
 from core.logging import get_logger
 from core.config import get_config
+from core.executor import shutdown_provider_executor
+from core.imaging import shutdown_image_preprocessor
+from core.assets import AssetStore
+from core.sessions import run_session_eviction_job
+from core.ratelimit import RateLimitMiddleware
 
 # Initialize configuration and logging
 config = get_config()
 logger = get_logger(__name__)
 
+# 静态资源启动时一次性读入内存：按内容哈希生成指纹 URL，并预先压缩
+assets = AssetStore("static")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager - modern FastAPI style"""
@@ -25,9 +35,23 @@ async def lifespan(app: FastAPI):
     logger.info("Starting AI Peer Review Platform v2.0...")
     initialize_database()
     logger.info("Database initialized")
+    assets.load()
+    db_config = get_config().database
+    background_tasks = []
+    if db_config.history_enabled and db_config.archive_after_days > 0:
+        background_tasks.append(asyncio.create_task(run_archive_job()))
+    if get_config().session.idle_hours > 0:
+        background_tasks.append(asyncio.create_task(run_session_eviction_job()))
     yield
     # Shutdown
     logger.info("Shutting down AI Peer Review Platform...")
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    shutdown_provider_executor()
+    shutdown_image_preprocessor()
+    close_db_connections()
 
 # Create FastAPI app - simple and explicit
 app = FastAPI(
@@ -37,6 +61,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Per-client token buckets and fair queuing on the expensive endpoints (inside CORS so 429s stay readable)
+app.add_middleware(RateLimitMiddleware)
+
 # CORS - allow all in development, restrict in production
 app.add_middleware(
     CORSMiddleware,
@@ -46,19 +73,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON API responses; precompressed assets and SSE streams are passed through untouched
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
+
 # Static files and API routes
-app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(api_router, prefix="/api")
+app.include_router(ws_router, prefix="/api")
+
+def asset_response(path: str, request: Request) -> Response:
+    """Serve an in-memory asset with content negotiation and ETag revalidation"""
+    result = assets.respond(path, request.headers.get("accept-encoding", ""), request.headers.get("if-none-match"))
+    if result is None:
+        raise HTTPException(404, "Not Found")
+    status, headers, body = result
+    return Response(content=body, status_code=status, headers=headers)
+
+@app.get("/static/{path:path}")
+async def static_asset(path: str, request: Request):
+    return asset_response(path, request)
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
+@app.get("/")
+async def read_root(request: Request):
     """Serve main page"""
-    try:
-        with open("static/index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
-        logger.error("index.html not found")
-        return HTMLResponse(content="<h1>Error: index.html not found</h1>", status_code=500)
+    return asset_response("index.html", request)
 
 @app.get("/health")
 async def health_check():
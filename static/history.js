@@ -1,206 +1,314 @@
 /*
  * static/history.js
- * 历史记录功能模块 - Linus 风格重构
- * "Simplicity is prerequisite for reliability" - Edsger Dijkstra (but Linus agrees)
+ * 历史记录功能模块 - 服务端存储，按页懒加载
+ * 列表来自 GET /api/history（键集分页），搜索走 GET /api/history/search（FTS5），
+ * 点击某条记录时才通过 GET /api/history/{id} 取回完整内容。
+ * 服务端只返回本浏览器（X-Client-Id）的记录；旧版本存在 localStorage 的记录仍列在最后。
  */
 
 (function() {
     'use strict';
-    
+
     const S = window.S || {
         get: (k, d) => localStorage.getItem(k) || d,
         set: (k, v) => localStorage.setItem(k, v)
     };
-    
-    // 保存聊天历史
-    function saveChatHistory() {
+
+    const PAGE_SIZE = 20;
+    const CLIENT_ID_KEY = 'history_client_id';
+    // 旧版本把对话保存在 localStorage 的这个键下（最多 50 条），只在本机读取，不上传
+    const LEGACY_KEY = 'all_chat_history';
+    const SEARCH_DEBOUNCE_MS = 300;
+    // 距离列表底部多少像素时加载下一页
+    const LOAD_MORE_THRESHOLD = 80;
+
+    const state = {
+        query: '',
+        cursor: null,
+        hasMore: true,
+        loading: false,
+        // 每次重置列表（打开弹窗、修改搜索词）时递增，丢弃过期请求的结果
+        generation: 0
+    };
+
+    function lang() {
+        return window.currentLang || 'zh';
+    }
+
+    function texts() {
+        const fallback = { noHistory: '暂无历史记录', user: '用户', aiAssistant: 'AI助手' };
+        return (window.i18n && window.i18n[lang()]) || fallback;
+    }
+
+    // 本浏览器的历史记录标识：首次使用时随机生成并保存，随请求以 X-Client-Id 发送
+    function clientId() {
+        let id = S.get(CLIENT_ID_KEY);
+        if (!id) {
+            const bytes = window.crypto.getRandomValues(new Uint8Array(16));
+            id = Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+            S.set(CLIENT_ID_KEY, id);
+        }
+        return id;
+    }
+
+    // 对应设置里的“自动保存”开关：关闭时请求不带 save_history，服务端不记录本次运行
+    function autoSaveEnabled() {
+        return S.get('sw_auto-save') === '1';
+    }
+
+    function legacyItems(query) {
+        let items;
         try {
-            const chatLog = document.getElementById('chat-log');
-            if (!chatLog) return;
-            
-            const messages = [];
-            chatLog.querySelectorAll('.chat-message').forEach(msg => {
-                const isUser = msg.classList.contains('user');
-                let contentEl = null;
-                
-                if (isUser) {
-                    const divs = msg.querySelectorAll('div');
-                    if (divs.length > 1) contentEl = divs[divs.length - 1];
-                } else {
-                    contentEl = msg.querySelector('.response-content') || 
-                               msg.querySelector('.final-answer') || 
-                               msg.querySelector('.process-text') ||
-                               (() => {
-                                   const divs = msg.querySelectorAll('div');
-                                   return divs.length > 1 ? divs[divs.length - 1] : null;
-                               })();
-                }
-                
-                if (contentEl) {
-                    const content = contentEl.textContent.trim();
-                    // 跳过空内容和状态消息
-                    if (content && !content.startsWith('✓') && !content.startsWith('❌') && 
-                        !content.includes('正在初始化') && !content.includes('正在') && 
-                        content.length > 3) {
-                        const timestamp = msg.getAttribute('data-timestamp') || Date.now().toString();
-                        messages.push({
-                            type: isUser ? 'user' : 'assistant',
-                            content: content,
-                            timestamp: timestamp
-                        });
-                    }
+            items = JSON.parse(localStorage.getItem(LEGACY_KEY) || '[]');
+        } catch (e) {
+            return [];
+        }
+        if (!Array.isArray(items)) return [];
+        const terms = query.toLowerCase().split(/\s+/).filter(Boolean);
+        return items.filter(item => item && Array.isArray(item.messages) && terms.every(term =>
+            String(item.title || '').toLowerCase().includes(term) ||
+            item.messages.some(msg => String(msg.content || '').toLowerCase().includes(term))
+        ));
+    }
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text == null ? '' : String(text);
+        return div.innerHTML;
+    }
+
+    // SQLite 的 CURRENT_TIMESTAMP 是 UTC 的 "YYYY-MM-DD HH:MM:SS"
+    function parseTimestamp(value) {
+        if (!value) return new Date();
+        return new Date(String(value).replace(' ', 'T') + 'Z');
+    }
+
+    function formatDate(date) {
+        return date.toLocaleString(lang() === 'en' ? 'en-US' : 'zh-CN', {
+            month: 'numeric',
+            day: 'numeric',
+            hour: '2-digit',
+            minute: '2-digit'
+        });
+    }
+
+    function ensureSearchBox() {
+        const popup = document.getElementById('history-popup');
+        const container = document.getElementById('chat-history');
+        if (!popup || !container) return null;
+
+        let input = document.getElementById('history-search');
+        if (!input) {
+            const wrapper = document.createElement('div');
+            wrapper.className = 'p-2 border-b border-gray-700';
+            input = document.createElement('input');
+            input.id = 'history-search';
+            input.type = 'search';
+            input.className = 'w-full px-2 py-1 text-sm bg-gray-800 border border-gray-700 rounded text-gray-200';
+            wrapper.appendChild(input);
+            popup.insertBefore(wrapper, container);
+
+            let timer = null;
+            input.addEventListener('input', () => {
+                clearTimeout(timer);
+                timer = setTimeout(() => resetAndLoad(input.value.trim()), SEARCH_DEBOUNCE_MS);
+            });
+            input.addEventListener('click', e => e.stopPropagation());
+            container.addEventListener('scroll', () => {
+                if (container.scrollTop + container.clientHeight >= container.scrollHeight - LOAD_MORE_THRESHOLD) {
+                    loadNextPage();
                 }
             });
-            
-            if (messages.length >= 2) {
-                const historyKey = 'chat_history_' + Date.now();
-                const firstUserMsg = messages.find(m => m.type === 'user');
-                const title = firstUserMsg ? (firstUserMsg.content.substring(0, 30) + (firstUserMsg.content.length > 30 ? '...' : '')) : '对话记录';
-                
-                const historyItem = {
-                    id: historyKey,
-                    title: title,
-                    messages: messages,
-                    createdAt: Date.now()
-                };
-                
-                let allHistory = JSON.parse(S.get('all_chat_history', '[]'));
-                
-                // 检查是否重复
-                const isDuplicate = allHistory.some(h => {
-                    if (h.messages.length !== messages.length) return false;
-                    return h.messages.every((m, i) => 
-                        m.type === messages[i].type && m.content === messages[i].content
-                    );
-                });
-                
-                if (!isDuplicate) {
-                    allHistory.unshift(historyItem);
-                    if (allHistory.length > 50) allHistory = allHistory.slice(0, 50);
-                    S.set('all_chat_history', JSON.stringify(allHistory));
-                    console.log('[历史记录] 已保存，共', messages.length, '条消息');
+        }
+        input.placeholder = lang() === 'en' ? 'Search history...' : '搜索历史记录...';
+        return input;
+    }
+
+    function historyEntry(title, date, onOpen) {
+        const el = document.createElement('div');
+        el.className = 'history-item p-2 hover:bg-gray-800 rounded cursor-pointer mb-1';
+        el.innerHTML = `
+            <div class="text-sm text-gray-200 truncate">${escapeHtml(title || '未命名对话')}</div>
+            <div class="text-xs text-gray-500 mt-1">${formatDate(date)}</div>
+        `;
+        el.addEventListener('click', onOpen);
+        return el;
+    }
+
+    function renderItems(items, append) {
+        const container = document.getElementById('chat-history');
+        if (!container) return;
+        if (!append) container.innerHTML = '';
+
+        const fragment = document.createDocumentFragment();
+        items.forEach(item => {
+            const el = historyEntry(item.question || item.preview, parseTimestamp(item.created_at), () => openRun(item.id));
+            el.dataset.id = item.id;
+            fragment.appendChild(el);
+        });
+        container.appendChild(fragment);
+    }
+
+    // 服务端记录加载完后，接着列出匹配的旧版本地记录
+    function renderLegacy() {
+        const container = document.getElementById('chat-history');
+        if (!container) return;
+        const items = legacyItems(state.query);
+        if (items.length) {
+            const fragment = document.createDocumentFragment();
+            const header = document.createElement('div');
+            header.className = 'text-xs text-gray-500 px-2 pt-2 pb-1';
+            header.textContent = lang() === 'en' ? 'Saved in this browser' : '本机旧记录';
+            fragment.appendChild(header);
+            items.forEach(item => {
+                const createdAt = item.createdAt || Number(String(item.id).replace('chat_history_', ''));
+                const title = item.title || (item.messages[0] && item.messages[0].content);
+                fragment.appendChild(historyEntry(title, new Date(createdAt), () => {
+                    loadHistoryToChat(item);
+                    closePopup();
+                }));
+            });
+            container.appendChild(fragment);
+        }
+        if (!container.children.length) {
+            container.innerHTML = `<div class="text-sm text-gray-400 text-center py-4">${escapeHtml(texts().noHistory)}</div>`;
+        }
+    }
+
+    function closePopup() {
+        const popup = document.getElementById('history-popup');
+        if (popup) popup.classList.add('hidden');
+    }
+
+    async function loadNextPage() {
+        if (state.loading || !state.hasMore) return;
+        state.loading = true;
+        const generation = state.generation;
+        const append = state.cursor !== null;
+
+        const params = new URLSearchParams({ limit: PAGE_SIZE });
+        if (state.cursor !== null) params.set('before', state.cursor);
+        let url = '/api/history';
+        if (state.query) {
+            url = '/api/history/search';
+            params.set('q', state.query);
+        }
+
+        try {
+            const response = await fetch(`${url}?${params}`, { headers: { 'X-Client-Id': clientId() } });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const page = await response.json();
+            if (generation !== state.generation) return;
+            renderItems(page.items || [], append);
+            state.cursor = page.next_cursor;
+            state.hasMore = page.next_cursor !== null && page.next_cursor !== undefined;
+            if (!state.hasMore) renderLegacy();
+        } catch (e) {
+            console.error('[历史记录] 加载失败:', e);
+            if (generation === state.generation && !append) {
+                const container = document.getElementById('chat-history');
+                if (container) {
+                    container.innerHTML = `<div class="text-sm text-red-400 text-center py-4">加载失败: ${escapeHtml(e.message)}</div>`;
                 }
             }
-        } catch (e) {
-            console.error('[历史记录] 保存失败:', e);
+        } finally {
+            if (generation === state.generation) state.loading = false;
         }
     }
-    
-    // 加载聊天历史
+
+    function resetAndLoad(query) {
+        state.generation += 1;
+        state.query = query || '';
+        state.cursor = null;
+        state.hasMore = true;
+        state.loading = false;
+        const container = document.getElementById('chat-history');
+        if (container) container.scrollTop = 0;
+        loadNextPage();
+    }
+
+    // 打开历史弹窗时加载第一页
     function loadChatHistory() {
+        const input = ensureSearchBox();
+        resetAndLoad(input ? input.value.trim() : '');
+    }
+
+    async function openRun(runId) {
         try {
-            console.log('[历史记录] 开始加载...');
-            const historyContainer = document.getElementById('chat-history');
-            if (!historyContainer) {
-                console.error('[历史记录] 容器不存在');
-                return;
-            }
-            
-            let allHistory = [];
-            try {
-                const historyStr = S.get('all_chat_history', '[]');
-                allHistory = JSON.parse(historyStr);
-                console.log('[历史记录] 成功解析，数量:', allHistory.length);
-            } catch (e) {
-                console.error('[历史记录] 解析失败:', e);
-                allHistory = [];
-            }
-            
-            if (!Array.isArray(allHistory) || allHistory.length === 0) {
-                const t = window.i18n ? window.i18n[window.currentLang || 'zh'] : { noHistory: '暂无历史记录' };
-                historyContainer.innerHTML = `<div class="text-sm text-gray-400 text-center py-4">${t.noHistory}</div>`;
-                return;
-            }
-            
-            console.log('[历史记录] 渲染', allHistory.length, '条记录');
-            historyContainer.innerHTML = allHistory.map(item => {
-                const date = new Date(item.createdAt || Date.now());
-                const dateStr = date.toLocaleString(window.currentLang === 'en' ? 'en-US' : 'zh-CN', {
-                    month: 'numeric',
-                    day: 'numeric',
-                    hour: '2-digit',
-                    minute: '2-digit'
-                });
-                return `
-                    <div class="history-item p-2 hover:bg-gray-800 rounded cursor-pointer mb-1" data-id="${item.id || 'unknown'}">
-                        <div class="text-sm text-gray-200 truncate">${item.title || '未命名对话'}</div>
-                        <div class="text-xs text-gray-500 mt-1">${dateStr}</div>
-                    </div>
-                `;
-            }).join('');
-            
-            // 绑定点击事件
-            historyContainer.querySelectorAll('.history-item').forEach(item => {
-                item.addEventListener('click', () => {
-                    const id = item.getAttribute('data-id');
-                    const historyItem = allHistory.find(h => h.id === id);
-                    if (historyItem) {
-                        console.log('[历史记录] 加载:', historyItem.title);
-                        loadHistoryToChat(historyItem);
-                        const popup = document.getElementById('history-popup');
-                        if (popup) popup.classList.add('hidden');
-                    }
-                });
+            const response = await fetch(`/api/history/${encodeURIComponent(runId)}`, {
+                headers: { 'X-Client-Id': clientId() }
             });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const run = await response.json();
+            const createdAt = parseTimestamp(run.created_at).getTime().toString();
+            loadHistoryToChat({
+                id: run.id,
+                title: run.question,
+                messages: [
+                    { type: 'user', content: run.question, timestamp: createdAt },
+                    { type: 'assistant', content: run.best_answer || '', timestamp: createdAt }
+                ]
+            });
+            closePopup();
         } catch (e) {
-            console.error('[历史记录] 加载失败:', e);
+            console.error('[历史记录] 打开记录失败:', e);
         }
     }
-    
+
     // 加载历史到聊天框
     function loadHistoryToChat(historyItem) {
         const chatLog = document.getElementById('chat-log');
         if (!chatLog) return;
-        
+
         chatLog.innerHTML = '';
-        
-        const t = window.i18n ? window.i18n[window.currentLang || 'zh'] : { user: '用户', aiAssistant: 'AI助手' };
+
+        const t = texts();
         historyItem.messages.forEach(msg => {
             const msgDiv = document.createElement('div');
             msgDiv.className = `chat-message ${msg.type}`;
             msgDiv.setAttribute('data-timestamp', msg.timestamp);
-            
+
             if (msg.type === 'user') {
-                msgDiv.innerHTML = `<div class="font-medium mb-1">${t.user}</div><div>${msg.content}</div>`;
+                msgDiv.innerHTML = `<div class="font-medium mb-1">${escapeHtml(t.user)}</div><div>${escapeHtml(msg.content)}</div>`;
             } else {
-                msgDiv.innerHTML = `<div class="font-medium mb-1 text-purple-400">${t.aiAssistant}</div><div class="response-content">${msg.content}</div>`;
+                const body = window.marked ? window.marked.parse(msg.content) : escapeHtml(msg.content);
+                msgDiv.innerHTML = `<div class="font-medium mb-1 text-purple-400">${escapeHtml(t.aiAssistant)}</div><div class="response-content">${body}</div>`;
             }
-            
+
             // 如果时间戳功能开启，添加时间戳
             if (S.get('sw_timestamps') === '1') {
                 const timeEl = document.createElement('div');
                 timeEl.className = 'message-timestamp';
                 timeEl.style.cssText = 'font-size: 11px; color: var(--text-muted); margin-top: 4px;';
                 const date = new Date(parseInt(msg.timestamp));
-                const lang = window.currentLang || 'zh';
-                timeEl.textContent = date.toLocaleString(lang === 'en' ? 'en-US' : 'zh-CN', { 
-                    month: lang === 'en' ? 'short' : 'numeric', 
-                    day: 'numeric', 
-                    hour: '2-digit', 
-                    minute: '2-digit' 
+                timeEl.textContent = date.toLocaleString(lang() === 'en' ? 'en-US' : 'zh-CN', {
+                    month: lang() === 'en' ? 'short' : 'numeric',
+                    day: 'numeric',
+                    hour: '2-digit',
+                    minute: '2-digit'
                 });
                 msgDiv.appendChild(timeEl);
             }
-            
+
             chatLog.appendChild(msgDiv);
         });
-        
+
         chatLog.scrollTop = chatLog.scrollHeight;
     }
-    
+
     // 初始化历史记录功能
     function init() {
         const historyBtn = document.getElementById('history-btn');
         const historyPopup = document.getElementById('history-popup');
-        
+
         if (historyBtn && historyPopup) {
             historyBtn.addEventListener('click', (e) => {
                 e.stopPropagation();
                 e.preventDefault();
-                loadChatHistory();
                 historyPopup.classList.toggle('hidden');
+                if (!historyPopup.classList.contains('hidden')) loadChatHistory();
             });
-            
+
             document.addEventListener('click', (e) => {
                 if (!historyPopup.contains(e.target) && !historyBtn.contains(e.target)) {
                     historyPopup.classList.add('hidden');
@@ -208,10 +316,11 @@
             });
         }
     }
-    
-    // 导出到全局
-    window.ChatHistory = { init, saveChatHistory, loadChatHistory, loadHistoryToChat };
-    
+
+    // 导出到全局；“自动保存”开启时，运行结果由服务端在评审结束时保存（请求带 save_history），
+    // 因此 saveChatHistory 保留为空操作以兼容旧调用
+    window.ChatHistory = { init, saveChatHistory: () => {}, loadChatHistory, loadHistoryToChat, clientId, autoSaveEnabled };
+
     // 自动初始化
     if (document.readyState === 'loading') {
         document.addEventListener('DOMContentLoaded', init);
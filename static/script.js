@@ -414,6 +414,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentReader = null;
     let isGenerating = false;
     let pendingOcrText = null;
+    // 当前这次提交（请求体与 Idempotency-Key）；重试、断线重连都沿用同一个 key，服务端据此接回同一次运行
+    let pendingSubmission = null;
+    const MAX_SUBMIT_RETRIES = 2;
     
     // === DOM元素引用（带错误检查）===
     const addProviderForm = document.getElementById('add-provider-form');
@@ -838,6 +841,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 <input name="api_key" type="password" value="" class="form-input text-sm" placeholder="${getI18n('api_key')}">
                 <input name="api_base" value="${escapeHtml(p.api_base || '')}" class="form-input text-sm" placeholder="${getI18n('api_base')}">
                 <input name="models" required value="${escapeHtml(p.original_models)}" class="form-input text-sm" placeholder="${getI18n('model_list')}">
+                <input name="equivalence_group" value="${escapeHtml(p.equivalence_group || '')}" class="form-input text-sm" placeholder="等价组（可选，同组同名模型可互为对冲）">
                 <div class="flex space-x-2 pt-1">
                     <button type="submit" class="font-bold py-1 px-3 text-sm rounded-md bg-blue-600 hover:bg-blue-700 flex-1 transition-colors">${getI18n('save')}</button>
                     <button type="button" class="delete-btn font-bold py-1 px-3 text-sm rounded-md bg-red-700 hover:bg-red-600">${getI18n('delete')}</button>
@@ -903,7 +907,8 @@ document.addEventListener('DOMContentLoaded', () => {
                         name: formData.get('name'),
                         type: formData.get('type'),
                         api_base: formData.get('api_base') || '',
-                        models: formData.get('models')
+                        models: formData.get('models'),
+                        equivalence_group: formData.get('equivalence_group') || ''
                     };
                     
                     const apiKey = formData.get('api_key');
@@ -1222,7 +1227,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     type: formData.get('type'),
                     api_key: formData.get('api_key').trim(),
                     api_base: formData.get('api_base').trim() || '',
-                    models: formData.get('models').trim()
+                    models: formData.get('models').trim(),
+                    equivalence_group: (formData.get('equivalence_group') || '').trim() || null
                 };
                 
                 const response = await fetch(`${API_BASE_URL}/api/providers`, {
@@ -1365,19 +1371,52 @@ document.addEventListener('DOMContentLoaded', () => {
                 question: question,
                 selected_models: modelsToUse,
                 history: conversationHistory.slice(0, -1),
-                ocr_text: pendingOcrText || null
+                ocr_text: pendingOcrText || null,
+                // “自动保存”开关：开启时服务端把本次运行记入本浏览器的历史
+                save_history: window.ChatHistory.autoSaveEnabled()
             };
             console.log('[processQuery] 完整请求体:', JSON.stringify(requestBody, null, 2));
             
-            const response = await fetch(`${API_BASE_URL}/api/process`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+            // key 在一次提交内只生成一次，下面的重试都带同一个 key
+            pendingSubmission = {
+                key: (window.crypto && crypto.randomUUID)
+                    ? crypto.randomUUID()
+                    : `${Date.now()}-${Math.random().toString(36).slice(2)}`,
                 body: JSON.stringify(requestBody)
-            });
-            
-            if (!response.ok) throw new Error(`HTTP ${response.status}`);
-            
-        await processStream(response, assistantBubble, userBubble, question);
+            };
+            const submission = pendingSubmission;
+
+            for (let attempt = 0; ; attempt++) {
+                try {
+                    const response = await fetch(`${API_BASE_URL}/api/process`, {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json',
+                            'Idempotency-Key': submission.key,
+                            'X-Client-Id': window.ChatHistory.clientId()
+                        },
+                        body: submission.body
+                    });
+
+                    if (!response.ok) {
+                        const error = new Error(`HTTP ${response.status}`);
+                        error.retryable = [502, 503, 504].includes(response.status);
+                        throw error;
+                    }
+
+                    await processStream(response, assistantBubble, userBubble, question);
+                    return;
+                } catch (error) {
+                    // 网络中断（fetch / read 抛出 TypeError）或网关错误时重连；服务端会接回进行中的运行或重放结果
+                    const retryable = error.retryable || error instanceof TypeError;
+                    if (!isGenerating || submission !== pendingSubmission || !retryable || attempt >= MAX_SUBMIT_RETRIES) {
+                        throw error;
+                    }
+                    log.warn(`Request interrupted (${error.message}), reconnecting (${attempt + 1}/${MAX_SUBMIT_RETRIES})`);
+                    assistantBubble.innerHTML = getI18n('loading');
+                    await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+                }
+            }
     }
     
     async function processStream(response, assistantBubble, userBubble, question) {
@@ -1491,6 +1530,7 @@ document.addEventListener('DOMContentLoaded', () => {
     
     function cleanupSubmission() {
             currentReader = null;
+            pendingSubmission = null;
             toggleLoading(false);
             chatLog.scrollTop = chatLog.scrollHeight;
             // 修复：在提交后清除所有文件和OCR文本